@@ -24,6 +24,11 @@
 /* FIXME: check for 64 bits; also defined in constants.pxi */
 #define SLOTS 2
 
+#if SLOTS == 2
+/* the bit vector of a FatChartItem as a single integer. */
+typedef unsigned __int128 uint128_t;
+#endif
+
 typedef uint32_t ItemNo;
 typedef uint32_t Label;
 typedef double Prob;
@@ -200,6 +205,117 @@ private:
 };
 
 
+// The scalar priority of an agenda value; used to assign it to a bucket.
+inline double agendapriority(double v) { return v; }
+template <typename T>
+inline double agendapriority(const std::pair<double, T>& v) { return v.first; }
+
+// A bucketed priority queue with the same interface as Agenda.
+// Priorities are quantized into buckets of a fixed width; only the bucket
+// with the lowest priorities is kept as a heap, other buckets are unsorted.
+// Items are therefore popped in exactly the same order as with Agenda, but
+// when new priorities are not lower than the last popped priority (as with
+// monotone parsing scores), most insertions are constant time appends.
+// Stale entries are removed lazily on pop, as with Agenda.
+template <typename Key,
+		typename Value,
+		typename KeyHasher = spp::spp_hash<Key> >
+class BucketAgenda {
+public:
+	struct Entry {
+		Key key;
+		Value value;
+		uint32_t count;
+		Entry() { };
+		Entry(Key _key, Value _value, uint32_t _count):
+			key(_key), value(_value), count(_count) { };
+	};
+	typedef Entry entry_type;
+	typedef typename std::pair<Key, Value> item_type;
+
+	BucketAgenda() { counter = 0; cur = 0; width = 1.0; }
+	void reserve(size_t n) {
+		map.reserve(n);
+	}
+	// set the width of the buckets; should be called while agenda is empty.
+	void setwidth(double w) {
+		width = w;
+	}
+	bool member(Key k) { return map.find(k) != map.end(); }
+	bool empty() { return map.empty(); }
+	size_t size() { return map.size(); }
+	void setitem(Key k, Value v) {
+		// NB: unconditional set; see Agenda::setitem().
+		entry_type entry(k, v, ++counter);
+		map[k] = entry;
+		push(entry);
+	}
+	void setifbetter(Key k, Value v) {
+		typename map_type::iterator x = map.find(k);
+		if (x == map.end()) {
+			entry_type entry(k, v, ++counter);
+			map[k] = entry;
+			push(entry);
+		} else if (v < x->second.value) {
+			entry_type entry(k, v, x->second.count);
+			x->second = entry;
+			push(entry);
+		} // else: ignore duplicate item with lower/equal priority.
+	}
+	item_type pop() {
+		item_type noitem;
+		entry_type entry;
+		while (!map.empty()) {
+			// since map is not empty, there is a non-empty bucket >= cur
+			while (buckets[cur].empty()) {
+				cur++;
+				std::make_heap(buckets[cur].begin(), buckets[cur].end(),
+						CmpRev<entry_type>());
+			}
+			std::pop_heap(buckets[cur].begin(), buckets[cur].end(),
+					CmpRev<entry_type>());
+			entry = buckets[cur].back();
+			buckets[cur].pop_back();
+			// skip entries which are no longer in the map
+			if (map.erase(entry.key)) {
+				return item_type(entry.key, entry.value);
+			}
+		}
+		return noitem;
+	}
+private:
+	template <typename entry_type> class CmpRev {
+		public:
+		size_t operator()(const entry_type& k1, const entry_type& k2) const {
+			return k1.value > k2.value || (
+					k1.value == k2.value && k1.count > k2.count);
+		}
+	};
+	void push(entry_type entry) {
+		double priority = agendapriority(entry.value) / width;
+		size_t idx = priority <= 0 ? 0
+				: priority >= MAXBUCKETS ? MAXBUCKETS : (size_t)priority;
+		if (idx >= buckets.size()) {
+			buckets.resize(idx + 1);
+		}
+		if (idx < cur) {  // buckets below cur are empty
+			cur = idx;
+		}
+		buckets[idx].push_back(entry);
+		if (idx == cur) {
+			std::push_heap(buckets[idx].begin(), buckets[idx].end(),
+					CmpRev<entry_type>());
+		}
+	}
+	static const size_t MAXBUCKETS = 1 << 20;
+	typedef spp::sparse_hash_map<Key, entry_type, KeyHasher> map_type;
+	map_type map;
+	std::vector<std::vector<entry_type> > buckets;
+	size_t cur;  // index of bucket with lowest priorities; kept as heap
+	double width;
+	size_t counter;
+};
+
 struct ProbRule {  // total: 32 bytes.
 	Prob prob;  // 8 bytes
 	Label lhs;  // 4 bytes
@@ -210,6 +326,53 @@ struct ProbRule {  // total: 32 bytes.
 	uint32_t no;  // 4 bytes
 };
 
+/* Test whether the bit vectors of the children of a binary rule are
+ * compatible with its yield function; cf. concat() in plcfrs.pyx.
+ * T is an unsigned integer type that can hold a whole bit vector. */
+template <typename T>
+inline bool concatbits(const ProbRule *rule, T lvec, T rvec) {
+	T mask;
+	int n, numbits = rule->lengths ? 32 - __builtin_clz(rule->lengths) : 0;
+	if (lvec & rvec)
+		return false;
+	// start at the first bit; the first component should have it
+	mask = (lvec | rvec) & ~((lvec | rvec) - 1);
+	for (n = 0; n < numbits; n++) {
+		if ((rule->args >> n) & 1) {  // component from right vector
+			if ((rvec & mask) == 0)
+				return false;  // check for expected component
+			rvec |= rvec - 1;  // trailing 0 bits => 1 bits
+			mask = rvec & (~rvec - 1);  // mask of 1 bits up to first 0 bit
+		} else {  // component from left vector
+			if ((lvec & mask) == 0)
+				return false;  // check for expected component
+			lvec |= lvec - 1;  // trailing 0 bits => 1 bits
+			mask = lvec & (~lvec - 1);  // mask of 1 bits up to first 0 bit
+		}
+		// zero out component
+		lvec &= ~mask;
+		rvec &= ~mask;
+		if ((rule->lengths >> n) & 1) {  // a gap
+			// check that there is a gap in both vectors
+			if ((lvec ^ rvec) & (mask + 1))
+				return false;
+			// increase mask to cover gap
+			// get minimum of trailing zero bits of lvec & rvec
+			mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1));
+		}
+		mask += 1;  // e.g., 00111 => 01000
+	}
+	// success if we've reached the end of both left and right vector
+	return lvec == 0 && rvec == 0;
+}
+
+#if SLOTS == 2
+/* Convert the two words of a FatChartItem bit vector to a single integer. */
+inline uint128_t touint128(const uint64_t *vec) {
+	return ((uint128_t)vec[1] << 64) | vec[0];
+}
+#endif
+
 // NB: a version of ProbRule without probability, rule number.
 class Rule {  // total: 20 bytes.
 public:
@@ -318,6 +481,24 @@ public:
 	FatChartItem(Label _label): label(_label) {
 		memset(vec, 0, SLOTS * 8);
 	};
+#if SLOTS == 2
+	/* Two words: compare directly instead of calling memcmp;
+	 * the order is the numeric order of the 128-bit vector. */
+	bool operator == (const FatChartItem& k2) const {
+		return label == k2.label && vec[0] == k2.vec[0]
+				&& vec[1] == k2.vec[1];
+	}
+	bool operator < (const FatChartItem& k2) const {
+		return label < k2.label || (label == k2.label
+				&& (vec[1] < k2.vec[1] || (vec[1] == k2.vec[1]
+					&& vec[0] < k2.vec[0])));
+	}
+	bool operator > (const FatChartItem& k2) const {
+		return label > k2.label || (label == k2.label
+				&& (vec[1] > k2.vec[1] || (vec[1] == k2.vec[1]
+					&& vec[0] > k2.vec[0])));
+	}
+#else
 	bool operator == (const FatChartItem& k2) const {
 		return ((label != k2.label) ? 0 :
 				memcmp(vec, k2.vec, SLOTS * 8) == 0);
@@ -332,10 +513,11 @@ public:
 		return label > k2.label || (label == k2.label
 				&& memcmp(vec, k2.vec, SLOTS * 8) > 0);
 	}
+#endif
 };
 struct FatChartItemHasher {
 	size_t operator()(const FatChartItem& k) const {
-		size_t _hash = 0, n;
+		size_t _hash = 0;
 		/* Juxtapose bits of label and vec.
 
 		64              32            0
@@ -350,9 +532,15 @@ struct FatChartItemHasher {
 		// 	_hash *= 33 ^ ((char *)k.vec)[n];
 		// }
 		spp::hash_combine(_hash, k.label);
+#if SLOTS == 2
+		spp::hash_combine(_hash, k.vec[0]);
+		spp::hash_combine(_hash, k.vec[1]);
+#else
+		size_t n;
 		for (n=0; n < SLOTS; n++) {
 			spp::hash_combine(_hash, k.vec[n]);
 		}
+#endif
 		return _hash;
 	}
 };
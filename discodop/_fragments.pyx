@@ -109,7 +109,7 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 		Ctrees trees2=None, int start2=0, int end2=0,
 		bint approx=True, bint debug=False,
 		bint disc=False, str twoterms=None, bint adjacent=False,
-		maxnodes=None):
+		maxnodes=None, int minshared=0):
 	"""Find the largest fragments in treebank(s) with the fast tree kernel.
 
 	- scenario 1: recurring fragments in single treebank, use::
@@ -129,6 +129,9 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 		one of which has a POS tag matching the given regex.
 	:param adjacent: only extract fragments from sentences with adjacent
 		indices.
+	:param minshared: only compare tree pairs that share at least this number
+		of distinct productions, selected with the production index of
+		``trees2``; with 1, the result is the same as comparing all pairs.
 	:param maxnodes: the maximum number of nodes in a single tree to fix the
 		bitset size. Set this manually when combining results from different
 		sets of trees to ensure a consistent bitset size. By default it is the
@@ -158,6 +161,8 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 				if vocab.islexical(n)}
 	if singletb:  # if trees2 not given, consider all (n,m) s.t. n<m in trees1
 		trees2 = trees1
+	if minshared and trees2.prodindex is None:
+		raise ValueError('minshared requires production index of trees.')
 	if maxnodes:
 		SLOTS = BITNSLOTS(maxnodes + 1)
 	else:
@@ -188,6 +193,14 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 					raise ValueError('illegal index %d' % m)
 				extractfrompair(a, anodes, trees2, n, m, debug,
 						vocab, inter, minterms, matrix, scratch, SLOTS)
+		elif minshared:
+			for m in sharedproductions(a, anodes, trees2, minshared):
+				if singletb and m <= n:
+					continue
+				elif m < start2 or m >= end2:
+					continue
+				extractfrompair(a, anodes, trees2, n, m, debug,
+						vocab, inter, minterms, matrix, scratch, SLOTS)
 		else:  # all pairs
 			if singletb:
 				start2 = max(n + 1, start2)
@@ -673,6 +686,29 @@ cdef twoterminals(NodeArray a, Node *anodes,
 	return candidates
 
 
+cdef sharedproductions(NodeArray a, Node *anodes, Ctrees trees2,
+		int minshared):
+	"""Select trees from ``trees2`` that share productions with tree ``a``.
+
+	Selected trees share at least ``minshared`` distinct productions."""
+	cdef int i, j, prodindexlen = len(trees2.prodindex)
+	cdef set seen = set()
+	# atleast[j] contains the trees sharing more than j productions
+	cdef list atleast = [RoaringBitmap() for _ in range(minshared)]
+	for i in range(a.len):
+		if (anodes[i].prod < 0 or anodes[i].prod >= prodindexlen
+				or anodes[i].prod in seen):
+			continue
+		seen.add(anodes[i].prod)
+		tmp = trees2.prodindex[anodes[i].prod]
+		if tmp is None:
+			continue
+		for j in range(minshared - 1, 0, -1):
+			atleast[j] |= atleast[j - 1] & tmp
+		atleast[0] |= tmp
+	return atleast[minshared - 1]
+
+
 def allfragments(Ctrees trees, Vocabulary vocab,
 		unsigned int maxdepth, unsigned int maxfrontier=999, bint disc=True,
 		bint indices=False, start=None, end=None):
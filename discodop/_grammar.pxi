@@ -11,6 +11,10 @@ BITPAR_NONINT = re.compile(b'(?:^|\n)[0-9]+\\.[0-9]+[ \t]')
 LEXICON_NONINT = re.compile(b'[ \t][0-9]+[./][0-9]+[ \t\n]')
 # Detect rule format of bitpar
 BITPARRE = re.compile(rb'^[-.e0-9]+\b')
+# Minimum size in bytes of a rules file to parse it in parallel
+PARALLELPARSESIZE = 1 << 22
+# The rules text and parameters for worker processes parsing rules.
+cdef dict RULEPARSER = {}
 # Match syntactic category and function tag, without any state splits,
 # for labels that were not introduced by the binarization:
 # e.g., given NN-HD/Acc^name group 1 will be NN-HD/Acc
@@ -47,6 +51,13 @@ cdef class Grammar:
 		which will be used by default when parsing with this grammar
 	:param altweights: a dictionary or filename with numpy arrays of
 		alternative weights.
+	:param numproc: if not 1 and the rules file is large, parse the rules with
+		this number of processes (``None``: use all CPUs); the result is the
+		same.
+	:param precision: ``'float64'``, or to reduce the memory used by
+		alternative weights, ``'float32'`` or ``'uint16'``; cf.
+		:class:`discodop.grammar.QuantizedWeights`. The weights of the
+		selected model are rounded to this precision as well.
 
 	By default the grammar is in logprob mode;
 	invoke ``grammar.switch('default', logprob=False)`` to switch.
@@ -54,8 +65,12 @@ cdef class Grammar:
 	be normalized into relative frequencies; if the grammar contains any
 	non-integral weights, weights will be left unchanged."""
 	def __init__(self, rule_tuples_or_filename, lexiconfile=None, start='ROOT',
-			altweights=None, backtransform=None):
+			altweights=None, backtransform=None, precision='float64',
+			numproc=1):
+		if precision not in ('float64', 'float32', 'uint16'):
+			raise ValueError('unrecognized precision: %r' % precision)
 		self.start = start
+		self.precision = precision
 		self.numunary = self.numbinary = self.numrules = 0
 		self.maxfanout = 0
 		self.logprob = True
@@ -70,6 +85,8 @@ cdef class Grammar:
 		else:
 			self.models = {}
 			self.altweightsfile = None
+		if self.models and precision != 'float64':
+			self._quantizemodels()
 		self.backtransform = backtransform
 
 		rules = lexicon = None
@@ -109,7 +126,7 @@ cdef class Grammar:
 		self.freqmass.push_back(0)
 		self.fanout.push_back(0)
 		self.fanout.push_back(1)
-		self.addrules(rules, lexicon, init=True)
+		self.addrules(rules, lexicon, init=True, numproc=numproc)
 		del rules, lexicon
 
 	def tobinfile(self, filename):
@@ -178,12 +195,14 @@ cdef class Grammar:
 			buf.tofile(outfile)
 
 	@classmethod
-	def frombinfile(cls, filename, rulesfile, lexiconfile, backtransform=None):
+	def frombinfile(cls, filename, rulesfile, lexiconfile, backtransform=None,
+			precision='float64'):
 		"""Load grammar from cached binary file.
 
 		:param filename: file produced by tobinfile() method; format subject to
 			change, recreate as needed.
-		:param rulesfile: original grammar file, used only when pickling."""
+		:param rulesfile: original grammar file, used only when pickling.
+		:param precision: cf. :class:`Grammar`."""
 		cdef Grammar ob = Grammar.__new__(Grammar)
 		cdef bytes data
 		cdef char *ptr
@@ -202,6 +221,9 @@ cdef class Grammar:
 		ob.tolabel = StringList()
 		ob.numunary = ob.numbinary = 0
 		ob.maxfanout = 1
+		if precision not in ('float64', 'float32', 'uint16'):
+			raise ValueError('unrecognized precision: %r' % precision)
+		ob.precision = precision
 		ob.logprob = True
 		ob.bitpar = False
 		ob.models = {}
@@ -305,12 +327,15 @@ cdef class Grammar:
 			key.lhs, key.rhs1, key.rhs2 = cur.lhs, cur.rhs1, cur.rhs2
 			key.args, key.lengths = cur.args, cur.lengths
 			ob.rulenos[key] = cur.no
+		if precision != 'float64':
+			ob._roundweights(True)
+			ob._copyweights()
 
 		ob.tblabelmapping = pickle.loads(data[idx:])
 		return ob
 
 	def addrules(self, bytes rules, bytes lexicon, backtransform=None,
-			init=False):
+			init=False, numproc=1):
 		"""Update weights and add new rules."""
 		cdef int n
 		cdef int orignumrules = self.numrules
@@ -322,7 +347,7 @@ cdef class Grammar:
 			self._unary.pop_back()
 			self._lbinary.pop_back()
 			self._rbinary.pop_back()
-		self._convertrules(rules, backtransform)
+		self._convertrules(rules, backtransform, numproc)
 		self._convertlexicon(lexicon, checkdup=init)
 		self.nonterminals = self.toid.ob.size()
 
@@ -373,6 +398,10 @@ cdef class Grammar:
 		self.revrulemap.resize(self.numrules)
 		for n in range(self.numrules):
 			self.revrulemap[self._bylhs[n].no] = n
+		# switch() would return early since currentmodel is 'default'
+		if init and self.precision != 'float64':
+			self._roundweights(True)
+			self._copyweights()
 
 		if not init:  # updating of these weights not supported
 			self.models = {}
@@ -388,9 +417,27 @@ cdef class Grammar:
 			if match is not None:
 				self.tblabelmapping.setdefault(match.group(2), []).append(n)
 
-	def _convertrules(self, bytes rules, list backtransform=None):
+	def _convertrules(self, bytes rules, list backtransform=None,
+			numproc=1):
 		"""Count unary & binary rules; make a canonical list of all
 		non-terminal labels and assign them unique IDs."""
+		cdef ProbRule cur
+		if numproc != 1 and len(rules) >= PARALLELPARSESIZE:
+			self._convertrulechunks(rules, backtransform, numproc)
+		else:
+			self._convertrulelines(rules, backtransform)
+		self.numrules = self.numunary + self.numbinary
+		# sentinel rules
+		cur.lhs = cur.rhs1 = cur.rhs2 = cur.prob = cur.lengths = cur.args = 0
+		self._bylhs.push_back(cur)
+		self._unary.push_back(cur)
+		self._lbinary.push_back(cur)
+		self._rbinary.push_back(cur)
+		if not self.numrules:
+			raise ValueError('No rules found')
+
+	cdef _convertrulelines(self, bytes rules, list backtransform):
+		"""Parse and add rules sequentially."""
 		cdef uint32_t n = self.numrules, m
 		cdef uint32_t lineno = 0
 		cdef Prob w
@@ -555,15 +602,101 @@ cdef class Grammar:
 			self.freqmass[cur.lhs] += w
 			lineno += 1
 
-		self.numrules = self.numunary + self.numbinary
-		# sentinel rules
-		cur.lhs = cur.rhs1 = cur.rhs2 = cur.prob = cur.lengths = cur.args = 0
-		self._bylhs.push_back(cur)
-		self._unary.push_back(cur)
-		self._lbinary.push_back(cur)
-		self._rbinary.push_back(cur)
-		if not self.numrules:
-			raise ValueError('No rules found')
+	cdef _convertrulechunks(self, bytes rules, list backtransform, numproc):
+		"""Parse chunks of rules in parallel and add them in order.
+
+		The workers number labels by first occurrence in their chunk; these
+		are mapped to label IDs in the order of the chunks, so that labels
+		and rules are numbered exactly as by ``_convertrulelines()``."""
+		cdef uint32_t n = self.numrules, m, lineno = 0
+		cdef size_t a, idx, numlines
+		cdef vector[Label] ids
+		cdef const uint8_t *fanouts
+		cdef const uint32_t *data
+		cdef const Prob *weights
+		cdef Prob w
+		cdef ProbRule cur
+		cdef Rule key
+		cdef bytes label
+		cdef list labels
+		# split into chunks at line boundaries
+		chunksize = len(rules) // (
+				4 * (numproc or multiprocessing.cpu_count())) + 1
+		offsets = [0]
+		end = 0  # offsets[-1]; not available with wraparound=False
+		while end < len(rules):
+			pos = rules.find(b'\n', end + chunksize)
+			end = len(rules) if pos == -1 else pos + 1
+			offsets.append(end)
+		pool = multiprocessing.Pool(processes=numproc,
+				initializer=_initruleparser,
+				initargs=(rules, self.bitpar, self.start.encode('utf8')))
+		try:
+			for labels, fanoutdata, ruledata, weightdata in pool.imap(
+					_ruleparserworker, zip(offsets, offsets[1:])):
+				fanouts = <const uint8_t *><const char *>fanoutdata
+				data = <const uint32_t *><const char *>ruledata
+				weights = <const Prob *><const char *>weightdata
+				# map the labels of this chunk to global label IDs
+				ids.resize(len(labels) + 1)
+				ids[0] = 0
+				for a, label in enumerate(labels, 1):
+					it = self.toid.ob.find(label)
+					if it == self.toid.ob.end():
+						ids[a] = self.toid.ob[label] = self.tolabel.ob.size()
+						self.tolabel.ob.push_back(label)
+						self.freqmass.push_back(0)
+						self.fanout.push_back(fanouts[a - 1])
+						if fanouts[a - 1] > self.maxfanout:
+							self.maxfanout = fanouts[a - 1]
+					else:
+						ids[a] = dereference(it).second
+				numlines = len(weightdata) // sizeof(Prob)
+				for idx in range(numlines):
+					cur.lhs = ids[data[6 * idx]]
+					cur.rhs1 = ids[data[6 * idx + 1]]
+					cur.rhs2 = ids[data[6 * idx + 2]]
+					cur.args = data[6 * idx + 3]
+					cur.lengths = data[6 * idx + 4]
+					if self.fanout[cur.lhs] != data[6 * idx + 5]:
+						raise ValueError('conflicting fanouts for symbol %r.\n'
+								'previous: %d; this non-terminal: %d. '
+								'line: %d' % (
+								self.tolabel.ob[cur.lhs].decode('utf8'),
+								self.fanout[cur.lhs], data[6 * idx + 5],
+								lineno + 1))
+					w = weights[idx]
+					key.lhs, key.rhs1, key.rhs2 = cur.lhs, cur.rhs1, cur.rhs2
+					key.args, key.lengths = cur.args, cur.lengths
+					it1 = self.rulenos.find(key)
+					if it1 == self.rulenos.end():  # add new rule
+						self.rulenos[key] = n
+						cur.no = n
+						cur.prob = w
+						self.rulecounts.push_back(w)
+						self._bylhs.push_back(cur)
+						if (backtransform is not None
+								and lineno < len(backtransform)):
+							if len(self.backtransform) != n:
+								self.backtransform.extend(
+										[None] * (n - len(self.backtransform)))
+							self.backtransform.append(backtransform[lineno])
+						if cur.rhs2 == 0:
+							self.numunary += 1
+							self._unary.push_back(cur)
+						else:
+							self.numbinary += 1
+							self._lbinary.push_back(cur)
+							self._rbinary.push_back(cur)
+						n += 1
+					else:  # update weight of existing rule
+						m = dereference(it1).second
+						self.rulecounts[m] += w
+					self.freqmass[cur.lhs] += w
+					lineno += 1
+		finally:
+			pool.terminate()
+			pool.join()
 
 	def _convertlexicon(self, bytes lexicon, bint checkdup=True):
 		"""Make objects for lexical rules."""
@@ -728,26 +861,21 @@ cdef class Grammar:
 				for n in range(self.lexical.size()):
 					self.lexical[n].prob = (self.lexcounts[n]
 							/ self.freqmass[self.lexical[n].lhs])
-			# instead of copying weights from bylhs, could compute them
-			# again, but number of lookups is the same.
-			for n in range(self.numbinary):
-				self._lbinary[n].prob = self._bylhs[
-						self.revrulemap[self._lbinary[n].no]].prob
-			for n in range(self.numbinary):
-				self._rbinary[n].prob = self._bylhs[
-						self.revrulemap[self._rbinary[n].no]].prob
-			for n in range(self.numunary):
-				self._unary[n].prob = self._bylhs[
-						self.revrulemap[self._unary[n].no]].prob
+			if self.precision != 'float64':
+				self._roundweights(logprob)
+			self._copyweights()
 		else:
-			if self.models is None and self.altweightsfile:
-				self.models = np.load(self.altweightsfile)  # FIXME: keep open?
+			self._loadmodels()
 			model = self.models[name]
 			if len(model) != <signed>numweights:
 				raise ValueError('length mismatch: %d grammar rules, '
 						'%d weights given.' % (
 						self.numrules + self.lexical.size(), len(model)))
-			ob = np.abs(np.log(model)) if logprob else model
+			if self.precision != 'float64':
+				ob = np.abs(model.neglogprobs()) if logprob else np.asarray(
+						model)
+			else:
+				ob = np.abs(np.log(model)) if logprob else model
 			tmp = &(ob[0])
 			for n in range(self.numrules):
 				self._bylhs[n].prob = tmp[self._bylhs[n].no]
@@ -762,6 +890,54 @@ cdef class Grammar:
 		self.logprob = logprob
 		self.currentmodel = name
 
+	cdef _loadmodels(self):
+		"""Load the alternative weights from file, if necessary."""
+		if self.models is None and self.altweightsfile:
+			self.models = np.load(self.altweightsfile)  # FIXME: keep open?
+			if self.precision != 'float64':
+				self._quantizemodels()
+
+	cdef _quantizemodels(self):
+		"""Replace the alternative weights with quantized versions."""
+		from .grammar import QuantizedWeights
+		self.models = {name: weights if isinstance(weights, QuantizedWeights)
+				else QuantizedWeights(weights, self.precision)
+				for name, weights in self.models.items()}
+
+	cdef _roundweights(self, bint logprob):
+		"""Round the weights in ``_bylhs`` and ``lexical`` to our precision.
+
+		The other arrays with rules are updated by ``_copyweights()``."""
+		from .grammar import QuantizedWeights
+		cdef size_t n, numlexical = self.lexical.size()
+		cdef Prob [:] ob = clone(dblarray, self.numrules + numlexical, False)
+		for n in range(self.numrules):
+			ob[n] = self._bylhs[n].prob
+		for n in range(numlexical):
+			ob[self.numrules + n] = self.lexical[n].prob
+		weights = QuantizedWeights(
+				np.exp(np.negative(ob)) if logprob else ob, self.precision)
+		ob = np.abs(weights.neglogprobs()) if logprob else np.asarray(weights)
+		for n in range(self.numrules):
+			self._bylhs[n].prob = ob[n]
+		for n in range(numlexical):
+			self.lexical[n].prob = ob[self.numrules + n]
+
+	cdef _copyweights(self):
+		"""Copy the weights in ``_bylhs`` to the other arrays with rules."""
+		cdef int n
+		# instead of copying weights from bylhs, could compute them
+		# again, but number of lookups is the same.
+		for n in range(self.numbinary):
+			self._lbinary[n].prob = self._bylhs[
+					self.revrulemap[self._lbinary[n].no]].prob
+		for n in range(self.numbinary):
+			self._rbinary[n].prob = self._bylhs[
+					self.revrulemap[self._rbinary[n].no]].prob
+		for n in range(self.numunary):
+			self._unary[n].prob = self._bylhs[
+					self.revrulemap[self._unary[n].no]].prob
+
 	def setmask(self, seq):
 		"""Given a sequence of rule numbers, store a mask so that any phrasal
 		rules not in the sequence are deactivated. If sequence is None, the
@@ -775,6 +951,27 @@ cdef class Grammar:
 		for n in seq:
 			CLEARBIT(&(self.mask[0]), n)
 
+	def fingerprint(self):
+		"""Return a digest identifying the labels, rules, and frequencies.
+
+		The digest does not depend on the currently selected weights."""
+		cdef array buf = clone(chararray, self.numrules * sizeof(ProbRule)
+				+ self.lexical.size() * (sizeof(Label) + sizeof(Prob)), False)
+		cdef ProbRule *ruleptr = <ProbRule *>buf.data.as_chars
+		cdef char *ptr = &(buf.data.as_chars[self.numrules * sizeof(ProbRule)])
+		cdef size_t n
+		if self.numrules:
+			memcpy(ruleptr, &self._bylhs[0], self.numrules * sizeof(ProbRule))
+		for n in range(self.numrules):
+			ruleptr[n].prob = self.rulecounts[ruleptr[n].no]
+		for n in range(self.lexical.size()):
+			memcpy(ptr, &self.lexical[n].lhs, sizeof(Label))
+			memcpy(&ptr[sizeof(Label)], &self.lexcounts[n], sizeof(Prob))
+			ptr += sizeof(Label) + sizeof(Prob)
+		result = hashlib.sha1(b'\n'.join(self.tolabel.ob))
+		result.update(buf)
+		return result.digest()
+
 	def testgrammar(self, epsilon=1e-16):
 		"""Test whether all left-hand sides sum to 1 +/-epsilon for the
 		currently selected weights."""
@@ -793,7 +990,7 @@ cdef class Grammar:
 				tmp[self.numrules + n] = (self.lexcounts[n]
 						/ self.freqmass[self.lexical[n].lhs])
 		else:
-			tmp = self.models[self.currentmodel]
+			tmp = np.asarray(self.models[self.currentmodel], dtype=np.float64)
 		# We could be strict about separating POS tags and phrasal categories,
 		# but Negra contains at least one tag (--) used for both.
 		for n in range(self.numrules):
@@ -1054,7 +1251,8 @@ cdef class Grammar:
 	def __reduce__(self):
 		"""Helper function for pickling."""
 		return (Grammar, (self.rulesfile or self.ruletuples, self.lexiconfile,
-				self.start, self.altweightsfile or self.models))
+				self.start, self.altweightsfile or self.models, None,
+				self.precision))
 
 
 cdef inline Prob convertweight(const char *weight):
@@ -1088,3 +1286,151 @@ cdef inline const char *readfields(const char *buf, vector[string] &result):
 		tmp = strchr(buf, b'\t')
 	result.push_back(string(buf, endofline - buf))
 	return endofline + 1
+
+
+def _parserules(bytes rules, bint bitpar, bytes start):
+	"""Parse a chunk of rules, as ``Grammar._convertrulelines()``.
+
+	Labels are numbered from 1 in order of first occurrence in the chunk.
+
+	:returns: a tuple ``(labels, fanouts, ruledata, weights)``; ``fanouts``
+		contains for each label the fanout of its first occurrence;
+		``ruledata`` contains for each rule the labels lhs, rhs1, rhs2
+		(0 for unary rules), args, lengths and the fanout of the lhs;
+		``weights`` contains the weight of each rule."""
+	cdef sparse_hash_map[string, Label] toid
+	cdef list labels = []
+	cdef vector[uint8_t] fanouts
+	cdef vector[uint32_t] ruledata
+	cdef vector[Prob] weights
+	cdef Label lhs, rhs1, rhs2
+	cdef uint32_t args, lengths, m
+	cdef Prob w
+	cdef string yf = b'<none>'
+	cdef string weight
+	cdef string epsilon = b'Epsilon', root = start
+	cdef uint8_t fanout = 1, rhs1fanout = 1, rhs2fanout = 1
+	cdef const char *buf = <const char*>rules
+	cdef const char *prev
+	cdef vector[string] fields
+	cdef vector[string] rule
+	while True:
+		fields.clear()
+		prev = buf
+		buf = readfields(buf, fields)
+		if buf is NULL:
+			break
+		elif fields.size() == 0:
+			continue
+		if bitpar:
+			weight = fields[0]
+			fields.erase(fields.begin())
+			rule = fields
+			if rule.size() > 1:
+				args, lengths = 0b10, 0b10
+			else:
+				args, lengths = 0b0, 0b1
+		else:
+			weight = fields[fields.size() - 1]
+			yf = fields[fields.size() - 2]
+			fields.pop_back()
+			fields.pop_back()
+			rule = fields
+			lengths = args = m = 0
+			fanout = 1
+			rhs1fanout = rhs2fanout = 0
+			for a in yf:
+				if a == b',':
+					lengths |= 1 << (m - 1)
+					fanout += 1
+					continue
+				elif a == b'0':
+					rhs1fanout += 1
+				elif a == b'1':
+					args += 1 << m
+					rhs2fanout += 1
+				else:
+					raise ValueError('invalid symbol in yield function: %r'
+							' (not in set [01,])\n%r' % (
+							a, prev[:buf - prev].decode('utf8')))
+				m += 1
+			lengths |= 1 << (m - 1)
+			if m >= (8 * sizeof(args)):
+				raise ValueError(
+						'Parsing complexity (%d) too high (max %d).\n'
+						'Rule: %r' % (m, (8 * sizeof(args)),
+						prev[:buf - prev].decode('utf8')))
+			if rule.size() == 2:
+				if rhs1fanout == 0 or rhs2fanout != 0:
+					raise ValueError('expected unary yield function: '
+							'%r\t%r' % (yf, rule))
+			elif rule.size() == 3:
+				if rhs1fanout == 0 or rhs2fanout == 0:
+					raise ValueError('expected binary yield function: '
+							'%r\t%r' % (yf, rule))
+		if rule.size() < 2:
+			raise ValueError('Not enough nonterminals:\n%r'
+					% prev[:buf - prev].decode('utf8'))
+		elif rule.size() > 3:
+			raise ValueError('Grammar not binarized:\n%r\n%r'
+					% (list(rule), prev[:buf - prev].decode('utf8')))
+		elif rule[0] == epsilon or rule[1] == epsilon or (
+				rule.size() == 3 and rule[2] == epsilon):
+			raise ValueError('Epsilon symbol may only occur '
+					'in RHS of lexical rules:\n%r' %
+					prev[:buf - prev].decode('utf8'))
+		elif rule[1] == root or (rule.size() == 3 and rule[2] == root):
+			raise ValueError('Start symbol should only occur on LHS:\n%r'
+					% prev[:buf - prev].decode('utf8'))
+		w = convertweight(weight.c_str())
+		if w <= 0:
+			raise ValueError('Expected positive non-zero weight\n%r'
+					% prev[:buf - prev].decode('utf8'))
+		it = toid.find(rule[0])
+		if it == toid.end():
+			lhs = toid[rule[0]] = len(labels) + 1
+			labels.append(rule[0])
+			fanouts.push_back(fanout)
+		else:
+			lhs = dereference(it).second
+		it = toid.find(rule[1])
+		if it == toid.end():
+			rhs1 = toid[rule[1]] = len(labels) + 1
+			labels.append(rule[1])
+			fanouts.push_back(rhs1fanout)
+		else:
+			rhs1 = dereference(it).second
+		rhs2 = 0
+		if rule.size() == 3:
+			it = toid.find(rule[2])
+			if it == toid.end():
+				rhs2 = toid[rule[2]] = len(labels) + 1
+				labels.append(rule[2])
+				fanouts.push_back(rhs2fanout)
+			else:
+				rhs2 = dereference(it).second
+		ruledata.push_back(lhs)
+		ruledata.push_back(rhs1)
+		ruledata.push_back(rhs2)
+		ruledata.push_back(args)
+		ruledata.push_back(lengths)
+		ruledata.push_back(fanout)
+		weights.push_back(w)
+	return (labels,
+			(<char *>fanouts.data())[:fanouts.size()],
+			(<char *>ruledata.data())[:ruledata.size() * sizeof(uint32_t)],
+			(<char *>weights.data())[:weights.size() * sizeof(Prob)])
+
+
+def _initruleparser(bytes rules, bint bitpar, bytes start):
+	"""Set the rules text for the worker processes of ``_parserules()``."""
+	RULEPARSER['rules'] = rules
+	RULEPARSER['bitpar'] = bitpar
+	RULEPARSER['start'] = start
+
+
+def _ruleparserworker(tuple span):
+	"""Parse the rules on the lines in the byte range ``span``."""
+	cdef bytes rules = RULEPARSER['rules']
+	return _parserules(rules[span[0]:span[1]], RULEPARSER['bitpar'],
+			RULEPARSER['start'])
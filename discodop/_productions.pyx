@@ -0,0 +1,477 @@
+"""Compiled extraction of LCFRS productions from trees and fragments.
+
+Productions are read off with integer IDs for labels and words, and counted
+in a table indexed by rule ID; :func:`discodop.grammar.lcfrsproductions` is a
+wrapper returning productions as tuples of strings. Fragments are flattened
+into binarized productions for :func:`discodop.grammar.flatten`."""
+
+from __future__ import print_function
+import re
+from .tree import Tree, escape
+
+cimport cython
+from libc.stdint cimport uint32_t, uint64_t
+from libcpp.vector cimport vector
+
+# a frontier node (NP 0= 2=) or a terminal node (NN 1=word) in a fragment
+FRONTIERORTERM = re.compile(r"\(([^ ]+) (([0-9]+)=([^ ()]*)(?: [0-9]+=)*)\)")
+
+
+@cython.final
+cdef class ProductionCounter:
+	"""Count LCFRS productions of trees.
+
+	Labels and words are mapped to integer IDs; productions are identified by
+	rule IDs assigned in order of first occurrence.
+
+	:param frontiers: if ``True``, frontier nodes generate empty productions;
+		by default they are ignored.
+
+	>>> from discodop.tree import Tree
+	>>> counter = ProductionCounter()
+	>>> counter.add(Tree('(S (NP 0) (VP 1))'), ['Mary', 'walks'])
+	>>> counter.add(Tree('(S (NP 0) (VP 1))'), ['John', 'walks'])
+	>>> for rule, cnt in counter.items():
+	...		print(rule, cnt)
+	(('S', 'NP', 'VP'), ((0, 1),)) 2
+	(('NP', 'Epsilon'), ('Mary',)) 1
+	(('VP', 'Epsilon'), ('walks',)) 2
+	(('NP', 'Epsilon'), ('John',)) 1"""
+	cdef readonly dict labelids  # label => label ID; Epsilon has ID 0
+	cdef readonly dict wordids  # escaped word => word ID
+	cdef readonly list labels  # label ID => label
+	cdef readonly list words  # word ID => escaped word
+	cdef dict ruleids  # tuple of label, word IDs and yield function => ID
+	cdef list rules  # rule ID => production as tuple of strings
+	cdef vector[uint64_t] counts  # rule ID => count
+	cdef vector[int] owner  # sentence index => child number, or -1
+	cdef bint frontiers
+
+	def __init__(self, frontiers=False):
+		self.labelids = {'Epsilon': 0}
+		self.labels = ['Epsilon']
+		self.wordids = {}
+		self.words = []
+		self.ruleids = {}
+		self.rules = []
+		self.frontiers = frontiers
+
+	def add(self, tree, sent):
+		"""Count the productions of a tree with indices and its sentence."""
+		cdef vector[uint32_t] result
+		cdef uint32_t ruleid
+		self._extract(tree, sent, result)
+		for ruleid in result:
+			self.counts[ruleid] += 1
+
+	def productions(self, tree, sent):
+		"""Return the productions of a tree without counting them.
+
+		:returns: a list of productions ``((lhs, rhs1, ...), yf)`` in
+			pre-order, as returned by
+			:func:`discodop.grammar.lcfrsproductions`."""
+		cdef vector[uint32_t] result
+		cdef uint32_t ruleid
+		self._extract(tree, sent, result)
+		return [self.rules[ruleid] for ruleid in result]
+
+	def rule(self, uint32_t ruleid):
+		"""Return the production with the given rule ID."""
+		return self.rules[ruleid]
+
+	def count(self, uint32_t ruleid):
+		"""Return the count of the production with the given rule ID."""
+		return self.counts.at(ruleid)
+
+	def getcounts(self):
+		"""Return the table of counts, indexed by rule ID."""
+		return list(self.counts)
+
+	def items(self):
+		"""Yield tuples ``(production, count)`` in order of first occurrence.
+
+		Productions of which only the ``productions()`` method was called are
+		skipped."""
+		cdef uint32_t n
+		for n in range(self.counts.size()):
+			if self.counts[n]:
+				yield self.rules[n], self.counts[n]
+
+	def __len__(self):
+		return len(self.rules)
+
+	cdef int _extract(self, tree, sent, vector[uint32_t]& result) except -1:
+		"""Collect rule IDs of the productions of tree in pre-order."""
+		cdef int n, idx, previdx, prevchild, lo, hi
+		cdef list agenda, yf, component, children
+		if not self._checkleaves(tree, sent):
+			checkleaves(tree, sent)
+		self.owner.assign(len(sent), -1)
+		agenda = [tree]
+		while agenda:
+			node = agenda.pop()
+			children = node.children
+			if not children:
+				raise ValueError(("Empty node. Frontier nodes should "
+					"designate which part(s) of the sentence they contribute "
+					"to.\ntree:%s\nindices: %r\nsent: %r" % (
+					tree.pprint(), tree.leaves(), sent)))
+			elif isinstance(children[0], int):
+				idx = children[0]
+				if len(children) == 1 and sent[idx] is not None:
+					result.push_back(self._lexruleid(node.label, sent[idx]))
+				elif self.frontiers:
+					result.push_back(self._ruleid(
+							(self._labelid(node.label), ), ()))
+				# a frontier may have children besides indices, e.g.,
+				# (X 0 (X|<> 2 (X|<> 4))) produced by handledisc()
+				agenda.extend([child for child in children[::-1]
+						if isinstance(child, Tree)])
+				continue
+			for child in children:
+				if not isinstance(child, Tree):
+					raise ValueError("Neither Tree node nor integer index:\n"
+						"%r, %r" % (children[0], type(children[0])))
+			# mark sentence indices with the child dominating them
+			lo, hi = len(sent), -1
+			for n, child in enumerate(children):
+				self._markleaves(child, n, &lo, &hi)
+			yf, component = [], []
+			previdx = prevchild = -2
+			for idx in range(lo, hi + 1):
+				n = self.owner[idx]
+				if n == -1:
+					continue
+				elif idx != previdx + 1:  # a discontinuity
+					if component:
+						yf.append(tuple(component))
+					component = [n]
+				elif n != prevchild:  # switch to a different non-terminal
+					component.append(n)
+				# otherwise terminal is part of current range
+				previdx, prevchild = idx, n
+				self.owner[idx] = -1
+			yf.append(tuple(component))
+			result.push_back(self._ruleid(
+					(self._labelid(node.label), ) + tuple([
+						self._labelid(child.label) for child in children]),
+					tuple(yf)))
+			agenda.extend(children[::-1])
+		return 0
+
+	cdef bint _checkleaves(self, tree, sent) except -1:
+		"""Cheaply check that leaves are unique indices into sent."""
+		if not sent:
+			return False
+		self.owner.assign(len(sent), -1)
+		return self._checkleaves1(tree, len(sent))
+
+	cdef bint _checkleaves1(self, node, int sentlen) except -1:
+		cdef int idx
+		for child in node.children:
+			if isinstance(child, Tree):
+				if not self._checkleaves1(child, sentlen):
+					return False
+			elif not isinstance(child, int):
+				return False
+			else:
+				if child < 0 or child >= sentlen:
+					return False
+				idx = child
+				if self.owner[idx] != -1:
+					return False
+				self.owner[idx] = 0
+		return True
+
+	cdef int _markleaves(self, node, int n, int *lo, int *hi) except -1:
+		"""Mark the sentence indices dominated by node as child n."""
+		cdef int idx
+		for child in node.children:
+			if isinstance(child, Tree):
+				self._markleaves(child, n, lo, hi)
+			else:
+				idx = child
+				self.owner[idx] = n
+				if idx < lo[0]:
+					lo[0] = idx
+				if idx > hi[0]:
+					hi[0] = idx
+		return 0
+
+	cdef uint32_t _labelid(self, label) except? 0:
+		labelid = self.labelids.get(label)
+		if labelid is None:
+			labelid = self.labelids[label] = len(self.labels)
+			self.labels.append(label)
+		return labelid
+
+	cdef uint32_t _lexruleid(self, label, word) except? 0:
+		word = escape(word)
+		wordid = self.wordids.get(word)
+		if wordid is None:
+			wordid = self.wordids[word] = len(self.words)
+			self.words.append(word)
+		key = (self._labelid(label), wordid)
+		ruleid = self.ruleids.get(key)
+		if ruleid is None:
+			ruleid = self._newrule(key, ((label, 'Epsilon'), (word, )))
+		return ruleid
+
+	cdef uint32_t _ruleid(self, tuple labelids, tuple yf) except? 0:
+		key = (labelids, yf)
+		ruleid = self.ruleids.get(key)
+		if ruleid is None:
+			ruleid = self._newrule(key, (tuple([self.labels[a]
+					for a in labelids]), yf))
+		return ruleid
+
+	cdef uint32_t _newrule(self, key, tuple rule) except? 0:
+		cdef uint32_t ruleid = len(self.rules)
+		self.ruleids[key] = ruleid
+		self.rules.append(rule)
+		self.counts.push_back(0)
+		return ruleid
+
+
+def flattentemplate(str frag):
+	"""Flatten a fragment without assigning IDs to binarization nodes.
+
+	Works as :func:`discodop.grammar.flatten`, but leaves out the IDs of the
+	nodes introduced by the binarization.
+
+	The IDs can be assigned afterwards in the order of the fragments, which
+	makes the result independent of how the fragments are divided among
+	processes.
+
+	:returns: a tuple ``(prods, template, root, keys, suffixes)``, where the
+		binarization labels in ``prods`` are integer indices ``n``; their ID
+		is ``ids[keys[n]]``, or a new ID ``next(ids)`` if ``keys[n]`` is
+		``None``, and their label is ``root + '}<' + ID + '>' + suffixes[n]``.
+
+	>>> frag = '(S (NP 0=) (VP (VB 1=is) (ADJP 2= 4=) (PP 3=)))'
+	>>> prods, template, root, keys, suffixes = flattentemplate(frag)
+	>>> for prod in prods:
+	...		print(prod)
+	(('S', 1, 'PP'), ((0, 1, 0),))
+	((1, 0, 'ADJP'), ((0, 1), (1,)))
+	((0, 'NP', 'VB@is'), ((0, 1),))
+	(('VB@is', 'Epsilon'), ('is',))
+	>>> print(template, keys, suffixes)
+	(S {0} (VP {1} {2} {3})) ['NP,VB@is;01', None] ['', '_2']"""
+	cdef vector[int] owner
+	cdef int n, k, idx, maxidx = 0
+	cdef list matches = list(FRONTIERORTERM.finditer(frag))
+	cdef list groups, leafindices, order, labels = [], words = []
+	cdef list indices = [], rank, template
+	cdef Py_ssize_t start, end
+	cdef list keys = [], suffixes = [], prods
+	root = frag[1:frag.index(' ')]
+	k = len(matches)
+	if k == 0:
+		raise ValueError('fragment without frontier or terminal nodes: %r'
+				% frag)
+	if frag.count(' ') == 1:
+		label, _, _, word = matches[0].groups()
+		return ([((label, 'Epsilon'), (escape(word), ))] if word else [],
+				'%s 0)' % frag[:frag.index(' ')], root, keys, suffixes)
+	groups = [match.groups() for match in matches]
+	leafindices = [_leafindices(a[1]) for a in groups]
+	# sort frontiers and terminals by their first index
+	order = sorted(range(k), key=[a[0] for a in leafindices].__getitem__)
+	for n in order:
+		label, leaves, _, word = groups[n]
+		labels.append(label + '@' + word if word else label)
+		words.append(word if ' ' not in leaves else '')
+		indices.append(leafindices[n])
+		for idx in leafindices[n]:
+			if idx > maxidx:
+				maxidx = idx
+	owner.assign(maxidx + 1, -1)
+	for n in range(k):
+		for idx in indices[n]:
+			owner[idx] = n
+	if k <= 2:
+		# normally, rules of fragments are disambiguated by binarization
+		# IDs. In case there's a fragment with only one or two frontier
+		# nodes, we add an artificial node.
+		yf = _yf(owner, k - 1, 1)
+		keys.append(None)
+		suffixes.append('' if len(yf) == 1 else '_%d' % len(yf))
+		prods = [((root, 0) + tuple(labels[1:]), yf),
+				((0, labels[0]), tuple([(0, ) for component in yf
+					for a in component if a == 0]))]
+	else:
+		# left-factored binarization; node n covers children 0 to n + 1.
+		for n in range(1, k - 1):
+			keys.append(','.join(labels[:n + 1]) + _getyf(owner, n)
+					if n < k - 2 else None)
+			fanout = _fanout(owner, n)
+			suffixes.append('_%d' % fanout if fanout > 1 else '')
+		prods = [((root, k - 3, labels[k - 1]), _yf(owner, k - 1, k - 1))]
+		for n in range(k - 2, 0, -1):
+			prods.append(((n - 1, n - 2 if n > 1 else labels[0], labels[n]),
+					_yf(owner, n, n)))
+	for n in range(k):
+		if words[n]:
+			prods.append(((labels[n], 'Epsilon'), (escape(words[n]), )))
+	# mark substitution sites
+	rank = [None] * k
+	for n in range(k):
+		rank[order[n]] = '{%d}' % n
+	template = []
+	idx = 0
+	for n, match in enumerate(matches):
+		start, end = match.span()
+		template.append(frag[idx:start])
+		template.append(rank[n])
+		idx = end
+	template.append(frag[idx:])
+	return prods, ''.join(template), root, keys, suffixes
+
+
+def assignids(tuple template, ids):
+	"""Assign IDs to the binarization labels of a flattened fragment.
+
+	:param template: a tuple as returned by :func:`flattentemplate`.
+	:param ids: a :class:`discodop.grammar.UniqueIDs` object; IDs are
+		assigned in the same order as :func:`discodop.grammar.flatten`.
+	:returns: a tuple ``(prods, template)``."""
+	cdef list prods, keys, suffixes, labels, result
+	cdef str root
+	prods, newfrag, root, keys, suffixes = template
+	if not keys:
+		return prods, newfrag
+	labels = ['%s}<%s>%s' % (root, next(ids) if key is None else ids[key],
+			suffix) for key, suffix in zip(keys, suffixes)]
+	result = []
+	for nts, yf in prods:
+		if nts[1] != 'Epsilon':
+			nts = tuple([labels[a] if isinstance(a, int) else a
+					for a in nts])
+		result.append((nts, yf))
+	return result, newfrag
+
+
+cdef list _leafindices(str leaves):
+	"""Parse the indices of a frontier or terminal, e.g. ``'0= 2='``."""
+	cdef list result = []
+	cdef int idx = 0
+	cdef bint inidx = True
+	cdef Py_UCS4 char
+	for char in leaves:
+		if inidx:
+			if char == u'=':
+				result.append(idx)
+				inidx = False
+			else:
+				idx = 10 * idx + <int>char - ord('0')
+		elif char == u' ':
+			idx = 0
+			inidx = True
+	return result
+
+
+cdef tuple _yf(vector[int]& owner, int last, int split):
+	"""Yield function of a node that covers the leaves of children.
+
+	The node covers children ``0..last``; those before ``split`` form its
+	first non-terminal."""
+	cdef int idx, child, prevchild = -1, previdx = -2
+	cdef list yf = [], component = []
+	for idx in range(owner.size()):
+		if owner[idx] == -1 or owner[idx] > last:
+			continue
+		child = owner[idx] >= split
+		if idx != previdx + 1:  # a discontinuity
+			if component:
+				yf.append(tuple(component))
+			component = [child]
+		elif child != prevchild:
+			component.append(child)
+		previdx, prevchild = idx, child
+	yf.append(tuple(component))
+	return tuple(yf)
+
+
+cdef str _getyf(vector[int]& owner, int n):
+	"""Yield function key of binarization node for children ``0..n``; cf.
+	:func:`discodop.treetransforms.getyf`."""
+	cdef int idx, bits = 0
+	cdef list result = [';']
+	cur = ','
+	for idx in range(owner.size()):
+		if owner[idx] != -1 and owner[idx] <= n:
+			bits = idx + 1
+	for idx in range(bits):
+		if owner[idx] != -1 and owner[idx] < n:
+			if cur != '0':
+				cur = '0'
+				result.append(cur)
+		elif owner[idx] == n:
+			if cur != '1':
+				cur = '1'
+				result.append(cur)
+		elif cur != ',':
+			cur = ','
+			result.append(cur)
+	return ''.join(result)
+
+
+cdef int _fanout(vector[int]& owner, int n):
+	"""Number of contiguous ranges covered by the children ``0..n``."""
+	cdef int idx, result = 0
+	cdef bint prev = False, cur
+	for idx in range(owner.size()):
+		cur = owner[idx] != -1 and owner[idx] <= n
+		if cur and not prev:
+			result += 1
+		prev = cur
+	return result
+
+
+def checkleaves(tree, sent):
+	"""Check that the leaves of a tree are indices of the words in sent.
+
+	:raises ValueError: unless the leaves of tree are unique integer indices
+		pointing to a word in sent."""
+	leaves = tree.leaves()
+	if len(set(leaves)) != len(leaves):
+		raise ValueError('indices should be unique. indices: %r\ntree: %s'
+				% (leaves, tree))
+	if not sent:
+		raise ValueError('no sentence.\ntree: %s\nindices: %r\nsent: %r'
+				% (tree.pprint(), leaves, sent))
+	if not all(isinstance(a, int) for a in leaves):
+		raise ValueError('indices should be integers.\ntree: %s\nindices: %r\n'
+				'sent: %r' % (tree.pprint(), leaves, sent))
+	if not all(0 <= a < len(sent) for a in leaves):
+		raise ValueError('indices should point to a word in the sentence.\n'
+			'tree: %s\nindices: %r\nsent: %r' % (tree.pprint(), leaves, sent))
+
+
+def test():
+	from collections import Counter
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import binarize, addfanoutmarkers
+	from discodop.grammar import lcfrsproductions
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in list(corpus.trees().values())]
+	counter = ProductionCounter()
+	expected = Counter()
+	for tree, sent in zip(trees, sents):
+		counter.add(tree, sent)
+		expected.update(lcfrsproductions(tree, sent))
+	assert list(counter.items()) == list(expected.items())
+	assert sum(counter.getcounts()) == sum(expected.values())
+	# a frontier with both indices and a subtree yields one production each
+	tree = Tree('(S (X 0 (X|<> 2 (X|<> 4))) (Y 1) (Z 3))')
+	prods = lcfrsproductions(tree, ['a', None, 'c', 'd', None],
+			frontiers=True)
+	assert len(prods) == len(list(tree.subtrees())), prods
+	print('distinct productions: %d, labels: %d, words: %d' % (
+			len(counter), len(counter.labels), len(counter.words)))
+
+
+__all__ = ['ProductionCounter', 'flattentemplate', 'assignids', 'checkleaves']
@@ -14,6 +14,8 @@ COMMANDS = {
 		'parser': 'Simple command line parser.',
 		'demos': 'Show some demonstrations of formalisms encoded in LCFRS.',
 		'gen': 'Generate sentences from a PLCFRS.',
+		'tune': 'Tune coarse-to-fine pruning parameters on a dev set.',
+		'estimates': 'Compute outside estimates for a trained model.',
 	}
 
 
@@ -198,6 +200,97 @@ overwritten."""
 			out.writelines(paramlines)
 
 
+def estimates():
+	"""Usage: discodop estimates <grammar/> [--maxlen=n] [--numproc=n]
+
+Compute the outside estimates for the stages of a model produced by
+``discodop runexp`` which specify the ``estimates`` parameter. Estimates
+already present are kept. --maxlen defaults to the maximum sentence length
+of the test corpus; --numproc=0 uses all CPUs."""
+	import os
+	import logging
+	from getopt import gnu_getopt, GetoptError
+	from multiprocessing import cpu_count
+	import numpy as np
+	from .containers import Grammar
+	from .parser import readparam
+	from .util import findfile
+	from .estimates import getpcfgestimates, SXlrgapsEstimates
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	try:
+		opts, args = gnu_getopt(argv[2:], 'h', ('maxlen=', 'numproc='))
+		if len(args) != 1:
+			raise ValueError('expected 1 argument: grammar directory')
+	except (GetoptError, ValueError) as err:
+		print('error: %r' % err, file=stderr)
+		print(estimates.__doc__)
+		sysexit(2)
+	opts = dict(opts)
+	directory = args[0]
+	prm = readparam(os.path.join(directory, 'params.prm'))
+	maxlen = int(opts.get('--maxlen', prm.testcorpus.maxwords))
+	numproc = int(opts.get('--numproc', 1)) or cpu_count()
+	top = getattr(prm, 'top', 'ROOT')
+	for stage in prm.stages:
+		if stage.estimates not in ('SX', 'SXlrgaps'):
+			continue
+		# DOP stages use estimates for the labels of the coarse stage
+		name = stage.prune if stage.dop else stage.name
+		probsfile = '%s/%s.probs.npz' % (directory, name)
+		gram = Grammar(findfile('%s/%s.rules' % (directory, name)),
+				findfile('%s/%s.lex' % (directory, name)), start=top,
+				altweights=probsfile if os.path.exists(probsfile) else None,
+				numproc=numproc)
+		filename = '%s/%s.outside.npy' % (directory, stage.name)
+		logging.info('computing %s estimates for %s', stage.estimates,
+				stage.name)
+		if stage.estimates == 'SX':
+			np.save(filename, getpcfgestimates(gram, maxlen, top))
+		else:
+			if (os.path.exists(filename) and SXlrgapsEstimates.fromfile(
+					filename, gram).maxlen != maxlen):
+				os.remove(filename)
+			SXlrgapsEstimates(gram, maxlen, filename).computeall(numproc)
+		logging.info('wrote %s', filename)
+
+
+def _evalgrammar(directory, devset, fmt=None, encoding=None):
+	"""Parse and evaluate a development set with the grammars in a directory.
+
+	The directory should be produced by ``discodop runexp``.
+
+	:returns: a tuple with the cpu time spent parsing, and the scores of the
+		last stage."""
+	import os
+	from time import process_time
+	from . import eval as evalmod
+	from .treebank import READERS
+	from .parser import Parser, readparam, readgrammars
+	prm = readparam(os.path.join(directory, 'params.prm'))
+	prm.update(resultdir=directory, verbosity=0)
+	readgrammars(directory, prm.stages, prm.postagging, prm.transformations,
+			top=getattr(prm, 'top', 'ROOT'))
+	theparser = Parser(prm)
+	corpus = READERS[fmt or prm.corpusfmt](devset,
+			encoding=encoding or prm.testcorpus.encoding,
+			headrules=prm.binarization.headrules,
+			removeempty=prm.removeempty, morphology=prm.morphology,
+			functions=prm.functions, ensureroot=prm.ensureroot)
+	usetags = not prm.postagging or prm.postagging.method != 'unknownword'
+	evalparam = evalmod.readparam(prm.evalparam)
+	evalparam['DEBUG'] = -1
+	evaluator = evalmod.Evaluator(evalparam)
+	elapsed = 0
+	for n, item in corpus.itertrees():
+		tags = [tag for _, tag in sorted(item.tree.pos())] if usetags else None
+		begin = process_time()
+		result = list(theparser.parse(item.sent, tags=tags))[-1]
+		elapsed += process_time() - begin
+		evaluator.add(n, item.tree.copy(True), item.sent,
+				result.parsetree.copy(True), item.sent)
+	return elapsed, evaluator.acc.scores()
+
+
 def treetransforms():
 	"""Treebank binarization and conversion.
 Usage: discodop treetransforms [input [output]] [options]
@@ -377,9 +470,10 @@ def grammar():
 	"""Read off grammars from treebanks.
 Usage: discodop grammar <type> <input> <output> [options]
 or: discodop grammar param <parameter-file> <output-directory>
-or: discodop grammar info <rules-file>
+or: discodop grammar info <rules-file|probs-file>
 or: discodop grammar merge (rules|lexicon|fragments) \
-<input1> <input2>... <output>"""
+<input1> <input2>... <output>
+or: discodop grammar compact <grammar/> <output/> [options]"""
 	import io
 	import os
 	import codecs
@@ -393,14 +487,15 @@ or: discodop grammar merge (rules|lexicon|fragments) \
 	from .grammar import (treebankgrammar, dopreduction, doubledop, dop1,
 			compiletsg, writegrammar, grammarinfo, grammarstats,
 			splitweight, merge, sumfrags, sumrules, sumlex, stripweight,
-			addindices)
+			addindices, quantizationreport, compactgrammar)
 	from .parser import readparam
 	from .runexp import (loadtraincorpus, getposmodel, dobinarization,
 			getgrammars)
 	logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 	shortoptions = 'hs:'
 	options = ('help', 'gzip', 'packed', 'inputfmt=', 'inputenc=',
-			'dopestimator=', 'maxdepth=', 'maxfrontier=', 'numproc=')
+			'dopestimator=', 'maxdepth=', 'maxfrontier=', 'numproc=',
+			'stages=', 'mincount=', 'minprob=', 'minfragfreq=', 'devset=')
 	try:
 		opts, args = gnu_getopt(argv[2:], shortoptions, options)
 		model = args[0]
@@ -415,13 +510,17 @@ or: discodop grammar merge (rules|lexicon|fragments) \
 		sysexit(2)
 	opts = dict(opts)
 	if model not in ('pcfg', 'plcfrs', 'dopreduction', 'doubledop', 'dop1',
-			'ptsg', 'param', 'info', 'merge'):
+			'ptsg', 'param', 'info', 'merge', 'compact'):
 		raise ValueError('unrecognized model: %r' % model)
 	if opts.get('dopestimator', 'rfe') not in ('rfe', 'ewe', 'shortest'):
 		raise ValueError('unrecognized estimator: %r' % opts['dopestimator'])
 
 	if model == 'info':
-		grammarstats(args[1])
+		if args[1].endswith('.npz'):
+			import numpy as np
+			print(quantizationreport(np.load(args[1])))
+		else:
+			grammarstats(args[1])
 		return
 	elif model == 'merge':
 		if len(args) < 5:
@@ -433,6 +532,49 @@ or: discodop grammar merge (rules|lexicon|fragments) \
 		elif args[1] == 'fragments':
 			merge(args[2:-1], args[-1], sumfrags, lambda x: x.rsplit('\t', 1)[0])
 		return
+	elif model == 'compact':
+		import shutil
+		directory, newdirectory = args[1], args[2]
+		prm = readparam(os.path.join(directory, 'params.prm'))
+		top = getattr(prm, 'top', 'ROOT')
+		names = (opts['--stages'].split(',') if '--stages' in opts
+				else [stage.name for stage in prm.stages
+					if stage.dop in ('doubledop', 'dop1', 'reduction')])
+		# outside estimates for these stages are computed with the grammar
+		# of a compacted stage
+		stale = {stage.name for stage in prm.stages if stage.estimates
+				and (stage.prune if stage.dop else stage.name) in names}
+		if os.path.exists(newdirectory):
+			raise ValueError('Directory %r already exists.\n' % newdirectory)
+		os.mkdir(newdirectory)
+		for filename in sorted(os.listdir(directory)):
+			name, _, ext = filename.partition('.')
+			if (name in names and ext in ('rules.gz', 'lex.gz', 'probs.npz',
+					'backtransform.gz', 'fragments.gz', 'g')
+					or name in stale and ext == 'outside.npy'
+					or not os.path.isfile(os.path.join(directory, filename))):
+				continue
+			shutil.copy2(os.path.join(directory, filename), newdirectory)
+		for name in names:
+			before, after = compactgrammar(
+					os.path.join(directory, name),
+					os.path.join(newdirectory, name), start=top,
+					mincount=float(opts.get('--mincount', 0)),
+					minprob=float(opts.get('--minprob', 0)),
+					minfragfreq=float(opts.get('--minfragfreq', 0)))
+			logging.info('%s: %d rules; after pruning: %d (%.1f %%)',
+					name, before, after, 100.0 * after / before)
+		if stale:
+			logging.info('outside estimates removed for stages %s; use '
+					'"discodop estimates %s" to recompute them.',
+					', '.join(sorted(stale)), newdirectory)
+		if '--devset' in opts:
+			for path in (directory, newdirectory):
+				elapsed, scores = _evalgrammar(path, opts['--devset'],
+						opts.get('--inputfmt'), opts.get('--inputenc'))
+				logging.info('%s: %.2fs cpu time; lf %s; ex %s', path,
+						elapsed, scores['lf'], scores['ex'])
+		return
 	elif model == 'param':
 		if opts:
 			raise ValueError('all options should be set in parameter file.')
@@ -470,10 +612,12 @@ or: discodop grammar merge (rules|lexicon|fragments) \
 
 	# read off grammar
 	if model in ('pcfg', 'plcfrs'):
-		xgrammar = treebankgrammar(trees, sents)
+		xgrammar = treebankgrammar(trees, sents,
+				numproc=int(opts.get('--numproc', 1)))
 	elif model == 'dopreduction':
 		xgrammar, altweights = dopreduction(trees, sents,
-				packedgraph='--packed' in opts)
+				packedgraph='--packed' in opts,
+				numproc=int(opts.get('--numproc', 1)))
 	elif model == 'doubledop':
 		xgrammar, backtransform, altweights, _ = doubledop(trees, sents,
 				numproc=int(opts.get('--numproc', 1)))
@@ -241,6 +241,17 @@ cdef extern from "_containers.h" nogil:
 		void setitem(K k, V v)
 		void setifbetter(K k, V v)
 		item_type pop()
+	cdef cppclass BucketAgenda[K, V]:
+		ctypedef pair[K, V] item_type
+		BucketAgenda()
+		void reserve(size_t n)
+		void setwidth(double w)
+		size_t size()
+		bint empty()
+		bint member(K k)
+		void setitem(K k, V v)
+		void setifbetter(K k, V v)
+		item_type pop()
 	cdef cppclass SmallChartItemAgenda[V]:
 		ctypedef pair[SmallChartItem, V] item_type
 		ctypedef pair[item_type, uint32_t] entry_type
@@ -542,15 +553,20 @@ cdef class Grammar:
 	cdef sparse_hash_map[string, vector[uint32_t]] lexicalbyword
 	cdef sparse_hash_set[uint32_t] lexicallhs
 	cdef readonly list backtransform
+	# backtransform templates as [str, int, str, ..., int, str]; cf. format()
+	cdef readonly list templates
 	cdef vector[uint64_t] mask
 	cdef vector[uint8_t] fanout
 	cdef StringList tolabel
-	cdef StringIntDict toid
+	cdef readonly StringIntDict toid
 	cdef vector[uint32_t] revrulemap
 	cdef vector[Label] mapping
 	cdef vector[Label] selfmapping
 	cdef vector[vector[Label]] splitmapping
 	cdef vector[vector[Label]] revmap
+	# label => 2 * index in projectedlabels + (1 if label has an ID else 0)
+	cdef vector[uint32_t] projection
+	cdef readonly list projectedlabels
 	cdef readonly list rulemapping, selfrulemapping
 	cdef readonly dict tblabelmapping
 	cdef readonly size_t nonterminals
@@ -561,9 +577,17 @@ cdef class Grammar:
 	cdef readonly object ruletuples
 	cdef readonly str currentmodel
 	cdef readonly object models  # serialized numpy arrays
+	cdef readonly str precision  # float64, float32, or uint16
 	#
 	cdef _indexrules(self, vector[ProbRule *]& dest, int idx, int filterlen,
 			int orignumrules)
+	cdef _convertrulelines(self, bytes rules, list backtransform)
+	cdef _convertrulechunks(self, bytes rules, list backtransform,
+			numproc)
+	cdef _loadmodels(self)
+	cdef _quantizemodels(self)
+	cdef _roundweights(self, bint logprob)
+	cdef _copyweights(self)
 	cpdef rulestr(self, int n)
 	cpdef noderuleno(self, node)
 	cpdef getruleno(self, tuple r, tuple yf)
@@ -584,12 +608,13 @@ cdef class Chart:
 	# cdef vector[string] derivations  # corresponds to rankededges[chart.root()]
 	# list of (str, float); corresponds to rankededges[chart.root()]:
 	cdef readonly list derivations
-	cdef Grammar grammar
+	cdef readonly Grammar grammar
 	cdef readonly list sent
 	cdef short lensent
 	cdef Label start
 	cdef readonly bint logprob  # False: 0 < p <= 1; True: 0 <= -log(p) < inf
 	cdef readonly bint viterbi  # False: inside probs; True: viterbi 1-best
+	cdef readonly bint incomplete  # True: parsing was interrupted by a budget
 	cdef int lexidx(self, Edge edge) except -1
 	cdef Prob subtreeprob(self, ItemNo itemidx)
 	cdef Prob lexprob(self, ItemNo itemidx, Edge edge) except -1
@@ -604,6 +629,8 @@ cdef class Chart:
 	cdef SmallChartItem asSmallChartItem(self, ItemNo itemidx)
 	cdef FatChartItem asFatChartItem(self, ItemNo itemidx)
 	cdef size_t asCFGspan(self, ItemNo itemidx)
+	cdef bytes _itemstobytes(self)
+	cdef _itemsfrombytes(self, bytes data)
 
 
 @cython.final
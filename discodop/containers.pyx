@@ -5,7 +5,9 @@ import os
 import re
 import mmap
 import pickle
+import hashlib
 import logging
+import multiprocessing
 import numpy as np
 from array import array
 from math import isinf, fsum
@@ -16,6 +18,7 @@ from .tree import Tree
 cimport cython
 from cython.operator cimport dereference
 from libc.string cimport strchr
+from libc.math cimport HUGE_VAL as INFINITY
 from libc.stdio cimport FILE, fopen, fread, fclose
 
 cdef extern from "<algorithm>" namespace "std" nogil:
@@ -27,6 +30,9 @@ include "constants.pxi"
 cdef array chararray = array('b')
 cdef array dblarray = array('d')
 cdef int maxbitveclen = SLOTS * sizeof(uint64_t) * 8
+# number of header fields of a serialized chart; rule number of lexical edges
+DEF CHARTHEADER = 8
+DEF LEXICALEDGE = 0xFFFFFFFF
 
 include "_grammar.pxi"
 
@@ -242,6 +248,138 @@ cdef class Chart:
 		# labels: len({self.label(item) for item in range(1, self.numitems() + 1)}),
 		# spans: ...
 
+	def tobytes(self, bytes fingerprint=None):
+		"""Serialize chart to a compact binary format; cf. ``frombytes()``.
+
+		Stores the items, parse forest, and probabilities of the chart, and
+		the sentence; the grammar is only identified by its fingerprint.
+		Derivations and indices used only while parsing are not stored.
+
+		:param fingerprint: ``grammar.fingerprint()``; pass it to avoid
+			recomputing it for each chart."""
+		cdef array buf
+		cdef char *ptr
+		cdef uint64_t header[CHARTHEADER]
+		cdef uint64_t ruleno
+		cdef uint32_t cnt
+		cdef size_t idx, n, numitems = self.numitems(), numedges = 0
+		cdef ItemNo item
+		cdef Edge edge
+		cdef bytes items = self._itemstobytes()
+		cdef bytes sent = '\n'.join(self.sent).encode('utf8')
+		cdef bytes name = type(self).__name__.encode('ascii') + b'\n'
+		if fingerprint is None:
+			fingerprint = self.grammar.fingerprint()
+		for n in range(1, numitems + 1):
+			numedges += self.parseforest[self.getitemidx(n)].size()
+		header[0] = self.parseforest.size()
+		header[1] = numitems
+		header[2] = numedges
+		header[3] = self.start
+		header[4] = self.logprob | self.viterbi << 1 | self.incomplete << 2
+		header[5] = len(fingerprint)
+		header[6] = len(sent)
+		header[7] = len(items)
+		buf = clone(chararray, len(name) + sizeof(header)
+				+ numitems * (sizeof(ItemNo) + sizeof(Prob) + sizeof(cnt))
+				+ numedges * 2 * sizeof(uint64_t)
+				+ len(fingerprint) + len(sent) + len(items), False)
+		ptr = buf.data.as_chars
+		memcpy(ptr, <char *>name, len(name))
+		idx = len(name)
+		memcpy(&ptr[idx], header, sizeof(header))
+		idx += sizeof(header)
+		for data in (fingerprint, sent, items):
+			memcpy(&ptr[idx], <char *><bytes>data, len(data))
+			idx += len(data)
+		# for each item: its number, probability, and edges
+		for n in range(1, numitems + 1):
+			item = self.getitemidx(n)
+			cnt = self.parseforest[item].size()
+			memcpy(&ptr[idx], &item, sizeof(ItemNo))
+			memcpy(&ptr[idx + sizeof(ItemNo)], &self.probs[item], sizeof(Prob))
+			memcpy(&ptr[idx + sizeof(ItemNo) + sizeof(Prob)], &cnt, sizeof(cnt))
+			idx += sizeof(ItemNo) + sizeof(Prob) + sizeof(cnt)
+			for edge in self.parseforest[item]:
+				# store rule number instead of pointer
+				ruleno = LEXICALEDGE if edge.rule is NULL else edge.rule.no
+				memcpy(&ptr[idx], &ruleno, sizeof(uint64_t))
+				memcpy(&ptr[idx + sizeof(uint64_t)], &edge.pos,
+						sizeof(uint64_t))
+				idx += 2 * sizeof(uint64_t)
+		assert idx == len(buf), (idx, len(buf))
+		return buf.tobytes()
+
+	@classmethod
+	def frombytes(cls, bytes data, Grammar grammar, bytes fingerprint=None):
+		"""Load a chart serialized with ``tobytes()``.
+
+		:param grammar: the grammar with which the chart was produced.
+		:param fingerprint: ``grammar.fingerprint()``; pass it to avoid
+			recomputing it for each chart."""
+		cdef Chart ob
+		cdef const char *ptr = data
+		cdef uint64_t header[CHARTHEADER]
+		cdef uint64_t ruleno
+		cdef uint32_t cnt, m
+		cdef size_t idx, n
+		cdef ItemNo item
+		cdef Edge edge
+		idx = data.index(b'\n') + 1
+		name = data[:idx - 1].decode('ascii')
+		if name != cls.__name__:
+			raise ValueError('expected %s, got %s' % (cls.__name__, name))
+		memcpy(header, &ptr[idx], sizeof(header))
+		idx += sizeof(header)
+		if fingerprint is None:
+			fingerprint = grammar.fingerprint()
+		if data[idx:idx + header[5]] != fingerprint:
+			raise ValueError('chart was produced with a different grammar.')
+		idx += header[5]
+		ob = cls.__new__(cls)
+		ob.grammar = grammar
+		ob.sent = data[idx:idx + header[6]].decode('utf8').split('\n')
+		if header[6] == 0:
+			ob.sent = []
+		idx += header[6]
+		ob.lensent = len(ob.sent)
+		ob.start = header[3]
+		ob.logprob = header[4] & 1
+		ob.viterbi = (header[4] >> 1) & 1
+		ob.incomplete = (header[4] >> 2) & 1
+		ob._itemsfrombytes(data[idx:idx + header[7]])
+		idx += header[7]
+		ob.probs.resize(header[0], INFINITY if ob.logprob else 0.0)
+		ob.parseforest.resize(header[0])
+		for n in range(header[1]):
+			memcpy(&item, &ptr[idx], sizeof(ItemNo))
+			if item >= header[0]:
+				raise ValueError('item number out of range: %d' % item)
+			memcpy(&ob.probs[item], &ptr[idx + sizeof(ItemNo)], sizeof(Prob))
+			memcpy(&cnt, &ptr[idx + sizeof(ItemNo) + sizeof(Prob)], sizeof(cnt))
+			idx += sizeof(ItemNo) + sizeof(Prob) + sizeof(cnt)
+			for m in range(cnt):
+				memcpy(&ruleno, &ptr[idx], sizeof(uint64_t))
+				memcpy(&edge.pos, &ptr[idx + sizeof(uint64_t)],
+						sizeof(uint64_t))
+				idx += 2 * sizeof(uint64_t)
+				if ruleno == LEXICALEDGE:
+					edge.rule = NULL
+				elif ruleno < grammar.numrules:
+					edge.rule = &(grammar._bylhs[grammar.revrulemap[ruleno]])
+				else:
+					raise ValueError('rule number out of range: %d' % ruleno)
+				ob.parseforest[item].push_back(edge)
+		return ob
+
+	cdef bytes _itemstobytes(self):
+		"""Return the items of the chart as raw bytes."""
+		raise NotImplementedError
+
+	cdef _itemsfrombytes(self, bytes data):
+		"""Restore the items of the chart from raw bytes, and index them."""
+		raise NotImplementedError
+
 
 cdef void _filtersubtree(Chart chart, item, set items):
 	"""Recursively collect items that lead to a complete derivation."""
@@ -4,22 +4,29 @@ Use as follows:
 
 >>> getderivations(chart, 1000)  # doctest: +SKIP
 >>> parses, msg = marginalize('mpp', chart)  # doctest: +SKIP
+
+Or, to estimate the most probable parse from sampled derivations:
+
+>>> getsamples(chart, 1000)  # doctest: +SKIP
+>>> parses, msg = marginalize('mpp-sample', chart)  # doctest: +SKIP
 """
 
 from __future__ import print_function
 import re
+from string import Formatter
 from heapq import nlargest
-from math import exp, log, isinf, fsum
-from random import random
+from math import exp, log, log1p, isinf, fsum
+from random import random, Random
 from bisect import bisect_right
 from operator import itemgetter, attrgetter
 from itertools import count
 from functools import partial
 from collections import defaultdict
+import numpy as np
 from . import plcfrs, _fragments
 from .tree import Tree, ParentedTree, ImmutableTree, writediscbrackettree
 from .kbest import lazykbest
-from .kbest cimport getderiv
+from .kbest cimport getderiv, LazyKBest
 from .grammar import lcfrsproductions, spinal, REMOVEDEC
 from .treetransforms import (addbitsets, unbinarize, canonicalize,
 		collapseunary, mergediscnodes, binarize)
@@ -27,8 +34,8 @@ from .bit import pyintnextset, pyintbitcount
 
 cimport cython
 from cython.operator cimport dereference
-from libc.string cimport memset
-from libc.stdint cimport uint64_t
+from libc.string cimport memset, memcpy
+from libc.stdint cimport uint32_t, uint64_t
 from libc.math cimport HUGE_VAL as INFINITY
 from libcpp.string cimport string
 from libcpp.vector cimport vector
@@ -36,7 +43,8 @@ from libcpp.utility cimport pair
 from .bit cimport abitcount
 from .containers cimport (Prob, Grammar, ProbRule, LexicalRule, Chart,
 		SmallChartItem, FatChartItem, Edge, RankedEdge, Whitelist, Label,
-		ItemNo, sparse_hash_map, logprobadd, logprobsum, yieldranges)
+		ItemNo, sparse_hash_map, FatChartItemBtreeMap, logprobadd, logprobsum,
+		yieldranges)
 
 
 cdef extern from "macros.h":
@@ -48,6 +56,7 @@ cdef extern from "macros.h":
 include "constants.pxi"
 
 REMOVEIDS = re.compile('@[-0-9]+')
+FORMATTER = Formatter()
 REMOVEWORDTAGS = re.compile('@[^ )]+')
 # NB: similar to the one in _grammar.pxi, but used to match labels within parse
 # trees instead of individual labels
@@ -78,6 +87,140 @@ cpdef getderivations(Chart chart, int k, derivstrings=True):
 	chart.derivations = lazykbest(chart, k, derivs=derivstrings)
 
 
+cpdef getsamples(Chart chart, int m, seed=0, derivstrings=True):
+	"""Sample *m* derivations from chart, proportional to their probability.
+
+	Derivations are sampled top-down, choosing among the edges of an item
+	according to their inside probabilities, which are computed in log space
+	to avoid underflow. The result is stored as with ``getderivations()``;
+	the same derivation may be sampled multiple times.
+
+	:param m: number of derivations to sample from chart
+	:param seed: seed for the random number generator.
+	:param derivstrings: whether to create derivations as strings
+	:returns: ``None``. Modifies ``chart.derivations`` and
+		``chart.rankededges`` in-place."""
+	cdef pair[RankedEdge, Prob] entry
+	cdef vector[double] inside
+	cdef vector[ItemNo] order
+	cdef ItemNo root = chart.root()
+	cdef int n
+	if root not in chart:
+		raise ValueError('sampling: no complete derivation in chart')
+	chart.rankededges.clear()
+	chart.rankededges.resize(chart.parseforest.size())
+	inside.resize(chart.parseforest.size(), -INFINITY)
+	if insideprob(inside, order, root, chart) == INFINITY:
+		raise ValueError('sampling: no derivation with non-zero probability')
+	rand = Random(seed).random
+	for n in range(m):
+		samplederiv(inside, order, root, chart, rand)
+	chart.derivations = [(getderiv(root, entry.first, chart).decode('utf8'),
+			entry.second) for entry in chart.rankededges[root]
+			] if derivstrings else None
+
+
+cdef double insideprob(vector[double]& inside, vector[ItemNo]& order,
+		ItemNo v, Chart chart) except? -1:
+	"""Compute inside probability of item, memoized in ``inside``.
+
+	Probabilities are negative log probabilities; ``inside`` should be
+	initialized with ``-INFINITY`` for items not yet computed. Edges leading
+	to a cycle back to an item contribute nothing. Items are appended to
+	``order`` after their children (bottom-up)."""
+	cdef Edge edge
+	cdef double result = INFINITY
+	if inside[v] != -INFINITY:
+		return inside[v]
+	inside[v] = INFINITY
+	for edge in chart.parseforest[v]:
+		result = neglogprobadd(
+				result, edgeprob(inside, order, v, edge, chart))
+	inside[v] = result
+	order.push_back(v)
+	return result
+
+
+cdef double edgeprob(vector[double]& inside, vector[ItemNo]& order,
+		ItemNo v, Edge& edge, Chart chart) except? -1:
+	"""Inside probability of item restricted to a single edge.
+
+	As with ``insideprob()``, the result is a negative log probability."""
+	cdef double result
+	if edge.rule is NULL:  # only one lexical edge; use viterbi probability
+		result = chart.subtreeprob(v)
+	else:
+		result = edge.rule.prob
+	if not chart.logprob:
+		result = -log(result) if result > 0 else INFINITY
+	if edge.rule is not NULL:
+		result += insideprob(inside, order, chart._left(v, edge), chart)
+		if edge.rule.rhs2:
+			result += insideprob(inside, order, chart._right(v, edge), chart)
+	return result
+
+
+cdef inline double neglogprobadd(double x, double y):
+	"""Add two probabilities given as negative log probabilities."""
+	if x > y:
+		x, y = y, x
+	if y == INFINITY:
+		return x
+	return x - log1p(exp(x - y))
+
+
+cdef int samplederiv(vector[double]& inside, vector[ItemNo]& order,
+		ItemNo v, Chart chart, rand) except -1:
+	"""Sample a derivation for item and add it to ``chart.rankededges[v]``.
+
+	Edges are chosen with their inside probabilities normalized by that of
+	the item.
+
+	:returns: the index of the derivation in ``chart.rankededges[v]``."""
+	cdef Edge edge
+	cdef double x = rand(), prob
+	cdef size_t n, chosen = 0
+	cdef int left = -1, right = -1
+	for n in range(chart.parseforest[v].size()):
+		prob = exp(inside[v] - edgeprob(
+				inside, order, v, chart.parseforest[v][n], chart))
+		if prob > 0:
+			chosen = n
+			if x < prob:
+				break
+			x -= prob
+	edge = chart.parseforest[v][chosen]
+	if edge.rule is not NULL:
+		left = samplederiv(inside, order, chart._left(v, edge), chart, rand)
+		if edge.rule.rhs2:
+			right = samplederiv(
+					inside, order, chart._right(v, edge), chart, rand)
+	return addrankededge(v, edge, left, right, chart)
+
+
+cdef int addrankededge(ItemNo v, Edge& edge, int left, int right,
+		Chart chart) except -1:
+	"""Add a derivation for item to ``chart.rankededges[v]``.
+
+	:param left, right: indices of derivations of the children of ``edge``
+		in ``chart.rankededges``, or -1.
+	:returns: the index of the derivation in ``chart.rankededges[v]``."""
+	cdef pair[RankedEdge, Prob] entry
+	cdef ItemNo item
+	if edge.rule is NULL:
+		entry.second = chart.subtreeprob(v)
+	else:
+		entry.second = edge.rule.prob
+		item = chart._left(v, edge)
+		entry.second += chart.rankededges[item][left].second
+		if edge.rule.rhs2:
+			item = chart._right(v, edge)
+			entry.second += chart.rankededges[item][right].second
+	entry.first = RankedEdge(edge, left, right)
+	chart.rankededges[v].push_back(entry)
+	return chart.rankededges[v].size() - 1
+
+
 cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 		int k=1000, int sldop_n=7, double mcplambda=1.0, set mcplabels=None,
 		bint ostag=False, set require=None, set block=None):
@@ -102,12 +245,22 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 		Available objective functions:
 
 		:'mpp': Most Probable Parse
+		:'mpp-sample': Most Probable Parse, estimated from the relative
+			frequencies of parse trees in derivations sampled with
+			``getsamples()``.
 		:'mpd': Most Probable Derivation
+		:'max-rule-product', 'max-recall': parse tree with maximum product
+			of rule posteriors, or maximum expected labeled recall;
+			computed from the chart, without derivations.
 		:'shortest': Most Probable Shortest Derivation
-		:'sl-dop': Simplicity-Likelihood DOP; select most likely parse from the
-			``sldop_n`` parse trees with the shortest derivations.
+		:'sl-dop': Simplicity-Likelihood DOP; select the parse tree with the
+			shortest derivation from the ``sldop_n`` most likely parse trees.
 		:'sl-dop-simple': Approximation of Simplicity-Likelihood DOP
-	:param k: when ``method='sl-dop``, number of derivations to consider.
+	:param k: if no derivations have been extracted from the chart yet (with
+		``getderivations()``), the maximum number of derivations to
+		enumerate. With ``'mpd'`` and ``'mpp'``, derivations are then
+		enumerated lazily, stopping as soon as the remaining derivations
+		cannot change the most probable parse.
 	:param require: optionally, a list of tuples ``(label, indices)``; only
 		parse trees containing these labeled spans will be kept.
 		For example. ``('NP', [0, 1, 2])``.
@@ -127,48 +280,68 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 	cdef list backtransform = chart.grammar.backtransform
 	cdef bint mpd = method == 'mpd'
 	cdef bint shortest = method == 'shortest'
+	cdef bint sample = method == 'mpp-sample'
 	cdef bint dopreduction = backtransform is None
 	cdef pair[RankedEdge, Prob] entry
 	cdef vector[pair[RankedEdge, Prob]] entries
+	cdef vector[Prob] probs
 	cdef sparse_hash_map[string, vector[Prob]] mpptrees
 	cdef dict mpdtrees = {}
 	cdef dict derivlen = {}  # parsetree => (derivlen, derivprob)
 	cdef dict derivs = {}
-	cdef str treestr, deriv
+	cdef dict memo = {}  # recovered subderivations for Double-DOP
+	cdef LazyKBest lazy = None
+	cdef MPPBound bound = None
+	cdef bytes treekey
+	cdef int shift
+	cdef str treestr, derivstr
 	cdef Prob prob, maxprob
-	cdef size_t n
+	cdef size_t n, nsamples
 	cdef ItemNo root = chart.root()
 
+	if method in ('max-rule-product', 'max-recall'):
+		return maxposteriorparse(chart, method == 'max-rule-product')
+	if chart.rankededges.size() == 0:  # no derivations extracted yet
+		if sample:
+			getsamples(chart, k)
+		elif (mpd or method == 'mpp') and not ostag:
+			lazy = LazyKBest(chart, k)
+			if not mpd and not (require or block):
+				bound = MPPBound(chart)
+		else:
+			getderivations(chart, k, derivstrings=ostag)
+
 	if method == 'sl-dop':
-		return sldop(chart, sent, tags, k, sldop_n)
+		return sldop(chart, sldop_n)
 	elif method == 'sl-dop-simple':
 		return sldop_simple(sldop_n, chart)
 	elif method == 'mcp':
 		return maxconstituentsparse(chart, mcplambda, mcplabels)
 	elif method == 'shortest':
 		# filter out all derivations which are not shortest
-		if not dopreduction:
-			maxprob = INFINITY
-			for entry in chart.rankededges[root]:
-				if entry.second < maxprob:
-					maxprob = entry.second
-			for entry in chart.rankededges[root]:
-				if entry.second == maxprob:
-					entries.push_back(entry)
-			chart.rankededges[root] = entries
-		elif chart.derivations:
-			_, maxprob = min(chart.derivations, key=itemgetter(1))
-			chart.derivations = [(deriv, prob)
-					for deriv, prob in chart.derivations
+		maxprob = INFINITY
+		for entry in chart.rankededges[root]:
+			if entry.second < maxprob:
+				maxprob = entry.second
+		for entry in chart.rankededges[root]:
+			if entry.second == maxprob:
+				entries.push_back(entry)
+		chart.rankededges[root] = entries
+		if chart.derivations:
+			chart.derivations = [(derivstr, prob)
+					for derivstr, prob in chart.derivations
 					if prob == maxprob]
+	nsamples = chart.rankededges[root].size()
 
 	if not dopreduction:  # Double-DOP
-		for n in range(chart.rankededges[root].size()):
-			entry = chart.rankededges[root][n]
+		for n in range(chart.rankededges[root].size() if lazy is None
+				else k):
+			if not nextderivation(lazy, chart, n, entry):
+				break
 			prob = entry.second
 			try:
 				treestr = recoverfragments(
-						root, entry.first, chart, backtransform)
+						root, entry.first, chart, backtransform, memo)
 			except Exception:
 				continue
 				# print(getderiv(
@@ -192,48 +365,79 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 				mpptrees[<string>treestr.encode('utf8')].push_back(-prob)
 				if treestr not in derivs:
 					derivs[treestr] = n
-	else:  # DOP reduction
-		for n, (deriv, prob) in enumerate(chart.derivations):
-			if ostag:
-				deriv = removeadjunaries(deriv)
-				treestr = REMOVEDEC.sub('@1' if mpd or shortest else '', deriv)
-			elif dopreduction:
-				treestr = REMOVEIDS.sub('@1' if mpd or shortest else '', deriv)
-			else:
-				raise ValueError
+			if stopearly(lazy, bound, mpd, treestr, prob, require, block):
+				break
+	elif ostag:
+		for n, (derivstr, prob) in enumerate(chart.derivations):
+			derivstr = removeadjunaries(derivstr)
+			treestr = REMOVEDEC.sub('@1' if mpd or shortest else '', derivstr)
 			if shortest:
 				entry = chart.rankededges[root][n]
 				newprob = getderivprob(root, entry.first, chart, sent)
 				score = (int(prob / log(0.5)), exp(-newprob))
-				if treestr not in derivlen or (not dopreduction
-						and score > derivlen[treestr]):
+				if treestr not in derivlen:
 					derivlen[treestr] = score
-					derivs[treestr] = deriv
-				elif dopreduction:
+					derivs[treestr] = derivstr
+				else:
 					oldscore = derivlen[treestr]
 					derivlen[treestr] = oldscore[0], oldscore[1] + score[1]
 			elif mpd:
 				if (treestr not in mpdtrees or
 						-prob > mpdtrees[treestr]):
 					mpdtrees[treestr] = -prob
-					derivs[treestr] = deriv
+					derivs[treestr] = derivstr
 			else:
 				mpptrees[<string>treestr.encode('utf8')].push_back(-prob)
 				if treestr not in derivs:
-					derivs[treestr] = deriv
+					derivs[treestr] = derivstr
+	else:  # DOP reduction
+		# map labels to labels without IDs, while traversing derivations.
+		projectlabels(chart.grammar)
+		shift = 0 if mpd or shortest else 1
+		for n in range(chart.rankededges[root].size() if lazy is None
+				else k):
+			if not nextderivation(lazy, chart, n, entry):
+				break
+			prob = entry.second
+			treekey = getkey(root, entry.first, chart, shift)
+			if shortest:
+				newprob = getderivprob(root, entry.first, chart, sent)
+				score = (int(prob / log(0.5)), exp(-newprob))
+				if treekey not in derivlen:
+					derivlen[treekey] = score
+					derivs[treekey] = n
+				else:
+					oldscore = derivlen[treekey]
+					derivlen[treekey] = oldscore[0], oldscore[1] + score[1]
+			elif mpd:
+				if (treekey not in mpdtrees or
+						-prob > mpdtrees[treekey]):
+					mpdtrees[treekey] = -prob
+					derivs[treekey] = n
+			else:
+				mpptrees[treekey].push_back(-prob)
+				if treekey not in derivs:
+					derivs[treekey] = n
+			if stopearly(lazy, bound, mpd, treekey, prob, require, block):
+				break
+	if lazy is not None:
+		lazy.finish()
 
 	if ostag:
 		results = []
 		for it in mpptrees:
 			treestr = REMOVEDEC.sub('', it.first.decode('utf8'))
 			probs = it.second
-			results.append((treestr, logprobsum(probs),
+			results.append((treestr, (<double>probs.size() / nsamples if sample
+					else logprobsum(probs)),
 					ostagderivation(derivs[treestr], chart.sent)))
 	elif shortest:
 		if dopreduction:
-			results = [(REMOVEIDS.sub('', treestr), (-a, b),
-					fragmentsinderiv_str(derivs[treestr], chart, backtransform))
-					for treestr, (a, b) in derivlen.items()]
+			results = [(keytotree(treekey, chart.grammar, shift), (-a, b),
+					fragmentsinderiv_str(getderiv(root,
+						chart.rankededges[root][derivs[treekey]].first,
+						chart).decode('utf8'), chart, backtransform))
+					for treekey, (a, b) in derivlen.items()]
 		else:
 			results = [(treestr, (-a, b),
 					fragmentsinderiv_re(
@@ -242,9 +446,11 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 					for treestr, (a, b) in derivlen.items()]
 	elif mpd:
 		if dopreduction:
-			results = [(REMOVEIDS.sub('', treestr), exp(prob),
-					fragmentsinderiv_str(derivs[treestr], chart, backtransform))
-					for treestr, prob in mpdtrees.items()]
+			results = [(keytotree(treekey, chart.grammar, shift), exp(prob),
+					fragmentsinderiv_str(getderiv(root,
+						chart.rankededges[root][derivs[treekey]].first,
+						chart).decode('utf8'), chart, backtransform))
+					for treekey, prob in mpdtrees.items()]
 		else:
 			results = [(treestr, exp(prob),
 					fragmentsinderiv_re(
@@ -254,22 +460,27 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 	elif dopreduction:
 		results = []
 		for it in mpptrees:
-			treestr = it.first.decode('utf8')
+			treekey = it.first
 			probs = it.second
-			results.append((treestr, logprobsum(probs),
-					fragmentsinderiv_str(derivs[treestr], chart, backtransform)))
+			results.append((keytotree(treekey, chart.grammar, shift),
+					(<double>probs.size() / nsamples if sample
+					else logprobsum(probs)),
+					fragmentsinderiv_str(getderiv(root,
+						chart.rankededges[root][derivs[treekey]].first,
+						chart).decode('utf8'), chart, backtransform)))
 	else:
 		results = []
 		for it in mpptrees:
 			treestr = it.first.decode('utf8')
 			probs = it.second
-			results.append((treestr, logprobsum(probs),
+			results.append((treestr, (<double>probs.size() / nsamples if sample
+					else logprobsum(probs)),
 					fragmentsinderiv_re(
 						root, chart.rankededges[root][derivs[treestr]].first,
 						chart, backtransform)))
 
 	msg = '%d derivations, %d parsetrees' % (
-			len(chart.derivations) if dopreduction
+			len(chart.derivations) if ostag
 				else chart.rankededges[root].size(),
 			len(mpdtrees) or len(derivlen) or mpptrees.size())
 	if require or block:
@@ -279,6 +490,181 @@ cpdef marginalize(method, Chart chart, list sent=None, list tags=None,
 	return results, msg
 
 
+cdef inline bint nextderivation(LazyKBest lazy, Chart chart, size_t n,
+		pair[RankedEdge, Prob]& entry) except -1:
+	"""Get the *n*-th derivation, enumerating it with ``lazy`` if given.
+
+	Without ``lazy``, the derivation is taken from ``chart.rankededges``.
+	Returns False when there are no more derivations."""
+	if lazy is None:
+		entry = chart.rankededges[chart.root()][n]
+		return True
+	elif lazy.next() == -1:
+		return False
+	entry = lazy.derivations[n]
+	return True
+
+
+cdef inline bint stopearly(LazyKBest lazy, MPPBound bound, bint mpd, tree,
+		Prob prob, set require, set block) except -1:
+	"""Test whether enumeration of derivations can stop after the current one.
+
+	With MPD, the first derivation gives the result; with MPP, when further
+	derivations cannot change the most probable parse."""
+	if lazy is None:
+		return False
+	elif bound is not None:
+		return bound.add(tree, exp(-prob))
+	return mpd and not (require or block)
+
+
+@cython.final
+cdef class MPPBound:
+	"""Test whether further derivations can change the most probable parse.
+
+	The probability mass of the derivations not yet seen is bounded by the
+	inside probability of the root minus the mass of those seen so far. The
+	inside probability leaves out derivations with cycles, which may still
+	be enumerated; when the chart has cyclic edges, there is no bound."""
+	cdef dict treeprobs  # parse tree => sum of probs of derivations so far
+	cdef object best
+	cdef double bestprob, secondprob, remaining
+
+	def __init__(self, Chart chart):
+		cdef vector[double] inside
+		cdef vector[ItemNo] order
+		cdef vector[size_t] rank
+		cdef Edge edge
+		cdef ItemNo v
+		cdef size_t n
+		inside.resize(chart.parseforest.size(), -INFINITY)
+		self.remaining = exp(-insideprob(inside, order, chart.root(), chart))
+		if self.remaining == 0:  # underflow; no bound
+			self.remaining = INFINITY
+		rank.resize(chart.parseforest.size(), 0)
+		for n in range(order.size()):
+			rank[order[n]] = n + 1
+		for v in order:
+			for edge in chart.parseforest[v]:
+				if not acyclicedge(rank, v, edge, chart):
+					self.remaining = INFINITY
+		self.treeprobs = {}
+		self.best = None
+		self.bestprob = self.secondprob = 0.0
+
+	cdef bint add(self, tree, double prob) except -1:
+		"""Add the probability of a derivation for parse tree.
+
+		:returns: True if the most probable parse can no longer change."""
+		cdef double total = self.treeprobs.get(tree, 0.0) + prob
+		self.treeprobs[tree] = total
+		self.remaining -= prob
+		if self.best is not None and tree == self.best:
+			self.bestprob = total
+		elif total > self.bestprob:
+			self.secondprob = self.bestprob
+			self.best, self.bestprob = tree, total
+		elif total > self.secondprob:
+			self.secondprob = total
+		return self.bestprob - self.secondprob > self.remaining
+
+
+cdef projectlabels(Grammar grammar):
+	"""Project labels of grammar to labels without annotations like ``@123``.
+
+	Computed once per grammar and stored in ``grammar.projection``;
+	labels added to the grammar later are projected on the next call."""
+	cdef dict index
+	cdef size_t n
+	if grammar.projection.size() == grammar.nonterminals:
+		return
+	if grammar.projectedlabels is None:
+		grammar.projectedlabels = []
+	index = {label: n for n, label in enumerate(grammar.projectedlabels)}
+	for n in range(grammar.projection.size(), grammar.nonterminals):
+		label = grammar.tolabel[n]
+		projected = REMOVEIDS.sub('', label)
+		if projected not in index:
+			index[projected] = len(grammar.projectedlabels)
+			grammar.projectedlabels.append(projected)
+		grammar.projection.push_back(
+				2 * index[projected] + (projected != label))
+
+
+cdef int derivkey(vector[uint32_t]& key, ItemNo v, RankedEdge& ej,
+		Chart chart, int shift) except -1:
+	"""Append a key for the parse tree of a derivation, without IDs.
+
+	The key contains an integer for each node in pre-order:
+	``3 * (grammar.projection[label] >> shift) + arity``; a node with arity 0
+	is followed by the index of its terminal. With ``shift=1``, derivations
+	of the same parse tree get the same key; with ``shift=0``, nodes with
+	IDs are distinguished from nodes without. Requires ``projectlabels()``."""
+	cdef RankedEdge rankededge
+	cdef uint32_t code = chart.grammar.projection[chart.label(v)] >> shift
+	if ej.edge.rule is NULL:  # lexical rule, left child is terminal
+		key.push_back(3 * code)
+		key.push_back(chart.lexidx(ej.edge))
+		return 0
+	key.push_back(3 * code + (2 if ej.edge.rule.rhs2 else 1))
+	item = chart.left(v, ej)
+	rankededge = chart.rankededges[item][ej.left].first
+	derivkey(key, item, rankededge, chart, shift)
+	if ej.right != -1:
+		item = chart.right(v, ej)
+		rankededge = chart.rankededges[item][ej.right].first
+		derivkey(key, item, rankededge, chart, shift)
+	return 0
+
+
+cdef bytes getkey(ItemNo v, RankedEdge& ej, Chart chart, int shift):
+	"""Return ``derivkey()`` of a derivation as a bytes object."""
+	cdef vector[uint32_t] key
+	derivkey(key, v, ej, chart, shift)
+	return (<char *>&(key[0]))[:key.size() * sizeof(uint32_t)]
+
+
+cdef str keytotree(bytes key, Grammar grammar, int shift):
+	"""Convert a key produced by ``derivkey()`` to a tree string."""
+	cdef vector[uint32_t] nodes
+	cdef list result = []
+	nodes.resize(len(key) // sizeof(uint32_t))
+	memcpy(&(nodes[0]), <char *>key, len(key))
+	_keytotree(result, nodes, 0, grammar.projectedlabels, 1 - shift)
+	return ''.join(result)
+
+
+cdef size_t _keytotree(list result, vector[uint32_t]& nodes, size_t n,
+		list names, int shift):
+	"""Auxiliary function for ``keytotree()``; returns index of next node."""
+	cdef int arity = nodes[n] % 3
+	result.append('(')
+	result.append(names[(nodes[n] // 3) >> shift])
+	if arity == 0:
+		result.append(' %d)' % nodes[n + 1])
+		return n + 2
+	result.append(' ')
+	n = _keytotree(result, nodes, n + 1, names, shift)
+	if arity == 2:
+		result.append(' ')
+		n = _keytotree(result, nodes, n, names, shift)
+	result.append(')')
+	return n
+
+
+cdef int unaddressed(bytes key):
+	"""Count the nodes without IDs in a key produced with ``shift=0``."""
+	cdef vector[uint32_t] nodes
+	cdef size_t n = 0
+	cdef int result = 0
+	nodes.resize(len(key) // sizeof(uint32_t))
+	memcpy(&(nodes[0]), <char *>key, len(key))
+	while n < nodes.size():
+		result += (nodes[n] // 3) % 2 == 0
+		n += 1 if nodes[n] % 3 else 2
+	return result
+
+
 def testconstraints(treestr, require, block):
 	"""Test if tree satisfies constraints of required/blocked labeled spans."""
 	spans = {(node.label, tuple(sorted(node.leaves())))
@@ -291,7 +677,7 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 	"""Approximate the Max Constituents Parse (MCP) parse from k-best list.
 
 	Also known as Most Constituents Correct.
-	:param chart: the chart, with k-best derivations as strings
+	:param chart: the chart, with k-best derivations
 	:param labda:
 		weight to assign to recall rate vs. the mistake rate;
 		1.0 assigns equal weight to both.
@@ -301,13 +687,13 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 	"""
 	# Cannot maximize this objective directly from chart because
 	# derivations need to be expanded first.
-	# NB: this requires derivation strings not entries.
 	cdef double sentprob = 0.0, maxscore = 0.0
 	cdef double prob, score, maxcombscore, contribution
 	cdef short start, spanlen
 	cdef object span, leftspan, rightspan, maxleft  # bitsets as Python ints
 	cdef list backtransform = chart.grammar.backtransform
-	cdef list derivations = []
+	cdef dict parsetrees = {}  # parse tree => sum of derivation probs
+	cdef dict memo = {}
 	cdef ItemNo root = chart.root()
 	# FIXME: optimize datastructures
 	# table[start][spanlen][span][label] = prob
@@ -315,17 +701,22 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 				for _ in range(len(chart.sent) - n + 1)]
 			for n in range(len(chart.sent) + 1)]
 	tree = None
+	# sum over derivations of each parse tree, so that each parse tree
+	# only needs to be expanded once.
 	if backtransform is None:
-		for deriv, prob in chart.derivations:
-			derivations.append((REMOVEIDS.sub('', deriv), prob))
-	else:
-		for n in range(chart.rankededges[root].size()):
-			entry = chart.rankededges[root][n]
-			derivations.append((
-					recoverfragments(root, entry.first, chart, backtransform),
-					entry.second))
+		projectlabels(chart.grammar)
+	for n in range(chart.rankededges[root].size()):
+		entry = chart.rankededges[root][n]
+		if backtransform is None:
+			treekey = getkey(root, entry.first, chart, 1)
+		else:
+			treekey = recoverfragments(
+					root, entry.first, chart, backtransform, memo)
+		parsetrees[treekey] = parsetrees.get(treekey, 0.0) + exp(-entry.second)
 	# get marginal probabilities
-	for treestr, prob in derivations:
+	for treekey, prob in parsetrees.items():
+		treestr = (keytotree(treekey, chart.grammar, 1)
+				if backtransform is None else treekey)
 		# Rebinarize because we optimize only for constituents in the tree as
 		# it will be evaluated. Collapse unaries because we only select the
 		# single best label in each cell.
@@ -339,7 +730,7 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 					joinchar='+',
 					collapsepos=True,
 					collapseroot=True)))
-		sentprob += exp(-prob)
+		sentprob += prob
 		for t in tree.subtrees():
 			span = t.bitset
 			start = pyintnextset(span, 0)
@@ -347,7 +738,7 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 			tablecell = table[start][spanlen][span]
 			tablecell.setdefault(t.label, 0.0)
 			if '|<' not in t.label and (labels is None or t.label in labels):
-				tablecell[t.label] += exp(-prob)
+				tablecell[t.label] += prob
 
 	cells = defaultdict(dict)  # cells[span] = (label, score, leftspan)
 	# select best derivation
@@ -394,7 +785,191 @@ cdef maxconstituentsparse(Chart chart, double labda, set labels=None):
 	else:
 		return [(str(result), maxscore,
 				None)], '%d derivations; sentprob: %g' % (
-				len(chart.derivations), sentprob)
+				chart.rankededges[root].size(), sentprob)
+
+
+cdef maxposteriorparse(Chart chart, bint ruleproduct):
+	"""Select parse tree with an objective based on posterior probabilities.
+
+	Posteriors are computed with a single inside-outside pass over the parse
+	forest, in log space; posteriors of items and edges with the same spans
+	and the same labels without annotations (e.g., ``@123``) are summed. The
+	best derivation under the objective is selected with a Viterbi pass.
+	With Double-DOP, only constituents visible in the chart are scored, not
+	those internal to fragments.
+
+	:param ruleproduct: if True, maximize the product of the posteriors of
+		the anchored rules in the tree (max-rule-product; Petrov & Klein
+		2007); otherwise, maximize the sum of the posteriors of its labeled
+		constituents (max-recall; Goodman 1996).
+	:returns: ``(parses, msg)``, as with ``marginalize()``; the score is the
+		product of rule posteriors, or the mean constituent posterior."""
+	cdef vector[double] inside, outside, best, posterior
+	cdef vector[ItemNo] order, projitem
+	cdef vector[size_t] rank
+	cdef vector[int] bestedge
+	cdef Grammar grammar = chart.grammar
+	cdef list backtransform = grammar.backtransform
+	cdef list isconst
+	cdef dict rulepost = {}
+	cdef Edge edge
+	cdef ItemNo v, left, right, root = chart.root()
+	cdef double sentprob, prob, score
+	cdef size_t n, numconst = 0
+	inside.resize(chart.parseforest.size(), -INFINITY)
+	sentprob = insideprob(inside, order, root, chart)
+	if sentprob == INFINITY:
+		return [], 'no derivation with non-zero probability'
+	rank.resize(chart.parseforest.size(), 0)
+	for n in range(order.size()):
+		rank[order[n]] = n + 1
+
+	# outside probabilities, top-down; skip edges that lead to cycles.
+	# as with inside probabilities, these are negative log probabilities.
+	outside.resize(chart.parseforest.size(), INFINITY)
+	outside[root] = 0.0
+	for n in range(order.size() - 1, -1, -1):
+		v = order[n]
+		for edge in chart.parseforest[v]:
+			if edge.rule is NULL or not acyclicedge(rank, v, edge, chart):
+				continue
+			prob = outside[v] + (edge.rule.prob if chart.logprob
+					else -log(edge.rule.prob))
+			left = chart._left(v, edge)
+			if edge.rule.rhs2:
+				right = chart._right(v, edge)
+				outside[left] = neglogprobadd(
+						outside[left], prob + inside[right])
+				outside[right] = neglogprobadd(
+						outside[right], prob + inside[left])
+			else:
+				outside[left] = neglogprobadd(outside[left], prob)
+
+	# sum posteriors of items with same projected label and span
+	projectlabels(grammar)
+	isconst = ['|<' not in label and '}<' not in label
+			for label in grammar.projectedlabels]
+	posterior.resize(projectitems(projitem, order, chart), 0.0)
+	for v in order:
+		posterior[projitem[v]] += exp(sentprob - inside[v] - outside[v])
+	if ruleproduct:  # sum posteriors of edges with same projected rule
+		for v in order:
+			for edge in chart.parseforest[v]:
+				if acyclicedge(rank, v, edge, chart):
+					key = edgekey(projitem, v, edge, chart)
+					prob = exp(sentprob - outside[v]
+							- edgeprob(inside, order, v, edge, chart))
+					rulepost[key] = rulepost.get(key, 0.0) + prob
+
+	# Viterbi pass over posterior scores, bottom-up
+	best.resize(chart.parseforest.size(), -INFINITY)
+	bestedge.resize(chart.parseforest.size(), -1)
+	for v in order:
+		for n in range(chart.parseforest[v].size()):
+			edge = chart.parseforest[v][n]
+			if not acyclicedge(rank, v, edge, chart):
+				continue
+			score = 0.0
+			if ruleproduct:
+				prob = rulepost[edgekey(projitem, v, edge, chart)]
+				score = log(prob) if prob > 0 else -INFINITY
+			if edge.rule is not NULL:
+				score += best[chart._left(v, edge)]
+				if edge.rule.rhs2:
+					score += best[chart._right(v, edge)]
+			if score > best[v] or bestedge[v] == -1:
+				best[v] = score
+				bestedge[v] = n
+		if not ruleproduct and isconst[grammar.projection[
+				chart.label(v)] >> 1]:
+			best[v] += posterior[projitem[v]]
+	if best[root] == -INFINITY:
+		return [], 'no derivation with non-zero posterior'
+
+	chart.rankededges.clear()
+	chart.rankededges.resize(chart.parseforest.size())
+	bestderiv(bestedge, root, chart)
+	deriv = chart.rankededges[root][0].first
+	if backtransform is None:
+		treestr = keytotree(getkey(root, deriv, chart, 1), grammar, 1)
+		frags = fragmentsinderiv_str(getderiv(root, deriv, chart).decode(
+				'utf8'), chart, backtransform)
+	else:
+		treestr = recoverfragments(root, deriv, chart, backtransform)
+		frags = fragmentsinderiv_re(root, deriv, chart, backtransform)
+	if ruleproduct:
+		score = exp(best[root])
+	else:
+		for v in order:
+			numconst += (chart.rankededges[v].size() != 0
+					and isconst[grammar.projection[chart.label(v)] >> 1])
+		score = best[root] / numconst
+	return [(treestr, score, frags)], '%d items; log sentprob: %g' % (
+			order.size(), -sentprob)
+
+
+cdef size_t projectitems(vector[ItemNo]& projitem, vector[ItemNo]& order,
+		Chart chart):
+	"""Number items by span and projected label.
+
+	Items with the same span and projected label get the same number;
+	requires ``projectlabels()``.
+
+	:returns: the number of distinct projected items."""
+	cdef FatChartItemBtreeMap[ItemNo] projitems
+	cdef SmallChartItem sitem
+	cdef FatChartItem fitem
+	cdef ItemNo v
+	cdef size_t m
+	# cf. plcfrs.parse(); a SmallLCFRSChart has no FatChartItems
+	cdef bint small = <unsigned>chart.lensent < sizeof(sitem.vec) * 8
+	projitem.resize(chart.parseforest.size())
+	for v in order:
+		if small:
+			sitem = chart.asSmallChartItem(v)
+			fitem = FatChartItem(sitem.label)
+			fitem.vec[0] = sitem.vec
+		else:
+			fitem = chart.asFatChartItem(v)
+		fitem.label = chart.grammar.projection[fitem.label] >> 1
+		if projitems.count(fitem) == 0:
+			m = projitems.size()
+			projitems[fitem] = m
+		projitem[v] = projitems[fitem]
+	return projitems.size()
+
+
+cdef inline bint acyclicedge(vector[size_t]& rank, ItemNo v, Edge& edge,
+		Chart chart):
+	"""Test whether the children of edge precede item in bottom-up order."""
+	if edge.rule is NULL:
+		return True
+	elif edge.rule.rhs2:
+		return (rank[chart._left(v, edge)] < rank[v]
+				and rank[chart._right(v, edge)] < rank[v])
+	return rank[chart._left(v, edge)] < rank[v]
+
+
+cdef inline tuple edgekey(vector[ItemNo]& projitem, ItemNo v, Edge& edge,
+		Chart chart):
+	"""Identify an edge by the projected labels and spans of its items."""
+	if edge.rule is NULL:
+		return (projitem[v], -1, -1)
+	elif edge.rule.rhs2:
+		return (projitem[v], projitem[chart._left(v, edge)],
+				projitem[chart._right(v, edge)])
+	return (projitem[v], projitem[chart._left(v, edge)], -1)
+
+
+cdef int bestderiv(vector[int]& bestedge, ItemNo v, Chart chart) except -1:
+	"""Add the derivation given by ``bestedge`` to ``chart.rankededges``."""
+	cdef Edge edge = chart.parseforest[v][bestedge[v]]
+	cdef int left = -1, right = -1
+	if edge.rule is not NULL:
+		left = bestderiv(bestedge, chart._left(v, edge), chart)
+		if edge.rule.rhs2:
+			right = bestderiv(bestedge, chart._right(v, edge), chart)
+	return addrankededge(v, edge, left, right, chart)
 
 
 def gettree(cells, span):
@@ -411,76 +986,150 @@ def gettree(cells, span):
 			gettree(cells, leftspan), gettree(cells, rightspan))
 
 
-cdef sldop(Chart chart, list sent, list tags, int m, int sldop_n):
+cdef sldop(Chart chart, int sldop_n):
 	"""'Proper' method for sl-dop.
 
-	Parses sentence once more to find shortest derivations, pruning away any
-	chart item not occurring in the *n* most probable parse trees; we need to
-	parse again because we have to consider all derivations for the *n* most
-	likely trees.
+	Selects the *n* most probable parse trees from the *k*-best derivations;
+	for each of these trees, the shortest derivation and the probability of
+	the tree are then obtained from all derivations in the chart consistent
+	with it, i.e., composed of the edges in the *k*-best derivations of the
+	tree (with DOP reduction, any edge with the same projected labels and
+	spans). The length of a derivation is its number of fragments, according
+	to the ``'shortest'`` weights of the grammar.
 
 	:returns: the intersection of the most probable parse trees and their
 		shortest derivations, with probabilities of the form (subtrees, prob).
-
-	NB: doesn't seem to work so well, so may contain a subtle bug.
-		Does not support PCFG charts."""
-	cdef dict derivations = {}
-	cdef dict derivs = {}
-	cdef list backtransform = chart.grammar.backtransform
-	cdef pair[RankedEdge, Prob] entry
-	cdef Chart chart2
-	cdef int n
-	cdef ItemNo root = chart.root()
+	"""
+	cdef vector[double] inside, treeprob, shortlen, shortprob
+	cdef vector[ItemNo] order, projitem
+	cdef vector[size_t] rank
+	cdef vector[int] bestedge
+	cdef vector[char] allowed
+	cdef double[:] weights
+	cdef Grammar grammar = chart.grammar
+	cdef list backtransform = grammar.backtransform
+	cdef dict derivsfortree = {}, memo = {}
+	cdef dict result = {}, treestrs = {}, derivs = {}
+	cdef set edgekeys
+	cdef RankedEdge deriv
+	cdef Edge edge
+	cdef ItemNo v, item, root = chart.root()
+	cdef double prob, viterbiprob, length
+	cdef size_t n, m, numprojitems
+	cdef size_t numderivs = chart.rankededges[root].size()
+	grammar._loadmodels()
+	weights = np.abs(np.log2(grammar.models['shortest']))
+	inside.resize(chart.parseforest.size(), -INFINITY)
+	insideprob(inside, order, root, chart)
+	rank.resize(chart.parseforest.size(), 0)
+	for n in range(order.size()):
+		rank[order[n]] = n + 1
+	projectlabels(grammar)
+	numprojitems = projectitems(projitem, order, chart)
 	# collect derivations for each parse tree
-	derivsfortree = defaultdict(set)
-	if backtransform is None:
-		derivations = dict(chart.derivations)
-		for deriv in derivations:
-			derivsfortree[REMOVEIDS.sub('', deriv)].add(deriv)
-	else:
-		for entry in chart.rankededges[root]:
-			deriv = <bytes>getderiv(root, entry.first, chart).decode('utf8')
-			derivations[deriv] = entry.second
-			derivsfortree[recoverfragments(
-					root, entry.first, chart, backtransform)].add(deriv)
+	for n in range(numderivs):
+		deriv = chart.rankededges[root][n].first
+		if backtransform is None:
+			treekey = getkey(root, deriv, chart, 1)
+		else:
+			treekey = recoverfragments(
+					root, deriv, chart, backtransform, memo)
+		derivsfortree.setdefault(treekey, []).append(n)
 	# sum over probs of derivations to get probs of parse trees
-	parsetreeprob = {tree: logprobsum([-derivations[d] for d in ds])
-			for tree, ds in derivsfortree.items()}
-	nmostlikelytrees = set(nlargest(sldop_n, parsetreeprob,
-			key=parsetreeprob.get))
-
-	model = chart.grammar.currentmodel
-	chart.grammar.switch(u'shortest', logprob=True)
-	shortestderivations, msg, chart2 = treeparsing(
-			nmostlikelytrees, sent, chart.grammar, m, backtransform, tags=tags,
-			maskrules=False)
-	if not chart2:
-		return [], 'SL-DOP couldn\'t find parse for tree'
-	result = {}
-	root = chart2.root()
-	for n, (deriv, s) in enumerate(shortestderivations):
-		entry = chart2.rankededges[root][n]
+	parsetreeprob = {tree: logprobsum([-chart.rankededges[root][n].second
+				for n in ns]) for tree, ns in derivsfortree.items()}
+	nmostlikelytrees = nlargest(sldop_n, parsetreeprob,
+			key=parsetreeprob.get)
+
+	treeprob.resize(chart.parseforest.size())
+	shortlen.resize(chart.parseforest.size())
+	shortprob.resize(chart.parseforest.size())
+	bestedge.resize(chart.parseforest.size())
+	for tree in nmostlikelytrees:
+		edgekeys = set()
+		for n in derivsfortree[tree]:
+			derivedgekeys(edgekeys, projitem, root,
+					chart.rankededges[root][n].first, chart)
+		allowed.assign(numprojitems, 0)
+		for key in edgekeys:
+			allowed[key[0]] = 1
+		# restricted pass over the chart, bottom-up
+		for v in order:
+			treeprob[v] = shortprob[v] = 0.0
+			shortlen[v] = INFINITY
+			bestedge[v] = -1
+			if not allowed[projitem[v]]:
+				continue
+			for m in range(chart.parseforest[v].size()):
+				edge = chart.parseforest[v][m]
+				if (not acyclicedge(rank, v, edge, chart)
+						or edgekey(projitem, v, edge, chart) not in edgekeys):
+					continue
+				if edge.rule is NULL:
+					prob = chart.subtreeprob(v)
+					try:
+						length = weights[
+								grammar.numrules + chart.lexruleno(v, edge)]
+					except ValueError:
+						length = 0
+				else:
+					prob = edge.rule.prob
+					length = weights[edge.rule.no]
+				prob = viterbiprob = exp(-prob) if chart.logprob else prob
+				if edge.rule is not NULL:
+					item = chart._left(v, edge)
+					prob *= treeprob[item]
+					viterbiprob *= shortprob[item]
+					length += shortlen[item]
+					if edge.rule.rhs2:
+						item = chart._right(v, edge)
+						prob *= treeprob[item]
+						viterbiprob *= shortprob[item]
+						length += shortlen[item]
+				treeprob[v] += prob
+				if length < shortlen[v] or (length == shortlen[v]
+						and viterbiprob > shortprob[v]):
+					shortlen[v] = length
+					shortprob[v] = viterbiprob
+					bestedge[v] = m
+		if bestedge[root] == -1:
+			continue
+		result[tree] = (-int(round(shortlen[root])), treeprob[root])
+		bestderiv(bestedge, root, chart)
+		deriv = chart.rankededges[root].back().first
 		if backtransform is None:
-			treestr = REMOVEIDS.sub('', deriv)
+			treestrs[tree] = keytotree(tree, grammar, 1)
+			derivs[tree] = fragmentsinderiv_str(getderiv(
+					root, deriv, chart).decode('utf8'), chart, backtransform)
 		else:
-			treestr = recoverfragments(
-					root, entry.first, chart2, backtransform)
-		if treestr in nmostlikelytrees and treestr not in result:
-			result[treestr] = (-abs(int(s / log(0.5))), parsetreeprob[treestr])
-			if backtransform is None:
-				derivs[treestr] = fragmentsinderiv_str(
-						deriv, chart2, backtransform)
-			else:
-				derivs[treestr] = fragmentsinderiv_re(
-						root, entry.first, chart2, backtransform)
-			if len(result) > sldop_n:
-				break
-	chart.grammar.switch(model, logprob=True)
+			treestrs[tree] = tree
+			derivs[tree] = fragmentsinderiv_re(
+					root, deriv, chart, backtransform)
+	chart.rankededges[root].resize(numderivs)
 	if not len(result):
 		return [], 'no matching derivation found'
 	msg = '(%d derivations, %d of %d parsetrees)' % (
-		len(derivations), min(sldop_n, len(parsetreeprob)), len(parsetreeprob))
-	return [(tree, result[tree], derivs[tree]) for tree in result], msg
+		numderivs, min(sldop_n, len(parsetreeprob)), len(parsetreeprob))
+	return [(treestrs[tree], result[tree], derivs[tree])
+			for tree in result], msg
+
+
+cdef int derivedgekeys(set result, vector[ItemNo]& projitem, ItemNo v,
+		RankedEdge& ej, Chart chart) except -1:
+	"""Collect ``edgekey()`` of each edge in a derivation."""
+	cdef RankedEdge rankededge
+	cdef ItemNo item
+	result.add(edgekey(projitem, v, ej.edge, chart))
+	if ej.edge.rule is NULL:
+		return 0
+	item = chart.left(v, ej)
+	rankededge = chart.rankededges[item][ej.left].first
+	derivedgekeys(result, projitem, item, rankededge, chart)
+	if ej.right != -1:
+		item = chart.right(v, ej)
+		rankededge = chart.rankededges[item][ej.right].first
+		derivedgekeys(result, projitem, item, rankededge, chart)
+	return 0
 
 
 cdef sldop_simple(int sldop_n, Chart chart):
@@ -493,63 +1142,74 @@ cdef sldop_simple(int sldop_n, Chart chart):
 	shortest among all possible derivations using Viterbi."""
 	cdef pair[RankedEdge, Prob] entry
 	cdef dict derivations = {}
-	cdef dict derivs = {}, keys = {}
+	cdef dict derivs = {}, keys = {}, memo = {}
 	cdef list backtransform = chart.grammar.backtransform
 	cdef int n
 	cdef ItemNo root = chart.root()
+	cdef dict numfrags = {}
 	derivsfortree = defaultdict(set)
 	# collect derivations for each parse tree
+	# the number of fragments used is the number of
+	# nodes (open parens), minus the number of interior
+	# (addressed) nodes.
 	if backtransform is None:
-		derivations = dict(chart.derivations)
-		for deriv in derivations:
-			tree = REMOVEIDS.sub('', deriv)
-			derivsfortree[tree].add(deriv)
+		projectlabels(chart.grammar)
+		for n in range(<signed>chart.rankededges[root].size()):
+			entry = chart.rankededges[root][n]
+			tree = getkey(root, entry.first, chart, 1)
+			keys[n] = n
+			derivations[n] = entry.second
+			derivsfortree[tree].add(n)
+			numfrags[n] = unaddressed(getkey(root, entry.first, chart, 0))
 	else:
 		for n in range(<signed>chart.rankededges[root].size()):
 			entry = chart.rankededges[root][n]
 			deriv = <bytes>getderiv(root, entry.first, chart).decode('utf8')
 			deriv = str(unbinarize(Tree(deriv), childchar='}'))
-			tree = recoverfragments(root, entry.first, chart, backtransform)
+			tree = recoverfragments(
+					root, entry.first, chart, backtransform, memo)
 			keys[deriv] = n
 			derivations[deriv] = entry.second
 			derivsfortree[tree].add(deriv)
+			numfrags[deriv] = deriv.count('(') - len([a for a
+					in deriv.split() if '@' in a or '}<' in a])
 
 	# sum over derivations to get parse trees
 	parsetreeprob = {tree: logprobsum([-derivations[d] for d in ds])
 			for tree, ds in derivsfortree.items()}
 	selectedtrees = nlargest(sldop_n, parsetreeprob, key=parsetreeprob.get)
 
-	# the number of fragments used is the number of
-	# nodes (open parens), minus the number of interior
-	# (addressed) nodes.
 	result = {}
 	for tree in selectedtrees:
-		score, deriv = min([
-				(deriv.count('(') - len([a for a in deriv.split()
-					if '@' in a or '}<' in a]),
-				deriv)
+		score, deriv = min([(numfrags[deriv], deriv)
 				for deriv in derivsfortree[tree]])
-		result[tree] = (-score, parsetreeprob[tree])
+		prob = parsetreeprob[tree]
 		if backtransform is None:
+			entry = chart.rankededges[root][keys[deriv]]
+			tree = keytotree(tree, chart.grammar, 1)
 			derivs[tree] = fragmentsinderiv_str(
-					deriv,
+					getderiv(root, entry.first, chart).decode('utf8'),
 					chart, backtransform)
 		else:
 			derivs[tree] = fragmentsinderiv_re(
 					root, chart.rankededges[root][keys[deriv]].first,
 					chart, backtransform)
+		result[tree] = (-score, prob)
 	msg = '(%d derivations, %d of %d parsetrees)' % (
 			len(derivations), len(result), len(parsetreeprob))
 	return [(tree, result[tree], derivs[tree]) for tree in result], msg
 
 
 cdef str recoverfragments(ItemNo root, RankedEdge deriv, Chart chart,
-		list backtransform):
+		list backtransform, dict memo=None):
 	"""Reconstruct a DOP derivation from a derivation with flattened fragments.
 
 	:param deriv: a RankedEdge representing a derivation.
 	:param backtransform: a list with fragments (as string templates)
 		corresponding to grammar rules.
+	:param memo: optionally, a dictionary to share recovered subderivations
+		across calls for derivations of the same chart; keys are pairs of
+		items and indices in ``chart.rankededges``.
 	:returns: expanded derivation as a string.
 
 	The flattened fragments in the derivation should be left-binarized.
@@ -565,21 +1225,48 @@ cdef str recoverfragments(ItemNo root, RankedEdge deriv, Chart chart,
 				chart.grammar.tolabel[chart.label(root)],
 				chart.lexidx(deriv.edge))
 	else:
-		result = recoverfragments_(root, deriv, chart, backtransform)
+		if memo is None:
+			memo = {}
+		preparsetemplates(chart.grammar)
+		result = recoverfragments_(root, deriv, chart, memo)
 	return REMOVEWORDTAGS.sub('', result)
 
 
 cdef str recoverfragments_(ItemNo v, RankedEdge deriv, Chart chart,
-		list backtransform):
+		dict memo):
 	cdef RankedEdge child
 	cdef list children = []
 	cdef vector[ItemNo] childitems
 	cdef vector[int] childranks
+	cdef list template = chart.grammar.templates[deriv.edge.rule.no]
+	cdef uint64_t key
 	cdef int n
-	cdef str frag = backtransform[deriv.edge.rule.no]  # template
-	ruleno = deriv.edge.rule.no  # FIXME only for debugging
 
-	# collect all children w/on the fly left-factored debinarization
+	collectchildren(childitems, childranks, v, deriv, chart)
+	# recursively expand all substitution sites
+	for n in range(childitems.size() - 1, -1, -1):
+		v = childitems[n]
+		key = (<uint64_t>v << 32) | <uint32_t>childranks[n]
+		if key in memo:
+			children.append(memo[key])
+			continue
+		child = chart.rankededges[v][childranks[n]].first
+		if child.edge.rule is NULL:
+			result = '(%s %d)' % (
+					chart.grammar.tolabel[chart.label(v)],
+					chart.lexidx(child.edge))
+		else:
+			result = recoverfragments_(v, child, chart, memo)
+		memo[key] = result
+		children.append(result)
+	return filltemplate(template, children)
+
+
+cdef int collectchildren(vector[ItemNo]& childitems, vector[int]& childranks,
+		ItemNo v, RankedEdge deriv, Chart chart) except -1:
+	"""Collect the substitution sites of a flattened fragment, right to left.
+
+	Performs on-the-fly left-factored debinarization."""
 	if deriv.edge.rule.rhs2:  # is there a right child?
 		# keep going while left child is part of same binarized constituent
 		# instead of looking for a binarization marker in the label string, we
@@ -601,47 +1288,40 @@ cdef str recoverfragments_(ItemNo v, RankedEdge deriv, Chart chart,
 	# left-most child
 	childitems.push_back(chart.left(v, deriv))
 	childranks.push_back(deriv.left)
-
-	# recursively expand all substitution sites
-	children = []
-	for n in range(childitems.size() - 1, -1, -1):
-		v = childitems[n]
-		child = chart.rankededges[v][childranks[n]].first
-		if child.edge.rule is NULL:
-			children.append('(%s %d)' % (
-					chart.grammar.tolabel[chart.label(v)],
-					chart.lexidx(child.edge)))
-		else:
-			children.append(
-					recoverfragments_(v, child, chart, backtransform))
-
-	# substitute results in template
-	try:  # FIXME for debugging only
-		return frag.format(*children)
-	except IndexError:
-		for n, a in enumerate(chart.grammar.backtransform):
-			print(n, chart.grammar.rulestr(chart.grammar.revrulemap[n]),
-					'\t', a)
-		print(ruleno)
-		print(frag)
-		print(children)
-		raise
-
-	# even better: build result incrementally; use a list of strings
-	# extended in recursive calls w/strings from backtransform.
-	# step 1: collect RankedEdges in a list (children);
-	# 		i.e., exctract nodes from binarized constituent.
-	# step 2: iterate over parts of template, alternately adding string from it
-	# 		and making a recursive call to insert the relevant child RankedEdge
-	# new backtransform format:
-	# backtransform[prod] = (list_of_strs, list_of_idx)
-	# backtransform[34] = (['(NP (DT ', ') (NN ', '))'], [0, 1])
-	# alternatively: (better locality?)
-	# frag = backtransform[34] = ['(NP (DT ', 0, ') (NN ', 1, '))']
-	# result += frag[0]
-	# for n in range(1, len(result), 2):
-	# 	foo(result, children[frag[n]])
-	# 	result += frag[n + 1]
+	return 0
+
+
+cdef preparsetemplates(Grammar grammar):
+	"""Preparse the templates in ``grammar.backtransform``.
+
+	Templates are split into literal strings and indices of substitution
+	sites, as in ``['(NP (DT ', 0, ') (NN ', 1, '))']``; stored in
+	``grammar.templates``, templates added to the grammar later are
+	preparsed on the next call."""
+	cdef list template
+	if grammar.templates is None:
+		grammar.templates = []
+	for frag in grammar.backtransform[len(grammar.templates):]:
+		template = None
+		if frag is not None:
+			template = []
+			for literal, field, _, _ in FORMATTER.parse(frag):
+				template.append(literal)
+				if field is not None:
+					template.append(int(field))
+			if len(template) % 2 == 0:
+				template.append('')
+		grammar.templates.append(template)
+
+
+cdef str filltemplate(list template, list children):
+	"""Substitute strings for the indices in a preparsed template."""
+	cdef list result = [template[0]]
+	cdef Py_ssize_t n
+	for n in range(1, len(template), 2):
+		result.append(children[template[n]])
+		result.append(template[n + 1])
+	return ''.join(result)
 
 
 cdef fragmentsinderiv_re(ItemNo root, RankedEdge deriv, chart,
@@ -679,34 +1359,14 @@ cdef fragmentsinderiv_re_(ItemNo v, RankedEdge deriv, Chart chart,
 	cdef Label lhs = deriv.edge.rule.lhs
 	cdef double ruleprob
 	cdef int ruleno = deriv.edge.rule.no
-	cdef str frag = backtransform[ruleno]  # template
+	cdef list template
 	cdef list tmp
 	cdef int n
 	ruleprob = (exp(-deriv.edge.rule.prob)
 			if chart.grammar.logprob else deriv.edge.rule.prob)
-
-	# collect all children w/on the fly left-factored debinarization
-	if deriv.edge.rule.rhs2:  # is there a right child?
-		# keep going while left child is part of same binarized constituent
-		# instead of looking for a binarization marker in the label string, we
-		# use the fact that such labels do not have a mapping as proxy.
-		while chart.grammar.selfmapping[deriv.edge.rule.rhs1] == 0:
-			# one of the right children
-			childitems.push_back(chart.right(v, deriv))
-			childranks.push_back(deriv.right)
-			# move on to next node in this binarized constituent
-			v = chart.left(v, deriv)
-			deriv = chart.rankededges[v][deriv.left].first
-		# last right child
-		if deriv.edge.rule.rhs2:  # is there a right child?
-			childitems.push_back(chart.right(v, deriv))
-			childranks.push_back(deriv.right)
-	elif chart.grammar.selfmapping[deriv.edge.rule.rhs1] == 0:
-		v = chart.left(v, deriv)
-		deriv = chart.rankededges[v][deriv.left].first
-	# left-most child
-	childitems.push_back(chart.left(v, deriv))
-	childranks.push_back(deriv.left)
+	preparsetemplates(chart.grammar)
+	template = chart.grammar.templates[ruleno]
+	collectchildren(childitems, childranks, v, deriv, chart)
 
 	tmp = []
 	for n in range(childitems.size() - 1, -1, -1):
@@ -720,7 +1380,7 @@ cdef fragmentsinderiv_re_(ItemNo v, RankedEdge deriv, Chart chart,
 					if '@' in chart.grammar.tolabel[chart.label(v)]
 					else yieldranges(chart.indices(v)))))
 	result.append((
-			frag.format(*tmp),
+			filltemplate(template, tmp),
 			'rel. freq: %g/%g; weight: %g' % (
 				chart.grammar.rulecounts[ruleno],
 				chart.grammar.freqmass[lhs],
@@ -968,27 +1628,38 @@ def dopparseprob(tree, sent, Grammar coarse, Grammar fine):
 	return chart[tree.bitset].get(fine.toid[tree.label], float('-inf'))
 
 
-def mcrerank(parsetrees, sent, k, trees, vocab):
+def mcrerank(parsetrees, sent, k, trees, vocab, minshared=2):
 	"""Rerank *k*-best trees using tree fragments from training treebank.
 
-	Searches for trees that share multiple fragments (multi component)."""
+	Searches for trees that share multiple fragments (multi component).
+	Each candidate is only compared to the training trees that share at least
+	``minshared`` distinct productions with it; the fragments of all
+	candidates are counted in the training treebank in a single pass."""
 	cdef list results = []
-	for derivstr, prob, _ in nlargest(k, parsetrees, key=itemgetter(1)):
-		tmp = _fragments.getctrees(
-				[(addbitsets(derivstr), sent)], vocab=vocab)
+	cdef list candidates = nlargest(k, parsetrees, key=itemgetter(1))
+	cdef list fragsets = []
+	cdef dict allfrags = {}
+	tmp = _fragments.getctrees(
+			[(addbitsets(derivstr), sent) for derivstr, _, _ in candidates],
+			vocab=vocab, index=False)
+	for n in range(len(candidates)):
 		frags = _fragments.extractfragments(
-				tmp['trees1'], 0, 0, vocab, trees,
-				disc=True, approx=False)
+				tmp['trees1'], n, n + 1, vocab, trees,
+				disc=True, approx=False, minshared=minshared)
 		frags = {frag: bitset for frag, bitset in frags.items()
 				if frag[0].count('(') > 3}
-		indices = _fragments.exactcounts(
-				list(frags.values()), tmp['trees1'], trees, indices=True)
+		for frag, bitset in frags.items():
+			allfrags.setdefault(frag, bitset)
+		fragsets.append(frags)
+	indices = dict(zip(allfrags, _fragments.exactcounts(
+			list(allfrags.values()), tmp['trees1'], trees, indices=True)))
+	for (derivstr, prob, _), frags in zip(candidates, fragsets):
 		score = 0
 		rev = defaultdict(set)
-		for frag, idx in zip(frags, indices):
+		for frag in frags:
 			# from: frag => (tree idx, freq)...
 			# to: tree idx => frags...
-			for i in idx:
+			for i in indices[frag]:
 				rev[i].add(frag)
 		for i in rev:
 			if len(rev[i]) > 1:
@@ -1074,6 +1745,7 @@ def removeadjunaries(tree):
 
 
 def test():
+	cdef Chart chart
 	from .grammar import dopreduction
 	from .containers import Grammar
 	from . import plcfrs
@@ -1103,24 +1775,59 @@ def test():
 	chart, _ = plcfrs.parse(sent, grammar, None, True)
 	assert chart
 	vitderiv, vitprob = viterbiderivation(chart)
+	derivs = lazykbest(chart, 10, structured=True)
+	assert [len(deriv) // 2 for deriv, _ in derivs] == [
+			deriv.count('(') for deriv, _ in lazykbest(chart, 10)]
+	getderivations(chart, 1000, derivstrings=False)
+	mppnostrings, _ = marginalize('mpp', chart)
 	getderivations(chart, 1000, derivstrings=True)
 	mpd, _ = marginalize('mpd', chart)
 	mpp, _ = marginalize('mpp', chart)
+	assert sorted(mpp) == sorted(mppnostrings)
+	chart.rankededges.clear()  # enumerate derivations lazily
+	assert e(marginalize('mpp', chart, k=1000)[0])[0] == e(mpp)[0]
+	chart.rankededges.clear()
+	assert e(marginalize('mpd', chart, k=1000)[0])[0] == e(mpd)[0]
+	getderivations(chart, 1000, derivstrings=True)
 	mcp, _ = marginalize('mcp', chart)
 	sldop_, _ = marginalize('sl-dop', chart, k=1000,
 			sldop_n=7, sent=sent)
 	sldopsimple, _ = marginalize('sl-dop-simple',
 			chart, k=1000, sldop_n=7, sent=sent)
 	short, _ = marginalize('shortest', chart, sent=sent)
+	getsamples(chart, 1000, seed=1)
+	mppsample, _ = marginalize('mpp-sample', chart)
+	assert e(mppsample)[0] == e(mpp)[0]
+	mrp, _ = marginalize('max-rule-product', chart)
+	mlr, _ = marginalize('max-recall', chart)
+	assert mrp[0][1] > 0 and mlr[0][1] > 0
 	print('\nvit:\t\t%s %r' % (REMOVEIDS.sub('', vitderiv),
 			exp(-vitprob)),
 		'MPD:\t\t%s %r' % e(mpd), 'MCP:\t\t%s %r' % e(mcp),
 		'MPP:\t\t%s %r' % e(mpp),
+		'MPP sampled:\t%s %r' % e(mppsample),
+		'max-rule-prod:\t%s %r' % e(mrp),
+		'max-recall:\t%s %r' % e(mlr),
 		'SL-DOP n=7:\t%s %r' % e(sldop_),
 		'simple SL-DOP:\t%s %r' % e(sldopsimple),
 		'shortest:\t%s %r' % e(short), sep='\n')
 
-
-__all__ = ['getderivations', 'marginalize', 'gettree', 'treeparsing',
-		'viterbiderivation', 'doprerank', 'dopparseprob', 'frontiernt',
-		'splitfrag', 'testconstraints']
+	# inside probabilities are computed in log space; the probability of
+	# this sentence underflows in real space. With 70 words, the parser
+	# produces a FatLCFRSChart instead of a SmallLCFRSChart.
+	grammar = Grammar([((('S', 'S', 'S'), ((0, 1),)), 1),
+			((('S', 'A'), ((0,),)), 1),
+			((('A', 'Epsilon'), ('a',)), 1),
+			((('A', 'Epsilon'), ('b',)), 1000000)], start='S')
+	for n in (60, 70):
+		chart, _ = plcfrs.parse(n * ['a'], grammar, None, True)
+		assert chart
+		getsamples(chart, 10, seed=1)
+		assert chart.rankededges[chart.root()].size() == 10
+		assert marginalize('max-rule-product', chart)[0]
+		assert marginalize('max-recall', chart)[0]
+
+
+__all__ = ['getderivations', 'getsamples', 'marginalize', 'gettree',
+		'treeparsing', 'viterbiderivation', 'doprerank', 'dopparseprob',
+		'frontiernt', 'splitfrag', 'testconstraints']
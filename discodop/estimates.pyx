@@ -9,9 +9,12 @@ The latter ported almost directly from rparse
 (except for sign reversal of log probs)."""
 
 from __future__ import print_function
+import os
+import errno
 from math import exp
 import numpy as np
-from .util import PyAgenda
+import multiprocessing
+from .util import PyAgenda, workerfunc
 
 from cython.operator cimport dereference
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
@@ -28,46 +31,12 @@ cdef extern from "<cmath>" namespace "std" nogil:
 
 include "constants.pxi"
 
+PARAMS = {}
 
-cdef class Item:
-	"""Item class used in agenda for computing the outside LR estimate."""
-	cdef int state, length, lr, gaps
-
-	def __hash__(Item self):
-		return (self.state * 1021
-				+ self.length * 571
-				+ self.lr * 311
-				+ self.gaps)
-
-	def __richcmp__(Item self, Item other, op):
-		if op == 2:
-			return (self.state == other.state and self.length == other.length
-					and self.lr == other.lr and self.gaps == other.gaps)
-		a = (self.state, self.length, self.lr, self.gaps)
-		b = (other.state, other.length, other.lr, other.gaps)
-		if op == 0:
-			return a < b
-		elif op == 1:
-			return a <= b
-		elif op == 3:
-			return a != b
-		elif op == 4:
-			return a > b
-		elif op == 5:
-			return a >= b
-
-	def __repr__(Item self):
-		return "%s(%4d, %2d, %2d, %2d)" % (self.__class__.__name__,
-				self.state, self.length, self.lr, self.gaps)
-
-
-cdef inline Item new_Item(int state, int length, int lr, int gaps):
-	cdef Item item = Item.__new__(Item)
-	item.state = state
-	item.length = length
-	item.lr = lr
-	item.gaps = gaps
-	return item
+
+cdef inline uint64_t itemkey(Label label, int length, int lr, int width):
+	"""Encode an item of the outside LR estimate as an integer."""
+	return (<uint64_t>label * width + length) * width + lr
 
 
 cdef inline double getoutside(double [:, :, :, :] outside,
@@ -233,41 +202,103 @@ cdef inline uint64_t insideconcat(uint64_t a, uint64_t b, ProbRule rule,
 
 
 def outsidelr(Grammar grammar, double [:, :] insidescores,
-		uint32_t maxlen, Label goal, double [:, :, :, :] outside):
-	"""Compute the outside SX simple LR estimate in top down fashion."""
-	cdef Item item
+		uint32_t maxlen, Label goal, double [:, :, :, :] outside,
+		int numproc=1):
+	"""Compute the outside SX simple LR estimate in top down fashion.
+
+	:param numproc: the number of processes over which sentence lengths are
+		distributed; the result does not depend on this number."""
+	cdef double [:, :, :, :] result
+	cdef int n, length, lr
+	cdef Label label
+	for n, result in outsideslices(grammar, insidescores, goal,
+			range(1, maxlen + 1), numproc):
+		for label in range(grammar.nonterminals):
+			for length in range(n + 1):
+				for lr in range(n + 1 - length):
+					outside[label, length, lr, n - length - lr] = result[
+							label, length, lr, 0]
+
+
+def outsideslices(Grammar grammar, double [:, :] insidescores, Label goal,
+		lengths, int numproc=1):
+	"""Compute outside SX simple LR estimates for several sentence lengths.
+
+	Slices for each length in ``lengths`` are computed, optionally in
+	parallel.
+
+	:returns: an iterator of tuples ``(n, outside)``, in arbitrary order, with
+		``outside`` as described for ``outsidelrslice()``."""
+	if numproc == 1:
+		for n in lengths:
+			yield n, outsideslice(grammar, insidescores, n, goal)
+		return
+	pool = multiprocessing.Pool(processes=numproc, initializer=initworker,
+			initargs=(grammar, np.asarray(insidescores), goal))
+	# longest first, since these take the most time.
+	for n, result in pool.imap_unordered(
+			mpworker, sorted(lengths, reverse=True)):
+		yield n, result
+	pool.close()
+	pool.join()
+
+
+def initworker(grammar, insidescores, goal):
+	"""Set the grammar and inside estimates for a worker process."""
+	PARAMS.update(grammar=grammar, insidescores=insidescores, goal=goal)
+
+
+@workerfunc
+def mpworker(n):
+	"""Worker function for a single sentence length."""
+	return n, outsideslice(PARAMS['grammar'], PARAMS['insidescores'], n,
+			PARAMS['goal'])
+
+
+def outsideslice(grammar, insidescores, n, goal):
+	"""Allocate and compute the outside estimates for sentence length n."""
+	result = np.empty((grammar.nonterminals, n + 1, n + 1, 1), dtype='d')
+	result[...] = np.inf
+	outsidelrslice(grammar, insidescores, n, goal, result)
+	result[0] = 0.0  # cf. projectlabels()
+	return result
+
+
+def outsidelrslice(Grammar grammar, double [:, :] insidescores,
+		int totlen, Label goal, double [:, :, :, :] outside):
+	"""Compute the outside SX simple LR estimate for a sentence length.
+
+	Estimates are for sentences of length ``totlen``; ``outside`` is indexed
+	as ``[label, length, lr, 0]``, with ``gaps = totlen - length - lr``."""
+	cdef Agenda[uint64_t, double] agenda
+	cdef pair[uint64_t, double] entry
 	cdef ProbRule rule
-	cdef double x, insidescore, current, score
-	cdef int n, totlen, addgaps, addright, leftfanout, rightfanout
-	cdef int lenA, lenB, lr, ga
+	cdef double x, insidescore, score
+	cdef int n, addgaps, addright, leftfanout, rightfanout
+	cdef int length, lr, lenA, lenB, newlr, ga, width = totlen + 1
+	cdef Label state
 	cdef size_t i
 	cdef bint stopaddleft, stopaddright
-	agenda = PyAgenda()
+	agenda.setitem(itemkey(goal, totlen, 0, width), 0.0)
+	outside[goal, totlen, 0, 0] = 0.0
 
-	for n in range(1, maxlen + 1):
-		agenda[new_Item(goal, n, 0, 0)] = 0.0
-		outside[goal, n, 0, 0] = 0.0
-	print("initialized")
-
-	while agenda:
-		item, x = agenda.popitem()
-		if len(agenda) % 10000 == 0:
-			print('agenda size: %dk top: %r, %g %s' % (
-					len(agenda) / 1000, item, exp(-x),
-					grammar.tolabel[item.state]))
-		totlen = item.length + item.lr + item.gaps
+	while not agenda.empty():
+		entry = agenda.pop()
+		x = entry.second
+		lr = entry.first % width
+		length = entry.first // width % width
+		state = entry.first // width // width
 		i = 0
-		rule = grammar.bylhs[item.state][i]
-		while rule.lhs == item.state:
+		rule = grammar.bylhs[state][i]
+		while rule.lhs == state:
 			# X -> A
 			if rule.rhs2 == 0:
 				score = rule.prob + x
-				if score < outside[rule.rhs1, item.length, item.lr, item.gaps]:
-					agenda[new_Item(rule.rhs1, item.length, item.lr, item.gaps)
-							] = score
-					outside[rule.rhs1, item.length, item.lr, item.gaps] = score
+				if score < outside[rule.rhs1, length, lr, 0]:
+					agenda.setitem(itemkey(rule.rhs1, length, lr, width), score)
+					outside[rule.rhs1, length, lr, 0] = score
 				i += 1
-				rule = grammar.bylhs[item.state][i]
+				rule = grammar.bylhs[state][i]
 				continue
 			# X -> A B
 			addgaps = addright = 0
@@ -285,21 +316,21 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 			rightfanout = grammar.fanout[rule.rhs2]
 
 			# binary-left (A is left)
-			for lenA in range(leftfanout, item.length - rightfanout + 1):
-				lenB = item.length - lenA
+			for lenA in range(leftfanout, length - rightfanout + 1):
+				lenB = length - lenA
 				insidescore = insidescores[rule.rhs2, lenB]
-				for lr in range(item.lr, item.lr + lenB + 2):  # FIXME: why 2?
-					if addright == 0 and lr != item.lr:
+				for newlr in range(lr, lr + lenB + 2):  # FIXME: why 2?
+					if addright == 0 and newlr != lr:
 						continue
-					for ga in range(leftfanout - 1, totlen + 1):
-						if (lenA + lr + ga == item.length + item.lr + item.gaps
-								and ga >= addgaps):
-							score = rule.prob + x + insidescore
-							current = outside[rule.rhs1, lenA, lr, ga]
-							if score < current:
-								agenda[new_Item(rule.rhs1, lenA, lr, ga)
-										] = score
-								outside[rule.rhs1, lenA, lr, ga] = score
+					# the total length is invariant, which determines gaps
+					ga = totlen - lenA - newlr
+					if ga < addgaps or ga < leftfanout - 1:
+						break
+					score = rule.prob + x + insidescore
+					if score < outside[rule.rhs1, lenA, newlr, 0]:
+						agenda.setitem(
+								itemkey(rule.rhs1, lenA, newlr, width), score)
+						outside[rule.rhs1, lenA, newlr, 0] = score
 
 			# X -> B A
 			addgaps = addright = 0
@@ -320,42 +351,203 @@ def outsidelr(Grammar grammar, double [:, :] insidescores,
 			addgaps -= addright
 
 			# binary-right (A is right)
-			for lenA in range(rightfanout, item.length - leftfanout + 1):
-				lenB = item.length - lenA
+			for lenA in range(rightfanout, length - leftfanout + 1):
+				lenB = length - lenA
 				insidescore = insidescores[rule.rhs1, lenB]
-				for lr in range(item.lr, item.lr + lenB + 2):  # FIXME: why 2?
-					for ga in range(rightfanout - 1, totlen + 1):
-						if (lenA + lr + ga == item.length + item.lr + item.gaps
-								and ga >= addgaps):
-							score = rule.prob + insidescore + x
-							current = outside[rule.rhs2, lenA, lr, ga]
-							if score < current:
-								agenda[new_Item(rule.rhs2, lenA, lr, ga)
-										] = score
-								outside[rule.rhs2, lenA, lr, ga] = score
+				for newlr in range(lr, lr + lenB + 2):  # FIXME: why 2?
+					ga = totlen - lenA - newlr
+					if ga < addgaps or ga < rightfanout - 1:
+						break
+					score = rule.prob + insidescore + x
+					if score < outside[rule.rhs2, lenA, newlr, 0]:
+						agenda.setitem(
+								itemkey(rule.rhs2, lenA, newlr, width), score)
+						outside[rule.rhs2, lenA, newlr, 0] = score
 			i += 1
-			rule = grammar.bylhs[item.state][i]
-		# end while rule.lhs == item.state:
+			rule = grammar.bylhs[state][i]
+		# end while rule.lhs == state:
 	# end while agenda:
 
 
-def getestimates(Grammar grammar, uint32_t maxlen, str rootlabel):
-	"""Compute table of outside SX simple LR estimates for a PLCFRS."""
+def getestimates(Grammar grammar, uint32_t maxlen, str rootlabel,
+		int numproc=1):
+	"""Compute table of outside SX simple LR estimates for a PLCFRS.
+
+	:param numproc: number of processes for the outside estimates."""
 	cdef Label goal = grammar.toid[rootlabel]
 	print("allocating outside matrix:",
 		(8 * grammar.nonterminals * (maxlen + 1) * (maxlen + 1)
 			* (maxlen + 1) / 1024 ** 2), 'MB')
 	insidescores = np.empty((grammar.nonterminals, (maxlen + 1)), dtype='d')
 	outside = np.empty((grammar.nonterminals, ) + 3 * (maxlen + 1, ), dtype='d')
-	insidescores[...] = np.NAN
+	insidescores[...] = np.nan
 	outside[...] = np.inf
 	print("getting inside estimates")
 	simpleinside(grammar, maxlen, insidescores)
 	print("getting outside estimates")
-	outsidelr(grammar, insidescores, maxlen, goal, outside)
+	outsidelr(grammar, insidescores, maxlen, goal, outside, numproc)
 	return outside
 
 
+class SXlrgapsEstimates(object):
+	"""Outside SX simple LR estimates, computed lazily per sentence length.
+
+	The total length (length + lr + gaps) of items is invariant in the
+	top-down computation, so the estimates for sentences of length ``n`` form
+	an independent slice, which is computed on first access.
+
+	:param maxlen: the maximum sentence length for which to provide estimates.
+	:param filename: if given, computed slices are stored in this ``.npy``
+		file, which is memory mapped; processes using the same file compute
+		each slice once and share it. The file is created when this object
+		is constructed, so this should be done before starting processes.
+	:param outside: instead of computing slices, take them from a dense
+		4-dimensional array as produced by ``getestimates()``."""
+
+	def __init__(self, grammar, maxlen, filename=None, outside=None):
+		self.grammar = grammar
+		self.goal = grammar.toid[grammar.start]
+		self.maxlen = maxlen
+		self.filename = filename
+		self.outside = outside
+		self.insidescores = self.mmap = None
+		self.slices = {}
+		if filename is not None:
+			self._open()
+
+	@classmethod
+	def fromfile(cls, filename, grammar):
+		"""Use a file with estimates created earlier by this class."""
+		return cls(grammar, int(np.load(filename, mmap_mode='r')[0]),
+				filename)
+
+	def getslice(self, n):
+		"""Return the estimates for sentences of length ``n``.
+
+		:returns: an array indexed as ``[label, length, lr, 0]``, with
+			``gaps = n - length - lr``; None if ``n`` exceeds ``maxlen``."""
+		if n > self.maxlen:
+			return None
+		elif n in self.slices:
+			return self.slices[n]
+		if self.mmap is None and self.filename is not None:
+			self._open()
+		shape = (self.grammar.nonterminals, n + 1, n + 1, 1)
+		if self.mmap is not None and self.mmap[n]:
+			result = self.mmap[self._offset(n):self._offset(n + 1)
+					].reshape(shape)
+		elif self.outside is not None:
+			result = np.empty(shape, dtype='d')
+			result[...] = np.inf
+			for length in range(n + 1):
+				lr = np.arange(n + 1 - length)
+				result[:, length, lr, 0] = self.outside[
+						:, length, lr, n - length - lr]
+			result[0] = 0.0
+		else:
+			result = outsideslice(self.grammar, self._insidescores(), n,
+					self.goal)
+		return self._store(n, result)
+
+	def computeall(self, numproc=1):
+		"""Compute all slices that are not available yet.
+
+		:param numproc: the number of processes to use."""
+		if self.mmap is None and self.filename is not None:
+			self._open()
+		lengths = [n for n in range(1, self.maxlen + 1)
+				if n not in self.slices
+				and (self.mmap is None or not self.mmap[n])]
+		if self.outside is None and lengths:
+			for n, result in outsideslices(self.grammar, self._insidescores(),
+					self.goal, lengths, numproc):
+				self._store(n, result)
+		for n in range(1, self.maxlen + 1):
+			self.getslice(n)
+
+	def _insidescores(self):
+		if self.insidescores is None:
+			self.insidescores = np.empty(
+					(self.grammar.nonterminals, self.maxlen + 1), dtype='d')
+			self.insidescores[...] = np.nan
+			simpleinside(self.grammar, self.maxlen, self.insidescores)
+		return self.insidescores
+
+	def _store(self, n, result):
+		if (self.mmap is not None and self.mmap.mode != 'r'
+				and not self.mmap[n]):
+			begin, end = self._offset(n), self._offset(n + 1)
+			# store slice before marking it as available.
+			self.mmap[begin:end] = result.ravel()
+			self.mmap[n] = 1
+			result = self.mmap[begin:end].reshape(result.shape)
+		self.slices[n] = result
+		return result
+
+	def _offset(self, n):
+		"""Position of the slice for sentence length ``n`` in the file.
+
+		The file starts with ``maxlen``, followed by a flag for each slice."""
+		return self.maxlen + 1 + self.grammar.nonterminals * sum(
+				(m + 1) ** 2 for m in range(1, n))
+
+	def _open(self):
+		size = self._offset(self.maxlen + 1)
+		if not os.path.exists(self.filename):
+			# create the file under a temporary name and link it into place,
+			# so that a concurrent process never truncates an existing file.
+			tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+			mmap = np.lib.format.open_memmap(
+					tmp, mode='w+', dtype='d', shape=(size, ))
+			mmap[0] = self.maxlen
+			mmap.flush()
+			del mmap
+			try:
+				os.link(tmp, self.filename)
+			except OSError as err:
+				if err.errno != errno.EEXIST:
+					raise
+			finally:
+				os.unlink(tmp)
+		if os.access(self.filename, os.W_OK):
+			self.mmap = np.load(self.filename, mmap_mode='r+')
+		else:
+			self.mmap = np.load(self.filename, mmap_mode='r')
+		if self.mmap.shape != (size, ) or self.mmap[0] != self.maxlen:
+			raise ValueError('%s: estimates do not match grammar.'
+					% self.filename)
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		if self.filename is not None:
+			state.update(mmap=None, slices={})
+		return state
+
+
+def projectlabels(Grammar grammar, Grammar coarse):
+	"""Map labels of a grammar to labels of a coarse grammar with estimates.
+
+	For example, the labels of a DOP grammar can be mapped to those of a
+	treebank grammar. Requires the mapping established by
+	``grammar.getmapping(coarse, ...)``. Labels without a counterpart in
+	``coarse`` are mapped to label 0; the estimates for label 0 are 0. This
+	applies to auxiliary labels, and to any label mapped to a coarse label
+	with a different fanout, such as a discontinuous label mapped to a
+	component label of a split-PCFG.
+
+	:returns: an array that can be passed as third element of the
+		``estimates`` tuple in ``plcfrs.parse()``."""
+	cdef Label n
+	result = np.zeros(grammar.nonterminals, dtype=np.uint32)
+	if grammar.mapping.size() != grammar.nonterminals:
+		raise ValueError('no mapping to coarse grammar.')
+	for n in range(grammar.nonterminals):
+		if (grammar.mapping[n] < coarse.nonterminals
+				and grammar.fanout[n] == coarse.fanout[grammar.mapping[n]]):
+			result[n] = grammar.mapping[n]
+	return result
+
+
 cdef inline double getpcfgoutside(dict outsidescores,
 		uint32_t maxlen, uint32_t slen, Label label, uint64_t vec):
 	"""Query for a PCFG A* estimate. For documentation purposes."""
@@ -394,6 +586,7 @@ cpdef getpcfgestimates(Grammar grammar, uint32_t maxlen, str rootlabel,
 						print("%s[%d-%d] %g" % (
 								grammar.tolabel[lhs], lspan,
 								rspan, exp(-outside[lhs, lspan, rspan])))
+	outside[0] = 0.0  # cf. projectlabels()
 	return outside
 
 
@@ -696,7 +889,7 @@ cpdef testestimates(Grammar grammar, uint32_t maxlen, str rootlabel):
 			# 		exp(insidescores[a][b]))
 	print(len(insidescores) * sum(map(len, insidescores.values())), '\n')
 	insidescores = np.empty((grammar.nonterminals, (maxlen + 1)), dtype='d')
-	insidescores[...] = np.NAN
+	insidescores[...] = np.nan
 	simpleinside(grammar, maxlen, insidescores)
 	insidescores[np.isnan(insidescores)] = np.inf
 	print("inside")
@@ -760,6 +953,13 @@ def test():
 	print(grammar, '\n')
 	testestimates(grammar, 4, 'ROOT')
 	outside = getestimates(grammar, 4, 'ROOT')
+	lazy = SXlrgapsEstimates(grammar, 4)
+	dense = SXlrgapsEstimates(grammar, 4, outside=outside)
+	for n in range(1, 5):
+		assert np.array_equal(lazy.getslice(n), dense.getslice(n)), n
+	assert lazy.getslice(5) is None
+	assert np.array_equal(getestimates(grammar, 4, 'ROOT', numproc=2),
+			outside)
 	sent = ["a", "b", "c"]
 	print("\nwithout estimates")
 	chart, msg = plcfrs.parse(sent, grammar, estimates=None)
@@ -807,5 +1007,6 @@ def test():
 	print('items avoided:', chart.numitems() - estchart.numitems())
 
 
-__all__ = ['Item', 'getestimates', 'getpcfgestimates', 'inside', 'outsidelr',
-		'simpleinside']
+__all__ = ['getestimates', 'getpcfgestimates', 'inside', 'outsidelr',
+		'outsidelrslice', 'outsideslices', 'projectlabels', 'simpleinside',
+		'SXlrgapsEstimates']
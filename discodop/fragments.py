@@ -500,6 +500,21 @@ def allfragments(trees, sents, maxdepth, maxfrontier=999):
 			disc=PARAMS['disc'], indices=PARAMS['indices'])
 
 
+def iterallfragments(trees, sents, maxdepth, maxfrontier=999):
+	"""Yield all fragments up to a certain depth, # frontiers, per tree.
+
+	:yields: for each tree, a dictionary with its fragments as keys and
+		arrays of sentence numbers as values (one for each occurrence)."""
+	PARAMS.update(disc=True, indices=True, approx=False, complete=False,
+			debug=False, adjacent=False, twoterms=None)
+	initworkersimple(trees, list(sents))
+	for n in range(PARAMS['trees1'].len):
+		yield _fragments.allfragments(PARAMS['trees1'],
+				PARAMS['vocab'], maxdepth, maxfrontier,
+				disc=PARAMS['disc'], indices=PARAMS['indices'],
+				start=n, end=n + 1)
+
+
 def altrepr(a):
 	"""Rewrite bracketed tree to alternative format.
 
@@ -605,5 +620,6 @@ def test():
 
 __all__ = ['main', 'regular', 'batch', 'readtreebanks', 'read2ndtreebank',
 		'initworker', 'initworkersimple', 'worker', 'exactcountworker',
-		'workload', 'recurringfragments', 'allfragments', 'debinarize',
+		'workload', 'recurringfragments', 'allfragments', 'iterallfragments',
+		'debinarize',
 		'printfragments', 'altrepr', 'cpu_count']
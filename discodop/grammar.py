@@ -1,24 +1,28 @@
 """Assorted functions to read off grammars from treebanks."""
 import io
+import os
 import re
 import gzip
 import codecs
+import multiprocessing
 from operator import mul, itemgetter
-from itertools import count, islice, repeat
+from itertools import count, islice, repeat, chain, groupby
 from collections import defaultdict, Counter, OrderedDict
 import numpy as np
 from .tree import (Tree, ParentedTree, ImmutableTree, DiscTree,
-		escape, unescape, brackettree, writediscbrackettree)
+		unescape, brackettree, writediscbrackettree)
 from .treebank import LEAVESRE
-from .util import openread, merge as utilmerge
+from .util import openread, workerfunc, merge as utilmerge
+from ._productions import (ProductionCounter, flattentemplate, assignids,
+		FRONTIERORTERM)
 from functools import reduce  # pylint: disable=redefined-builtin
 
 RULERE = re.compile(
 		r'(?P<RULE1>(?P<LHS1>[^ \t]+).*)\t'
 		r'(?P<WEIGHT1>(?P<FREQ1>[-.e0-9]+)(?:\/[0-9]+)?)$'
 		r'|(?P<FREQ2>[-.e0-9]+)\t(?P<RULE2>(?P<LHS2>[^ \t]+).*)$')
-FRONTIERORTERM = re.compile(r"\(([^ ]+) (([0-9]+)=([^ ()]*)(?: [0-9]+=)*)\)")
 REMOVEDEC = re.compile('[@[][^ ()]+')
+PARAMS = {}
 
 
 def lcfrsproductions(tree, sent, frontiers=False):
@@ -28,7 +32,8 @@ def lcfrsproductions(tree, sent, frontiers=False):
 	corresponding words for these indices. Always produces monotone LCFRS
 	rules. For best results, tree should be canonicalized. When ``frontiers``
 	is ``True``, frontier nodes will generate empty productions, by default
-	they are ignored.
+	they are ignored. Wrapper for the compiled
+	:class:`discodop._productions.ProductionCounter`.
 
 	>>> tree = Tree("(S (VP_2 (V 0) (ADJ 2)) (NP 1))")
 	>>> sent = "is Mary happy".split()
@@ -39,82 +44,38 @@ def lcfrsproductions(tree, sent, frontiers=False):
 	is	V Epsilon
 	happy	ADJ Epsilon
 	Mary	NP Epsilon"""
-	leaves = tree.leaves()
-	if len(set(leaves)) != len(leaves):
-		raise ValueError('indices should be unique. indices: %r\ntree: %s'
-				% (leaves, tree))
-	if not sent:
-		raise ValueError('no sentence.\ntree: %s\nindices: %r\nsent: %r'
-				% (tree.pprint(), leaves, sent))
-	if not all(isinstance(a, int) for a in leaves):
-		raise ValueError('indices should be integers.\ntree: %s\nindices: %r\n'
-				'sent: %r' % (tree.pprint(), leaves, sent))
-	if not all(0 <= a < len(sent) for a in leaves):
-		raise ValueError('indices should point to a word in the sentence.\n'
-			'tree: %s\nindices: %r\nsent: %r' % (tree.pprint(), leaves, sent))
-	rules = []
-	for st in tree.subtrees():
-		if not st:
-			raise ValueError(("Empty node. Frontier nodes should designate "
-				"which part(s) of the sentence they contribute to.\ntree:"
-				"%s\nindices: %r\nsent: %r" % (tree.pprint(), leaves, sent)))
-		# elif all(isinstance(a, int) for a in st):
-		elif isinstance(st[0], int):
-			if len(st) == 1 and sent[st[0]] is not None:  # terminal node
-				rule = ((st.label, 'Epsilon'), (escape(sent[st[0]]), ))
-			elif frontiers:
-				rule = ((st.label, ), ())
-			else:
-				continue
-			# else:
-			# 	raise ValueError(("Preterminals should dominate a single "
-			# 		"terminal; frontier nodes should dominate a sequence of "
-			# 		"indices that are None in the sentence.\n"
-			# 		"subtree: %s\nsent: %r" % (st, sent)))
-		elif all(isinstance(a, Tree) for a in st):  # isinstance(st[0], Tree):
-			# convert leaves() to bitsets
-			childleaves = [a.leaves() if isinstance(a, Tree) else [a]
-					for a in st]
-			leaves = [(idx, n) for n, child in enumerate(childleaves)
-					for idx in child]
-			leaves.sort(key=itemgetter(0), reverse=True)
-			previdx, prevparent = leaves.pop()
-			yf = [[prevparent]]
-			while leaves:
-				idx, parent = leaves.pop()
-				if idx != previdx + 1:  # a discontinuity
-					yf.append([parent])
-				elif parent != prevparent:  # switch to a different non-terminal
-					yf[-1].append(parent)
-				# otherwise terminal is part of current range
-				previdx, prevparent = idx, parent
-			nonterminals = (st.label, ) + tuple(a.label for a in st)
-			rule = (nonterminals, tuple(map(tuple, yf)))
-		else:
-			raise ValueError("Neither Tree node nor integer index:\n"
-				"%r, %r" % (st[0], type(st[0])))
-		rules.append(rule)
-	return rules
+	return ProductionCounter(frontiers).productions(tree, sent)
 
 
-def treebankgrammar(trees, sents, extrarules=None):
+def treebankgrammar(trees, sents, extrarules=None, numproc=1):
 	"""Induce a probabilistic LCFRS with relative frequencies of productions.
 
 	When trees contain no discontinuities, the result is equivalent to a
 	treebank PCFG.
 
 	:param extarules: A dictionary of productions that will be merged with the
-		grammar, with (pseudo)frequencies as values."""
-	grammar = Counter(rule for tree, sent in zip(trees, sents)
-			for rule in lcfrsproductions(tree, sent))
+		grammar, with (pseudo)frequencies as values.
+	:param numproc: number of processes to use; ``None`` or 0: use all CPUs.
+		The result does not depend on this number."""
+	grammar = Counter()
+	for counts in mapshards(_treebankcounts, trees, sents, numproc):
+		grammar.update(counts)
 	if extrarules is not None:
 		for rule in extrarules:
 			grammar[rule] += extrarules[rule]
 	return sortgrammar(grammar.items())
 
 
+def _treebankcounts(trees, sents, _start):
+	"""Count productions in a shard of a treebank."""
+	counter = ProductionCounter()
+	for tree, sent in zip(trees, sents):
+		counter.add(tree, sent)
+	return Counter(dict(counter.items()))
+
+
 def dopreduction(trees, sents, packedgraph=False, decorator=None,
-		extrarules=None):
+		extrarules=None, numproc=1):
 	"""Induce a reduction of DOP to an LCFRS.
 
 	Based on how Goodman (1996, 2003) reduces DOP to a PCFG.
@@ -124,6 +85,10 @@ def dopreduction(trees, sents, packedgraph=False, decorator=None,
 		http://aclweb.org/anthology/P10-1112
 	:param decorator: a TreeDecorator instance (packedgraph is ignored if this
 		is passed).
+	:param numproc: number of processes to use; ``None`` or 0: use all CPUs.
+		Not used with ``packedgraph`` or ``decorator``, since node IDs then
+		depend on all previous trees. The result does not depend on this
+		number.
 	:returns: a set of rules with the relative frequency estimate as
 		probabilities, and a dictionary with alternate weights."""
 	# fd: how many subtrees are headed by node X (e.g. NP or NP@1-2),
@@ -132,20 +97,15 @@ def dopreduction(trees, sents, packedgraph=False, decorator=None,
 	fd = defaultdict(int)
 	ntfd = defaultdict(int)
 	rules = defaultdict(int)
-	if decorator is None:
-		decorator = TreeDecorator(memoize=packedgraph)
-
-	# collect rules
-	for tree, sent in zip(trees, sents):
-		prods = lcfrsproductions(tree, sent)
-		dectree = decorator.decorate(tree, sent)
-		uprods = lcfrsproductions(dectree, sent)
-		nodefreq(tree, dectree, fd, ntfd)
-		for (a, avar), (b, bvar) in zip(prods, uprods):
-			assert avar == bvar
-			for c in cartpi([(x, ) if x == y else (x, y)
-					for x, y in zip(a, b)]):
-				rules[c, avar] += 1
+	if decorator is not None or packedgraph:
+		shards = [_dopreductioncounts(trees, sents, 0,
+				decorator or TreeDecorator(memoize=True))]
+	else:
+		shards = mapshards(_dopreductioncounts, trees, sents, numproc)
+	for shardrules, shardfd, shardntfd in shards:
+		for a, b in ((rules, shardrules), (fd, shardfd), (ntfd, shardntfd)):
+			for key, value in b.items():
+				a[key] += value
 	if extrarules is not None:
 		for rule in extrarules:
 			rules[rule] += extrarules[rule]
@@ -181,6 +141,64 @@ def dopreduction(trees, sents, packedgraph=False, decorator=None,
 			bon=np.array(bon, dtype=np.double))
 
 
+def _dopreductioncounts(trees, sents, start, decorator=None):
+	"""Collect the rules and node counts of DOP reduction for a shard.
+
+	The shard consists of ``trees``, starting at tree number ``start`` in the
+	treebank."""
+	fd = defaultdict(int)
+	ntfd = defaultdict(int)
+	rules = defaultdict(int)
+	if decorator is None:
+		decorator = TreeDecorator(n=start + 1)
+	for tree, sent in zip(trees, sents):
+		prods = lcfrsproductions(tree, sent)
+		dectree = decorator.decorate(tree, sent)
+		uprods = lcfrsproductions(dectree, sent)
+		nodefreq(tree, dectree, fd, ntfd)
+		for (a, avar), (b, bvar) in zip(prods, uprods):
+			assert avar == bvar
+			for c in cartpi([(x, ) if x == y else (x, y)
+					for x, y in zip(a, b)]):
+				rules[c, avar] += 1
+	return rules, fd, ntfd
+
+
+def mapshards(func, trees, sents, numproc=1):
+	"""Apply a function to contiguous shards of a treebank in parallel.
+
+	:param func: a module-level function called as
+		``func(trees, sents, start)``, with ``start`` the index of the first
+		tree of the shard.
+	:param numproc: number of processes to use; ``None`` or 0: use all CPUs.
+	:returns: a list with the result for each shard, in treebank order;
+		merging the results in this order preserves the order in which
+		items are first encountered."""
+	if numproc == 1 or len(trees) < 2:
+		return [func(trees, sents, 0)]
+	numproc = numproc or multiprocessing.cpu_count()
+	chunk = len(trees) // numproc + 1
+	pool = multiprocessing.Pool(processes=numproc,
+			initializer=_initshardworker, initargs=(trees, sents))
+	result = pool.map(_shardworker, [(func, start, start + chunk)
+			for start in range(0, len(trees), chunk)])
+	pool.close()
+	pool.join()
+	return result
+
+
+def _initshardworker(trees, sents):
+	"""Set the treebank for a worker process."""
+	PARAMS.update(trees=trees, sents=sents)
+
+
+@workerfunc
+def _shardworker(args):
+	"""Apply a function to a shard of the treebank."""
+	func, start, end = args
+	return func(PARAMS['trees'][start:end], PARAMS['sents'][start:end], start)
+
+
 def doubledop(trees, sents, debug=False, maxdepth=1,
 		maxfrontier=999, numproc=None, extrarules=None):
 	"""Extract a Double-DOP grammar from a treebank.
@@ -202,7 +220,8 @@ def doubledop(trees, sents, debug=False, maxdepth=1,
 	from .fragments import recurringfragments
 	fragments = recurringfragments(trees, sents, numproc, disc=True,
 			indices=True, maxdepth=maxdepth, maxfrontier=maxfrontier)
-	return dopgrammar(trees, fragments, debug=debug, extrarules=extrarules)
+	return dopgrammar(trees, fragments, debug=debug, extrarules=extrarules,
+			numproc=numproc)
 
 
 def dop1(trees, sents, maxdepth=4, maxfrontier=999, extrarules=None):
@@ -222,7 +241,8 @@ def dop1(trees, sents, maxdepth=4, maxfrontier=999, extrarules=None):
 	return dopgrammar(trees, fragments, extrarules=extrarules)
 
 
-def dopgrammar(trees, fragments, extrarules=None, debug=False, ids=None):
+def dopgrammar(trees, fragments, extrarules=None, debug=False, ids=None,
+		numproc=1):
 	"""Create a DOP grammar from a set of fragments and occurrences.
 
 	A second level of binarization (a normal form) is needed when fragments are
@@ -235,6 +255,8 @@ def dopgrammar(trees, fragments, extrarules=None, debug=False, ids=None):
 	:param fragments: a dictionary of fragments from binarized trees, with
 		occurrences as values (a sequence of sentence numbers with repetitions).
 	:param extrarules: Additional rules to add to the grammar.
+	:param numproc: number of processes used to flatten fragments; the IDs
+		are assigned in fragment order, so the result does not depend on it.
 	:returns: a tuple (grammar, altweights, backtransform, fragments)
 		altweights is a dictionary containing alternate weights."""
 	def getweight(frag):
@@ -266,8 +288,9 @@ def dopgrammar(trees, fragments, extrarules=None, debug=False, ids=None):
 	# binarize, turn into LCFRS productions
 	# use artificial markers of binarization as disambiguation,
 	# construct a mapping of productions to fragments
-	for frag in fragments:
-		prods, newfrag = flatten(frag, ids)
+	for frag, template in zip(fragments,
+			flattentemplates(fragments, numproc)):
+		prods, newfrag = assignids(template, ids)
 		prod = prods[0]
 		if prod[0][1] == 'Epsilon':  # lexical production
 			grammar[prod] = getweight(frag)
@@ -321,6 +344,214 @@ def dopgrammar(trees, fragments, extrarules=None, debug=False, ids=None):
 			ewe=eweweights, bon=bonweights, shortest=shortest), fragments
 
 
+def streamdop1(trees, sents, prefix, maxdepth=4, maxfrontier=999,
+		extrarules=None, chunksize=100000, tmpdir=None):
+	"""Write an all-fragments DOP1 model to files.
+
+	Fragments are extracted per tree and are not kept in memory; see
+	``writedopgrammar()`` for the files that are written and the other
+	parameters.
+
+	:param maxdepth: restrict fragments to `1 < depth < maxdepth`.
+	:param maxfrontier: limit number of frontier non-terminals; not yet
+		implemented.
+	:returns: the number of rules."""
+	from .fragments import iterallfragments
+	return writedopgrammar(trees,
+			iterallfragments(trees, sents, maxdepth, maxfrontier), prefix,
+			extrarules=extrarules, chunksize=chunksize, tmpdir=tmpdir)
+
+
+def writedopgrammar(trees, fragmentsbytree, prefix, extrarules=None,
+		chunksize=100000, tmpdir=None):
+	"""Streaming version of ``dopgrammar()`` which writes the grammar to files.
+
+	Occurrences of fragments and the resulting rules are aggregated with
+	external sorts, and IDs for binarization nodes are assigned by sorting
+	their keys, so that memory usage does not grow with the number of
+	fragments, except for the lexical rules. Fragments are flattened in sorted
+	order; aside from the IDs of binarization nodes, the result is the same as
+	that of ``dopgrammar()``.
+
+	:param fragmentsbytree: an iterable with for each tree a dictionary of
+		fragments, with occurrences as values (a sequence of sentence numbers
+		with repetitions).
+	:param prefix: the files ``prefix.{rules,lex,backtransform,fragments}.gz``
+		and ``prefix.probs.npz`` are written; the latter contains the weights
+		``ewe``, ``bon``, and ``shortest``.
+	:param chunksize: the number of items that is sorted in memory.
+	:param tmpdir: directory for temporary files.
+	:returns: the number of rules."""
+	def occurrences():
+		"""Yield tuples ``(fragment, sentno, count)``."""
+		for fragments in fragmentsbytree:
+			for frag, indices in fragments.items():
+				for idx, cnt in Counter(indices).items():
+					fragmentcount[idx] += cnt
+					yield frag, idx, cnt
+
+	def fragmentrecords():
+		"""Yield records for fragments and their binarization keys.
+
+		The records are ``(0, key, fragno, n)`` for each binarization node
+		with a key, and ``(1, fragno, frag, freq, weight, template)`` for each
+		fragment."""
+		for fragno, (frag, group) in enumerate(groupby(externalsort(
+				occurrences(), key=itemgetter(0), chunksize=chunksize,
+				tmpdir=tmpdir), key=itemgetter(0))):
+			# cf. getweight() in dopgrammar()
+			freq = ewe = 0
+			for _, idx, cnt in group:
+				freq += cnt
+				for _ in range(cnt):
+					ewe += 1 / fragmentcount[idx]
+			root = frag[1:frag.index(' ')]
+			nonterms = frag.count('(') - 1
+			weight = (freq, ewe, 2 ** -nonterms * (freq / ntfd[root]), 0.5)
+			template = flattentemplate(frag)
+			for n, key in enumerate(template[3]):
+				if key is not None:
+					yield 0, key, fragno, n
+			yield 1, fragno, frag, freq, weight, template
+
+	def keyids(records):
+		"""Yield ``(fragno, n, ID)`` for key records sorted by key.
+
+		Binarization nodes with the same key get the same ID."""
+		prev = label = None
+		for _, key, fragno, n in records:
+			if key != prev:
+				prev, label = key, next(ids)
+			yield fragno, n, label
+
+	def productions():
+		"""Yield non-lexical productions with weights and fragments."""
+		# instead of keeping an ID for each key in memory, the keys are
+		# sorted to assign IDs, which are then sorted by fragment number.
+		sections = groupby(externalsort(fragmentrecords(),
+				key=itemgetter(0, 1), chunksize=chunksize, tmpdir=tmpdir),
+				key=itemgetter(0))
+		section, group = next(sections, (None, ()))
+		labelids = ()
+		if section == 0:
+			labelids = externalsort(keyids(group), chunksize=chunksize,
+					tmpdir=tmpdir)
+			# all keys are read before the first ID is available.
+			labelids = chain([next(labelids)], labelids)
+			section, group = next(sections, (None, ()))
+		labelids = groupby(labelids, key=itemgetter(0))
+		fragids = next(labelids, (None, ()))
+		for _, fragno, frag, freq, weight, template in group:
+			if fragids[0] == fragno:
+				ids.ids = {template[3][n]: label
+						for _, n, label in fragids[1]}
+				fragids = next(labelids, (None, ()))
+			prods, newfrag = assignids(template, ids)
+			if prods[0][0][1] == 'Epsilon':  # lexical production
+				lexical[prods[0]] = weight
+				continue
+			# first binarized production gets prob. mass & the fragment
+			addsumewe(prods[0], weight[1])
+			yield prods[0], (weight, (frag, freq, newfrag))
+			for prod in prods[1:]:
+				if prod[0][1] == 'Epsilon':
+					lexical[prod] = uniformweight
+				else:
+					addsumewe(prod, uniformweight[1])
+					yield prod, (uniformweight, None)
+		for rule, x in (extrarules or {}).items():
+			if rule[0][1] == 'Epsilon':
+				a, b, c, _ = lexical.get(rule, (0, 0, 0, 0))
+				lexical[rule] = (a + x, b + x, c + x, 0.5)
+			else:
+				addsumewe(rule, x)
+				yield rule, ((x, x, x, 0.5), None)
+
+	def addsumewe(rule, ewe):
+		"""Add to the sum of EWE weights for the lhs of a rule.
+
+		A binarization node is the lhs of a single rule and is skipped."""
+		if '}<' not in rule[0][0]:
+			ntsumsewe[rule[0][0]] += ewe
+
+	def addrule(rule, weight):
+		"""Buffer a rule and its weights; write them when buffer is full."""
+		freq, ewe, bon, shortest = weight
+		buf.append((rule, freq))
+		weights['ewe'].append(ewe / ntsumsewe.get(rule[0][0], ewe))
+		weights['bon'].append(bon)
+		weights['shortest'].append(shortest)
+		if len(buf) >= chunksize:
+			flush()
+
+	def flush():
+		"""Write buffered rules and weights."""
+		rulesout.write(writegrammar(buf)[0])
+		for name, values in weights.items():
+			values.tofile(weightfiles[name])
+			del values[:]
+		del buf[:]
+
+	from array import array
+	from tempfile import TemporaryFile
+	from .util import externalsort
+	uniformweight = (1, 1, 1, 1)
+	ids = UniqueIDs()
+	fragmentcount = defaultdict(int)
+	# ntfd: frequency of a non-terminal node in treebank
+	ntfd = Counter(node.label for tree in trees for node in tree.subtrees())
+	lexical = {}
+	ntsumsewe = defaultdict(int)
+	numrules = 0
+	buf = []
+	weights = OrderedDict((name, array('d'))
+			for name in ('ewe', 'bon', 'shortest'))
+	weightfiles = {name: TemporaryFile(dir=tmpdir) for name in weights}
+	rules = externalsort(productions(), key=_sortkey, chunksize=chunksize,
+			tmpdir=tmpdir)
+	# the first sorted rule is available after all productions are read.
+	first = next(rules, None)
+	lexical = sortgrammar(lexical.items())
+	for rule, (_, ewe, _, _) in lexical:
+		ntsumsewe[rule[0][0]] += ewe
+	try:
+		with codecs.getwriter('utf8')(gzip.open('%s.rules.gz' % prefix,
+					'wb', compresslevel=1)) as rulesout, \
+				codecs.getwriter('utf8')(gzip.open(
+					'%s.backtransform.gz' % prefix, 'wb',
+					compresslevel=1)) as btout, \
+				codecs.getwriter('utf8')(gzip.open(
+					'%s.fragments.gz' % prefix, 'wb',
+					compresslevel=1)) as fragout:
+			prev = None
+			for rule, (weight, frag) in (() if first is None
+					else chain([first], rules)):
+				if rule == prev:  # binarization IDs are shared by fragments
+					continue
+				prev = rule
+				if frag is not None:
+					btout.write('%s\n' % frag[2])
+					fragout.write('%s\t%d\n' % frag[:2])
+				addrule(rule, weight)
+				numrules += 1
+			for rule, weight in lexical:
+				addrule(rule, weight)
+				numrules += 1
+			flush()
+		with codecs.getwriter('utf8')(gzip.open('%s.lex.gz' % prefix, 'wb',
+				compresslevel=1)) as out:
+			out.write(writegrammar(
+					[(rule, freq) for rule, (freq, _, _, _) in lexical])[1])
+		np.savez_compressed('%s.probs.npz' % prefix, **{
+				name: np.memmap(weightfiles[name], dtype=np.double,
+					mode='r', shape=(numrules, ))
+				for name in weights})
+	finally:
+		for a in weightfiles.values():
+			a.close()
+	return numrules
+
+
 def compiletsg(fragments):
 	"""Compile a set of weighted fragments (i.e., a TSG) into a grammar.
 
@@ -681,21 +912,22 @@ def sortgrammar(grammar, altweights=None):
 	2. non-initial binarized 2dop rules (to align the 2dop backtransform with
 		the rules in cluster 1 which introduce a new fragment)
 	3. lexical rules sorted by word"""
-	def sortkey(rule):
-		"""Sort key ``(word or '', 2dop binarized rule?, lhs)``."""
-		(nts, yf), _p = rule
-		word = yf[0] if nts[1] == 'Epsilon' else ''
-		return word, '}<' in nts[0], nts[0]
-
 	if altweights is None:
-		return sorted(grammar, key=sortkey)
+		return sorted(grammar, key=_sortkey)
 
-	idx = sorted(range(len(grammar)), key=lambda n: sortkey(grammar[n]))
+	idx = sorted(range(len(grammar)), key=lambda n: _sortkey(grammar[n]))
 	altweights = {name: weights[idx] for name, weights in altweights.items()}
 	grammar = [grammar[n] for n in idx]
 	return grammar, altweights
 
 
+def _sortkey(rule):
+	"""Sort key ``(word or '', 2dop binarized rule?, lhs)``."""
+	(nts, yf), _p = rule
+	word = yf[0] if nts[1] == 'Epsilon' else ''
+	return word, '}<' in nts[0], nts[0]
+
+
 def flatten(frag, ids):
 	r"""Auxiliary function for Double-DOP.
 
@@ -703,7 +935,8 @@ def flatten(frag, ids):
 	productions of the resulting flattened fragment. Aside from returning
 	productions, also return fragment with lexical and frontier nodes replaced
 	by a templating symbol '{n}' where n is an index.
-	Trees are in the form of strings.
+	Trees are in the form of strings. Wrapper for the compiled
+	:func:`discodop._productions.flattentemplate`.
 
 	:param frag: a tree fragment
 	:param ids: an iterator which yields unique IDs for non-terminals
@@ -721,69 +954,25 @@ def flatten(frag, ids):
 	.	$.@. Epsilon
 	>>> print(template)
 	(ROOT {0} (ROOT|<$,>_2 {1} {2}))"""
-	from .treetransforms import factorconstituent, addbitsets
-	sent = {}
-
-	def repl(x):
-		"""Add information to a frontier or terminal node.
-
-		:frontiers: ``(label indices)``
-		:terminals: ``(label@word idx)``"""
-		label = x.group(1)  # label
-		word = x.group(4)
-		if not word:
-			# indices = x.group(2).replace('=', '')
-			# return '(%s %s)' % (label, indices)
-			return x.group(0)  # (label indices)
-		idx = x.group(2)  # index
-		# (label@word idx)
-		return "(%s@%s %s)" % (label, word, idx)
-
-	def substleaf(x):
-		"""Collect word and return index."""
-		idx, word = x.split('=', 1)
-		idx = int(idx)
-		sent[idx] = word or None
-		return int(idx)
-
-	if frag.count(' ') == 1:
-		frag_ = Tree.parse(frag, parse_leaf=substleaf)
-		sent = [sent.get(n, None) for n in range(max(sent) + 1)]
-		frag = frag[:frag.index(' ')] + ' 0)'
-		return lcfrsproductions(addbitsets(frag_), sent), frag
-	# give terminals unique POS tags
-	prod = FRONTIERORTERM.sub(repl, frag)
-	# remove internal nodes, reorder
-	prod = "%s %s)" % (
-			prod[:prod.index(' ')],
-			' '.join(x.group(0) for x
-				in sorted(FRONTIERORTERM.finditer(prod),
-					key=lambda x: int(x.group(3)))))
-	prod_ = Tree.parse(prod, parse_leaf=substleaf)
-	sent = [sent.get(n, None) for n in range(max(sent) + 1)]
-	tmp = factorconstituent(addbitsets(prod_), "}",
-			factor='left', markfanout=True, markyf=True, ids=ids, threshold=2)
-	prods = lcfrsproductions(tmp, sent)
-	# remember original order of frontiers / terminals for template
-	order = {x.group(2): "{%d}" % n
-			for n, x in enumerate(FRONTIERORTERM.finditer(prod))}
-	# mark substitution sites and ensure string.
-	newtree = FRONTIERORTERM.sub(lambda x: order[x.group(2)], frag)
-	prod = prods[0]
-	if len(prod_) <= 2:
-		# normally, rules of fragments are disambiguated by binarization IDs.
-		# In case there's a fragment with only one or two frontier nodes,
-		# we add an artificial node.
-		newlabel = "%s}<%s>%s" % (prod[0][0], next(ids),
-				'' if len(prod[1]) == 1 else '_%d' % len(prod[1]))
-		prod1 = ((prod[0][0], newlabel) + prod[0][2:], prod[1])
-		# we have to determine fanout of the first nonterminal
-		# on the right hand side
-		prod2 = ((newlabel, prod[0][1]),
-			tuple((0,) for component in prod[1]
-			for a in component if a == 0))
-		prods[:1] = [prod1, prod2]
-	return prods, newtree
+	return assignids(flattentemplate(frag), ids)
+
+
+def flattentemplates(fragments, numproc=1, chunksize=1000):
+	"""Flatten a sequence of fragments, in parallel if numproc != 1.
+
+	:returns: an iterator with the results of
+		:func:`discodop._productions.flattentemplate`, in the same order as
+		``fragments``; IDs are assigned afterwards with
+		:func:`discodop._productions.assignids`."""
+	if numproc == 1:
+		yield from map(flattentemplate, fragments)
+		return
+	pool = multiprocessing.Pool(processes=numproc)
+	try:
+		yield from pool.imap(flattentemplate, fragments, chunksize)
+	finally:
+		pool.terminate()
+		pool.join()
 
 
 def nodefreq(tree, dectree, subtreefd, nonterminalfd):
@@ -1108,6 +1297,88 @@ def mean(seq):
 	return sum(seq) / len(seq)
 
 
+class QuantizedWeights(object):
+	"""Probabilities stored as negative log probabilities of lower precision.
+
+	Reduced precision saves memory with large grammars.
+
+	:param weights: a sequence of probabilities.
+	:param precision: ``'float32'``, or ``'uint16'`` to map the negative log
+		probabilities linearly onto 16-bit integers, with a scale and offset
+		for this array; the largest integer encodes a probability of zero.
+
+	>>> weights = QuantizedWeights([1, 0.5, 0.25, 0], 'uint16')
+	>>> weights.nbytes
+	8
+	>>> np.asarray(weights).round(4).tolist()
+	[1.0, 0.5, 0.25, 0.0]"""
+	def __init__(self, weights, precision='uint16'):
+		with np.errstate(divide='ignore'):
+			neglogprobs = -np.log(np.asarray(weights, dtype=np.float64))
+		self.precision = precision
+		self.scale, self.offset = 1.0, 0.0
+		if precision == 'float32':
+			self.codes = neglogprobs.astype(np.float32)
+		elif precision == 'uint16':
+			maxcode = np.iinfo(np.uint16).max
+			finite = np.isfinite(neglogprobs)
+			if finite.any():
+				self.offset = neglogprobs[finite].min()
+				self.scale = (neglogprobs[finite].max() - self.offset) / (
+						maxcode - 1) or 1.0
+			self.codes = np.empty(len(neglogprobs), dtype=np.uint16)
+			self.codes[~finite] = maxcode
+			self.codes[finite] = np.rint(
+					(neglogprobs[finite] - self.offset) / self.scale)
+		else:
+			raise ValueError('unrecognized precision: %r' % precision)
+
+	def neglogprobs(self):
+		"""Return the negative log probabilities as an array of doubles."""
+		if self.precision == 'float32':
+			return self.codes.astype(np.float64)
+		result = self.codes * self.scale + self.offset
+		result[self.codes == np.iinfo(np.uint16).max] = np.inf
+		return result
+
+	def __array__(self, dtype=None, copy=None):
+		result = np.exp(-self.neglogprobs())
+		return result if dtype is None else result.astype(dtype)
+
+	def __len__(self):
+		return len(self.codes)
+
+	@property
+	def nbytes(self):
+		"""The number of bytes used for the weights."""
+		return self.codes.nbytes
+
+
+def quantizationreport(models, precisions=('float32', 'uint16')):
+	"""Report memory use versus accuracy of quantized weights.
+
+	:param models: a mapping of names to arrays of probabilities, e.g., the
+		result of ``np.load('stage.probs.npz')``.
+	:returns: a table with the size in bytes, and the maximum absolute error
+		of the negative log probabilities and of the probabilities for each
+		model and precision."""
+	result = ['model\tprecision\tbytes\tlogprob error\tprob error']
+	for name in sorted(models):
+		weights = np.asarray(models[name], dtype=np.float64)
+		with np.errstate(divide='ignore'):
+			neglogprobs = -np.log(weights)
+		finite = np.isfinite(neglogprobs)
+		result.append('%s\tfloat64\t%d\t0\t0' % (name, weights.nbytes))
+		for precision in precisions:
+			quantized = QuantizedWeights(weights, precision)
+			logerror = np.abs(quantized.neglogprobs()[finite]
+					- neglogprobs[finite]).max() if finite.any() else 0
+			error = np.abs(np.asarray(quantized) - weights).max(initial=0)
+			result.append('%s\t%s\t%d\t%.3g\t%.3g' % (
+					name, precision, quantized.nbytes, logerror, error))
+	return '\n'.join(result)
+
+
 def grammarinfo(grammar, dump=None):
 	"""Print some statistics on a grammar, before it goes through Grammar().
 
@@ -1274,6 +1545,193 @@ def merge(filenames, outfilename, sumfunc, key):
 				utilmerge(*openfiles, key=key), len(openfiles)))
 
 
+def compactgrammar(prefix, newprefix, start='ROOT', mincount=0, minprob=0,
+		minfragfreq=0):
+	"""Prune rarely used phrasal rules from a grammar and write the result.
+
+	A phrasal rule is pruned when its count, its relative frequency, or the
+	frequency of the fragment it represents (Double-DOP, DOP1) is below the
+	given threshold. Rules introduced by the binarization of fragments (with
+	``}<`` in the LHS) and lexical rules are not pruned directly, but any rule
+	that is no longer productive or reachable from ``start`` as a result is
+	removed as well; e.g., the binarized rules and lexicalized POS tags of a
+	pruned fragment. Weights are not changed, since ``Grammar`` normalizes
+	counts; alternative weights that sum to one for each LHS are renormalized.
+
+	:param prefix: reads ``prefix.{rules,lex}.gz`` and, if they exist,
+		``prefix.probs.npz``, ``prefix.backtransform.gz``, and
+		``prefix.fragments.gz``.
+	:param newprefix: the same files are written with this prefix, as well as
+		``newprefix.rulemap.gz``, with the original rule number of each rule
+		(phrasal rules followed by lexical rules), and
+		``newprefix.labelmap.gz``, with each label and its original and new
+		label ID.
+	:returns: a tuple with the number of rules before and after pruning."""
+	with openread('%s.rules.gz' % prefix) as inp:
+		ruleslines = inp.readlines()
+	with openread('%s.lex.gz' % prefix) as inp:
+		lexlines = inp.readlines()
+	bitpar = bool(ruleslines) and re.match(
+			r'[-.e0-9]+\b', ruleslines[0]) is not None
+	rules, counts = [], []
+	for line in ruleslines:
+		fields = line.rstrip('\n').split('\t')
+		if bitpar:
+			rules.append(tuple(fields[1:]))
+			counts.append(convertweight(fields[0]))
+		else:
+			rules.append(tuple(fields[:-2]))
+			counts.append(convertweight(fields[-1]))
+	lexicon = []  # list of (word, [(tag, weight), ...])
+	for line in lexlines:
+		word, *entries = line.rstrip('\n').split('\t')
+		lexicon.append((word, [tuple(a.split(' ', 1)) for a in entries]))
+	lexrules = [(tag, convertweight(weight))
+			for _, entries in lexicon for tag, weight in entries]
+	mass = Counter()
+	for rule, cnt in chain(zip(rules, counts), lexrules):
+		mass[rule[0]] += cnt
+	fragfreqs = ()
+	if minfragfreq:
+		if not os.path.exists('%s.fragments.gz' % prefix):
+			raise ValueError('%s.fragments.gz required to prune by fragment '
+					'frequency.' % prefix)
+		with openread('%s.fragments.gz' % prefix) as inp:
+			fragfreqs = [convertweight(line[line.rindex('\t') + 1:])
+					for line in inp]
+
+	pruned = [n < len(fragfreqs) and fragfreqs[n] < minfragfreq
+			or '}<' not in rule[0] and (cnt < mincount
+				or cnt / mass[rule[0]] < minprob)
+			for n, (rule, cnt) in enumerate(zip(rules, counts))]
+	lextags = {tag for tag, _ in lexrules}
+	olduseful, oldreachable = _usefulrules(rules, (), lextags, start)
+	useful, reachable = _usefulrules(rules, pruned, lextags, start)
+	if start not in reachable:
+		raise ValueError('no rules left for start symbol %r' % start)
+	keeprules = [n for n, rule in enumerate(rules)
+			if useful[n] or not olduseful[n] and not pruned[n]]
+	keeplex = [n for n, (tag, _) in enumerate(lexrules)
+			if tag in reachable or tag not in oldreachable]
+
+	# write files
+	keepset = set(keeprules)
+	keeplexset = set(keeplex)
+	with gzip.open('%s.rules.gz' % newprefix, 'wt', encoding='utf8',
+			compresslevel=1) as out:
+		out.writelines(ruleslines[n] for n in keeprules)
+	with gzip.open('%s.lex.gz' % newprefix, 'wt', encoding='utf8',
+			compresslevel=1) as out:
+		n = 0
+		for word, entries in lexicon:
+			kept = []
+			for tag, weight in entries:
+				if n in keeplexset:
+					kept.append('%s %s' % (tag, weight))
+				n += 1
+			if kept:
+				out.write('%s\t%s\n' % (word, '\t'.join(kept)))
+	for ext in ('backtransform', 'fragments'):
+		if os.path.exists('%s.%s.gz' % (prefix, ext)):
+			with openread('%s.%s.gz' % (prefix, ext)) as inp:
+				lines = inp.readlines()
+			with gzip.open('%s.%s.gz' % (newprefix, ext), 'wt',
+					encoding='utf8', compresslevel=1) as out:
+				out.writelines(line for n, line in enumerate(lines)
+						if n in keepset)
+	ruleindex = np.array(keeprules + [len(rules) + n for n in keeplex],
+			dtype=np.int64)
+	if os.path.exists('%s.probs.npz' % prefix):
+		lhs = [rule[0] for rule in rules] + [tag for tag, _ in lexrules]
+		labelids = {label: n for n, label in enumerate(set(lhs))}
+		lhs = np.array([labelids[a] for a in lhs], dtype=np.int64)
+		models = {}
+		for name, weights in np.load('%s.probs.npz' % prefix).items():
+			sums = np.bincount(lhs, weights=weights)
+			weights = weights[ruleindex]
+			if np.allclose(sums, 1):
+				weights = weights / np.bincount(lhs[ruleindex],
+						weights=weights, minlength=len(sums))[lhs[ruleindex]]
+			models[name] = weights
+		np.savez_compressed('%s.probs.npz' % newprefix, **models)
+	oldlabels = _labelids(start, rules, lexrules)
+	newlabels = _labelids(start, [rules[n] for n in keeprules],
+			[lexrules[n] for n in keeplex])
+	with gzip.open('%s.rulemap.gz' % newprefix, 'wt', encoding='utf8',
+			compresslevel=1) as out:
+		out.writelines('%d\n' % n for n in ruleindex)
+	with gzip.open('%s.labelmap.gz' % newprefix, 'wt', encoding='utf8',
+			compresslevel=1) as out:
+		out.writelines('%s\t%d\t%d\n' % (label, oldlabels[label], n)
+				for label, n in newlabels.items())
+	return len(rules) + len(lexrules), len(ruleindex)
+
+
+def _usefulrules(rules, pruned, lextags, start):
+	"""Find the rules that are not pruned and that can be used in a parse.
+
+	Such rules have only productive labels on the right-hand side, and a
+	left-hand side reachable from ``start``.
+
+	:returns: a tuple ``(useful, reachable)``; a list with a boolean for each
+		rule, and the set of reachable labels."""
+	# productive labels: a worklist with the number of unproductive
+	# RHS labels of each rule
+	productive = set(lextags)
+	remaining = [0] * len(rules)
+	byrhs = defaultdict(list)
+	agenda = []
+	for n, rule in enumerate(rules):
+		if pruned and pruned[n]:
+			continue
+		for label in set(rule[1:]):
+			if label not in productive:
+				remaining[n] += 1
+				byrhs[label].append(n)
+		if not remaining[n]:
+			agenda.append(rule[0])
+	while agenda:
+		label = agenda.pop()
+		if label in productive:
+			continue
+		productive.add(label)
+		for n in byrhs.pop(label, ()):
+			remaining[n] -= 1
+			if not remaining[n]:
+				agenda.append(rules[n][0])
+	# reachable labels, using only rules with productive RHS labels
+	bylhs = defaultdict(list)
+	for n, rule in enumerate(rules):
+		if not (pruned and pruned[n]) and all(
+				label in productive for label in rule[1:]):
+			bylhs[rule[0]].append(n)
+	reachable = {start}
+	agenda = [start]
+	while agenda:
+		for n in bylhs.get(agenda.pop(), ()):
+			for label in rules[n][1:]:
+				if label not in reachable:
+					reachable.add(label)
+					agenda.append(label)
+	useful = [not (pruned and pruned[n]) and rule[0] in reachable
+			and all(label in productive for label in rule[1:])
+			for n, rule in enumerate(rules)]
+	return useful, reachable
+
+
+def _labelids(start, rules, lexrules):
+	"""Return the label IDs that ``Grammar`` assigns to labels of rules.
+
+	IDs are assigned in the same way as ``Grammar._convertrules()``."""
+	result = OrderedDict([('Epsilon', 0), (start, 1)])
+	for rule in rules:
+		for label in rule:
+			result.setdefault(label, len(result))
+	for tag, _ in lexrules:
+		result.setdefault(tag, len(result))
+	return result
+
+
 def addindices(frag):
 	"""Convert fragment in bracket to discbracket format."""
 	cnt = count()
@@ -1282,8 +1740,10 @@ def addindices(frag):
 
 __all__ = ['lcfrsproductions', 'treebankgrammar', 'dopreduction', 'doubledop',
 		'dop1', 'dopgrammar', 'compiletsg', 'sortgrammar', 'flatten',
-		'nodefreq', 'TreeDecorator', 'UniqueIDs', 'mean', 'addindices',
-		'rangeheads', 'ranges', 'defaultparse', 'printrule', 'cartpi',
-		'writegrammar', 'subsetgrammar', 'grammarinfo', 'grammarstats',
-		'splitweight', 'convertweight', 'stripweight', 'sumrules', 'sumlex',
-		'sumfrags', 'merge']
+		'flattentemplates', 'nodefreq', 'TreeDecorator', 'UniqueIDs', 'mean',
+		'addindices', 'rangeheads', 'ranges', 'defaultparse', 'printrule',
+		'cartpi', 'writegrammar', 'subsetgrammar', 'grammarinfo',
+		'grammarstats', 'splitweight', 'convertweight', 'stripweight',
+		'sumrules', 'sumlex', 'sumfrags', 'merge', 'mapshards', 'streamdop1',
+		'writedopgrammar', 'QuantizedWeights', 'quantizationreport',
+		'compactgrammar']
@@ -11,4 +11,17 @@ from .plcfrs cimport LCFRSChart, SmallLCFRSChart, FatLCFRSChart
 ctypedef sparse_hash_map[ItemNo, RankedEdgeAgenda[Prob]] agendas_type
 
 cdef string getderiv(ItemNo v, RankedEdge ej, Chart chart)
+cdef int getderivnodes(vector[int]& result, ItemNo v, RankedEdge ej,
+		Chart chart) except -1
 cdef collectitems(ItemNo v, RankedEdge& ej, Chart chart, itemset)
+
+
+cdef class LazyKBest:
+	cdef Chart chart
+	cdef agendas_type cand
+	cdef RankedEdgeSet explored
+	cdef vector[pair[RankedEdge, Prob]] derivations
+	cdef ItemNo root
+	cdef int k, n
+	cdef int next(self) except -2
+	cpdef finish(self)
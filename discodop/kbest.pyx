@@ -10,8 +10,12 @@ cimport cython
 from libcpp.string cimport string
 from libc.stdio cimport sprintf
 from libc.stdlib cimport abort
+from libc.string cimport memcpy
+from cpython.array cimport array, clone
 include "constants.pxi"
 
+cdef array intarray = array('i')
+
 cdef RankedEdgeAgenda[Prob] getcandidates(Chart chart, ItemNo v, int k):
 	""":returns: a heap with up to k candidate arcs starting from vertex v."""
 	# NB: the priority queue should either do a stable sort, or should
@@ -135,9 +139,12 @@ cdef inline Prob getprob(Chart chart, ItemNo v, RankedEdge& ej) except -1:
 
 
 cdef int explorederivation(ItemNo v, RankedEdge& ej, Chart chart,
-		RankedEdgeSet& explored, int depthlimit) except -2:
+		RankedEdgeSet& explored, int depthlimit, agendas_type *cand=NULL,
+		int k1=0) except -2:
 	"""Traverse derivation to ensure all 1-best RankedEdges are present.
 
+	:param cand: if given, missing 1-best RankedEdges are obtained with
+		``lazykthbest()``, such that enumeration can continue afterwards.
 	:returns: True when ``ej`` is a valid, complete derivation."""
 	cdef pair[RankedEdge, Prob] entry
 	cdef RankedEdgeAgenda[Prob] tmp
@@ -150,30 +157,42 @@ cdef int explorederivation(ItemNo v, RankedEdge& ej, Chart chart,
 		if not chart.rankededges[leftitem].size():
 			assert ej.left == 0, '%d-best edge for %s of left item missing' % (
 						ej.left, chart.itemstr(v))
-			tmp = getcandidates(chart, leftitem, 1)
-			if tmp.size() < 1:
-				abort()
-			entry = tmp.pop()
-			chart.rankededges[leftitem].push_back(entry)
-			explored.insert(entry.first)
+			if cand is not NULL:
+				lazykthbest(leftitem, 1, k1, cand[0], chart, explored,
+						depthlimit - 1)
+				if not chart.rankededges[leftitem].size():
+					abort()
+			else:
+				tmp = getcandidates(chart, leftitem, 1)
+				if tmp.size() < 1:
+					abort()
+				entry = tmp.pop()
+				chart.rankededges[leftitem].push_back(entry)
+				explored.insert(entry.first)
 		if not explorederivation(leftitem,
 				chart.rankededges[leftitem][ej.left].first,
-				chart, explored, depthlimit - 1):
+				chart, explored, depthlimit - 1, cand, k1):
 			return False
 	if ej.right != -1:
 		rightitem = chart.right(v, ej)
 		if not chart.rankededges[rightitem].size():
 			assert ej.right == 0, (('%d-best edge for right child '
 					'of %s missing') % (ej.right, chart.itemstr(v)))
-			tmp = getcandidates(chart, rightitem, 1)
-			if tmp.size() < 1:
-				abort()
-			entry = tmp.pop()
-			chart.rankededges[rightitem].push_back(entry)
-			explored.insert(entry.first)
+			if cand is not NULL:
+				lazykthbest(rightitem, 1, k1, cand[0], chart, explored,
+						depthlimit - 1)
+				if not chart.rankededges[rightitem].size():
+					abort()
+			else:
+				tmp = getcandidates(chart, rightitem, 1)
+				if tmp.size() < 1:
+					abort()
+				entry = tmp.pop()
+				chart.rankededges[rightitem].push_back(entry)
+				explored.insert(entry.first)
 		return explorederivation(rightitem,
 				chart.rankededges[rightitem][ej.right].first,
-				chart, explored, depthlimit - 1)
+				chart, explored, depthlimit - 1, cand, k1)
 	return True
 
 
@@ -218,6 +237,46 @@ cdef string getderiv(ItemNo v, RankedEdge ej, Chart chart):
 	return result  # result.decode('utf8')
 
 
+cdef int _getderivnodes(vector[int]& result, ItemNo v, RankedEdge& ej,
+		Chart chart) except -1:
+	"""Auxiliary function for ``getderivnodes()``."""
+	cdef RankedEdge rankededge
+	result.push_back(v)
+	if ej.edge.rule is NULL:  # lexical rule, left child is terminal
+		result.push_back(-1 - chart.lexidx(ej.edge))
+		return 0
+	result.push_back(ej.edge.rule.no)
+	item = chart.left(v, ej)
+	rankededge = chart.rankededges[item][ej.left].first
+	_getderivnodes(result, item, rankededge, chart)
+	if ej.right != -1:
+		item = chart.right(v, ej)
+		rankededge = chart.rankededges[item][ej.right].first
+		_getderivnodes(result, item, rankededge, chart)
+	return 0
+
+
+cdef int getderivnodes(vector[int]& result, ItemNo v, RankedEdge ej,
+		Chart chart) except -1:
+	"""Convert a RankedEdge to a derivation in the form of an integer array.
+
+	The array lists the nodes of the derivation in pre-order, with two
+	integers per node: the chart item, and the number of the rule
+	(``rule.no``), or for a lexical node, ``-1 - n`` where ``n`` is the
+	index of the terminal in the sentence. This is equivalent to the string
+	produced by ``getderiv()``, but cheaper to produce and to process."""
+	result.clear()
+	return _getderivnodes(result, v, ej, chart)
+
+
+cdef array derivarray(vector[int]& deriv):
+	"""Copy a derivation produced by ``getderivnodes()`` to an array."""
+	cdef array result = clone(intarray, deriv.size(), False)
+	if deriv.size():
+		memcpy(result.data.as_ints, &(deriv[0]), deriv.size() * sizeof(int))
+	return result
+
+
 cdef collectitems(ItemNo v, RankedEdge& ej, Chart chart, itemset):
 	"""Traverse derivation and add all item IDs to itemset."""
 	cdef RankedEdge ej1
@@ -261,7 +320,7 @@ def partitionincompletechart(
 	return results
 
 
-def lazykbest(Chart chart, int k, bint derivs=True):
+def lazykbest(Chart chart, int k, bint derivs=True, bint structured=False):
 	"""Wrapper function to run ``lazykthbest``.
 
 	Produces the ranked chart, as well as derivations as strings (when
@@ -269,11 +328,14 @@ def lazykbest(Chart chart, int k, bint derivs=True):
 	should be acyclic unless probabilities resolve the cycles (maybe nonzero
 	weights for unary productions are sufficient?).
 
-	:param k: the number of derivations to enumerate."""
+	:param k: the number of derivations to enumerate.
+	:param structured: if True, derivations are returned as integer arrays
+		instead of strings; cf. ``getderivnodes()``."""
 	cdef agendas_type cand
 	cdef RankedEdgeSet explored
 	cdef pair[RankedEdge, Prob] entry
 	cdef vector[pair[RankedEdge, Prob]] tmp
+	cdef vector[int] deriv
 	cdef ItemNo root = chart.root()
 	cdef int n = 0
 	if root not in chart:
@@ -288,10 +350,73 @@ def lazykbest(Chart chart, int k, bint derivs=True):
 		if n >= k:
 			break
 	chart.rankededges[root] = tmp
-	if derivs:
+	if derivs and structured:
+		result = []
+		for entry in chart.rankededges[root]:
+			getderivnodes(deriv, root, entry.first, chart)
+			result.append((derivarray(deriv), entry.second))
+		return result
+	elif derivs:
 		return [(getderiv(root, entry.first, chart).decode('utf8'),
 				entry.second) for entry in chart.rankededges[root]]
 	return None
 
 
-__all__ = ['lazykbest']
+cdef class LazyKBest:
+	"""Enumerate the *k*-best derivations of a chart one at a time.
+
+	Iterating yields tuples ``(deriv, logprob)`` as with ``lazykbest()``;
+	Cython code can use ``next()`` and read ``derivations`` instead, which
+	does not create strings. Once the iterator is exhausted, or after
+	``finish()``, ``chart.rankededges[chart.root()]`` contains the valid
+	derivations enumerated so far, as after ``lazykbest()``.
+
+	:param k: the maximum number of derivations to enumerate."""
+
+	def __init__(self, Chart chart, int k):
+		self.chart = chart
+		self.root = chart.root()
+		self.k = k
+		self.n = 0
+		if self.root not in chart:
+			raise ValueError('kbest: no complete derivation in chart')
+		chart.rankededges.clear()
+		chart.rankededges.resize(chart.parseforest.size())
+
+	cdef int next(self) except -2:
+		"""Enumerate the next derivation.
+
+		:returns: the index of the derivation in ``self.derivations``, or -1
+			when no derivations are left."""
+		cdef pair[RankedEdge, Prob] entry
+		while self.n < self.k:
+			lazykthbest(self.root, self.n + 1, self.k, self.cand, self.chart,
+					self.explored, MAX_DEPTH)
+			if <int>self.chart.rankededges[self.root].size() <= self.n:
+				break
+			entry = self.chart.rankededges[self.root][self.n]
+			self.n += 1
+			if explorederivation(self.root, entry.first, self.chart,
+					self.explored, MAX_DEPTH, &(self.cand), self.k):
+				self.derivations.push_back(entry)
+				return self.derivations.size() - 1
+		self.k = self.n  # exhausted
+		return -1
+
+	cpdef finish(self):
+		"""Store the derivations enumerated so far in the chart."""
+		self.chart.rankededges[self.root] = self.derivations
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		cdef int n = self.next()
+		if n == -1:
+			self.finish()
+			raise StopIteration
+		return (getderiv(self.root, self.derivations[n].first,
+				self.chart).decode('utf8'), self.derivations[n].second)
+
+
+__all__ = ['lazykbest', 'LazyKBest']
@@ -16,8 +16,9 @@ from heapq import nlargest
 from getopt import gnu_getopt, GetoptError
 from operator import itemgetter
 import pickle
+from collections import OrderedDict
 import numpy as np
-from . import plcfrs, pcfg, disambiguation
+from . import plcfrs, pcfg, disambiguation, estimates
 from . import grammar, treetransforms, treebanktransforms
 from .containers import Grammar, Vocabulary, Ctrees
 from .coarsetofine import prunechart
@@ -28,7 +29,7 @@ from .treebank import writetree, handlefunctions
 from .heads import saveheads, readheadrules, applyheadrules
 from .punctuation import punctprune, applypunct
 from .functiontags import applyfunctionclassifier
-from .util import workerfunc, openread
+from .util import workerfunc, openread, findfile
 from .treetransforms import binarizetree, binarize, splitdiscnodes
 from .grammar import UniqueIDs
 from .kbest import partitionincompletechart
@@ -100,6 +101,7 @@ DEFAULTSTAGE = dict(
 		estimates=None,  # compute, store & use outside estimates
 		collapse=None,  # optionally, collapse phrase labels for multilevel CTF
 		neverblockre=None,  # do not prune nodes with label that match regex
+		precision='float64',  # precision of weights: float64, float32, uint16
 
 		# parameters that can be changed before parsing each sentence:
 		mode='plcfrs',  # use the agenda-based PLCFRS parser
@@ -107,13 +109,20 @@ DEFAULTSTAGE = dict(
 		k=50,  # no. of coarse pcfg derivations to prune with; k=0: filter only
 		m=10,  # number of derivations to enumerate
 		estimator='rfe',  # choices: rfe, ewe
-		objective='mpp',  # choices: mpp, mpd, shortest, sl-dop[-simple]
+		objective='mpp',  # choices: mpp, mpp-sample, mpd, shortest,
+			# sl-dop[-simple], max-rule-product, max-recall
 			# NB: w/shortest derivation, estimator only affects tie breaking.
 		sldop_n=7,  # number of trees to consider when using sl-dop[-simple]
 		mcplambda=1.0,  # weight to assign to recall vs. mistake rate with mcp
 		mcplabels=None,  # optionally, set of labels to optimize for with mcp
 		beam_beta=1.0,  # beam pruning factor, between 0 and 1; 1 to disable.
 		beam_delta=40,  # maximum span length to which beam_beta is applied
+		# budget for plcfrs parsing; when exhausted, return incomplete chart
+		maxitems=0,  # maximum number of items to pop from agenda; 0: no limit
+		maxedges=0,  # maximum number of edges to add to chart; 0: no limit
+		timelimit=0,  # maximum number of seconds (wall-clock); 0: no limit
+		bucketwidth=0,  # plcfrs agenda: 0: binary heap;
+		# > 0: bucketed queue with buckets of this width (in -log prob)
 		# deprecated options
 		kbest=True, sample=False, binarized=True,
 		iterate=False, complement=False,
@@ -144,6 +153,10 @@ class DictObj(object):
 
 
 PARAMS = DictObj()  # used for multiprocessing when using CLI of this module
+# charts that can be serialized; cf. Chart.tobytes()
+CHARTTYPES = {cls.__name__: cls for cls in (
+		pcfg.DenseCFGChart, pcfg.SparseCFGChart,
+		plcfrs.SmallLCFRSChart, plcfrs.FatLCFRSChart)}
 
 
 class Parser(object):
@@ -153,9 +166,14 @@ class Parser(object):
 		:py:func:`parser.readparam()`.
 	:param funcclassifier: optionally, a function tag classifier trained by
 		:py:func:`functiontags.trainfunctionclassifier`.
+	:param cachesize: optionally, the maximum number of bytes of charts to
+		keep in a cache, so that parsing a sentence again with different
+		parameters for later stages or disambiguation can skip the earlier
+		stages; least recently used charts are evicted first.
 	"""
 
-	def __init__(self, prm, funcclassifier=None, loadtrees=False):
+	def __init__(self, prm, funcclassifier=None, loadtrees=False,
+			cachesize=0):
 		self.prm = prm
 		self.stages = prm.stages
 		self.transformations = prm.transformations
@@ -181,6 +199,10 @@ class Parser(object):
 			if prm.verbosity >= 3:
 				print(stage.name)
 				print(stage.grammar)
+		self.cachesize = cachesize
+		self.cache = OrderedDict()  # key => serialized chart
+		self.cachebytes = 0
+		self.fingerprints = {}  # stage name => grammar.fingerprint()
 		self.ctrees = self.newctrees = self.vocab = None
 		self.phrasallabels = self.functiontags = self.poslabels = None
 		if loadtrees:
@@ -242,7 +264,7 @@ class Parser(object):
 		self.cnt = 0
 
 	def parse(self, sent, tags=None, root=None, goldtree=None,
-			require=(), block=()):
+			require=(), block=(), fromchart=None, keepcharts=None):
 		"""Parse a sentence and perform postprocessing.
 
 		Yields a dictionary from parse trees to probabilities for each stage.
@@ -257,7 +279,12 @@ class Parser(object):
 			parse trees containing these labeled spans will be returned.
 			For example, ``('NP', [0, 1, 2])``.
 		:param block: optionally, a list of tuples ``(label, indices)``;
-			these labeled spans will be pruned."""
+			these labeled spans will be pruned.
+		:param fromchart: optionally, a chart for the last stage, e.g., as
+			stored with ``Chart.tobytes()``; instead of parsing, only
+			disambiguation and postprocessing are performed.
+		:param keepcharts: optionally, a dictionary in which the chart of
+			each stage is stored, with the name of the stage as key."""
 		if 'PUNCT-PRUNE' in (self.transformations or ()):
 			origsent = sent[:]
 			punctprune(None, sent)
@@ -294,7 +321,10 @@ class Parser(object):
 		partialparse = False
 		# parse with each coarse-to-fine stage
 		for n, stage in enumerate(self.stages):
+			if fromchart is not None and n + 1 < len(self.stages):
+				continue
 			begin = process_time()
+			chart = None
 			noparse = False
 			parsetrees = fragments = None
 			golditems = 0
@@ -311,7 +341,28 @@ class Parser(object):
 			# do parsing; if CTF pruning enabled, require parent stage to
 			# be successful.
 			splitprune = False
-			if sent and (not stage.prune or charts[stage.prune]):
+			cachekey = None
+			if (self.cachesize and sent and fromchart is None
+					and stage.mode in ('pcfg', 'plcfrs')):
+				cachekey = repr((sent, tags, root, sorted(require or ()),
+						sorted(block or ()), [self.stagekey(a)
+							for a in self.stages[:n + 1]]))
+			if fromchart is not None:
+				if stage.mode in ('dop-rerank', 'mc-rerank'):
+					raise ValueError('cannot rerank stored chart.')
+				elif fromchart.sent != sent:
+					raise ValueError('chart does not match sentence: %s'
+							% ' '.join(fromchart.sent))
+				chart = fromchart
+				tree = goldtree if not stage.split else None
+				msg += 'chart loaded: %s\n\t' % chart.stats()
+			elif cachekey is not None and cachekey in self.cache:
+				self.cache.move_to_end(cachekey)
+				chart = chartfrombytes(self.cache[cachekey], stage.grammar,
+						self.fingerprint(stage))
+				tree = goldtree if not stage.split else None
+				msg += 'chart from cache: %s\n\t' % chart.stats()
+			elif sent and (not stage.prune or charts[stage.prune]):
 				prevn = 0
 				if stage.prune:
 					prevn = [a.name for a in self.stages].index(stage.prune)
@@ -353,13 +404,20 @@ class Parser(object):
 							splitprune=splitprune,
 							markorigin=self.stages[prevn].markorigin,
 							estimates=(stage.estimates, stage.outside)
+								+ ((stage.estimatelabels, )
+									if stage.estimatelabels is not None
+									else ())
 								if stage.estimates in ('SX', 'SXlrgaps')
 								else None,
 							beam_beta=-log(stage.beam_beta),
 							beam_delta=stage.beam_delta,
 							itemsestimate=estimateitems(
 								sent, stage.prune, stage.mode, stage.dop),
-							postagging=self.postagging)
+							postagging=self.postagging,
+							maxitems=stage.maxitems,
+							maxedges=stage.maxedges,
+							timelimit=stage.timelimit,
+							bucketwidth=stage.bucketwidth)
 				elif stage.mode == 'dop-rerank':
 					if prevparsetrees[stage.prune]:
 						parsetrees, msg1 = disambiguation.doprerank(
@@ -387,12 +445,16 @@ class Parser(object):
 							'pruning' % (golditems, totalgolditems))
 				msg += '%s\n\t' % msg1
 				if (n > 0 and stage.prune and not chart and not noparse
+						and not getattr(chart, 'incomplete', False)
 						and stage.split == self.stages[prevn].split):
 					logging.error('ERROR: expected successful parse;\n'
 							'sent: %s\nstage %d: %s',
 							' '.join(sent), n, stage.name)
 					# raise ValueError('ERROR: expected successful parse. '
 					# 		'sent %s, %s.' % (nsent, stage.name))
+				if cachekey is not None:
+					self.addtocache(cachekey,
+							chart.tobytes(self.fingerprint(stage)))
 			numitems = chart.numitems() if hasattr(chart, 'numitems') else 0
 
 			if self.verbosity >= 3 and chart:
@@ -403,14 +465,21 @@ class Parser(object):
 			if (sent and chart and stage.mode not in ('dop-rerank', 'mc-rerank')
 					and not (self.relationalrealizational and stage.split)):
 				begindisamb = process_time()
-				disambiguation.getderivations(
-						chart, stage.m,
-						derivstrings=stage.dop not in ('doubledop', 'dop1')
-								or stage.objective == 'mcp'
-								or self.verbosity >= 3)
-				if self.verbosity >= 3:
-					print('%d-best derivations:\n%s' % (
-						min(stage.m, 100),
+				sample = stage.dop and stage.objective == 'mpp-sample'
+				if sample:
+					disambiguation.getsamples(
+							chart, stage.m,
+							derivstrings=stage.dop == 'ostag'
+									or self.verbosity >= 3)
+				elif not self.lazyderivations(stage):
+					disambiguation.getderivations(
+							chart, stage.m,
+							derivstrings=stage.dop == 'ostag'
+									or self.verbosity >= 3)
+				if self.verbosity >= 3 and chart.derivations:
+					print('%s derivations:\n%s' % (
+						('%d sampled' if sample
+							else '%d-best') % min(stage.m, 100),
 						'\n'.join('%d. %s %s' % (n + 1,
 							('subtrees=%d' % abs(int(prob / log(0.5))))
 							if stage.objective == 'shortest'
@@ -452,7 +521,7 @@ class Parser(object):
 							if chart.itemid(node.label, node.leaves()))
 					msg += ('%d/%d gold items in derivations\n\t' % (
 							golditems, totalgolditems))
-			elif (sent and not chart
+			elif (sent and chart is not None and not chart
 					and stage.mode not in ('dop-rerank', 'mc-rerank')
 					and not (self.relationalrealizational and stage.split)
 					and not partialparse):  # sentence could not be parsed
@@ -494,6 +563,9 @@ class Parser(object):
 			if stage.name in (stage.prune for stage in self.stages):
 				charts[stage.name] = chart
 				prevparsetrees[stage.name] = parsetrees
+			if keepcharts is not None and stage.mode not in (
+					'dop-rerank', 'mc-rerank'):
+				keepcharts[stage.name] = chart
 
 			# postprocess, yield result
 			if parsetrees:
@@ -532,6 +604,51 @@ class Parser(object):
 					totalgolditems=totalgolditems, msg=msg)
 		del charts, prevparsetrees
 
+	def stagekey(self, stage):
+		"""Return the parameters of a stage that affect its chart."""
+		names = [a.name for a in self.stages]
+		n = names.index(stage.name)
+		prevn = names.index(stage.prune) if stage.prune else 0
+		splitprune = bool(stage.prune and not stage.split
+				and self.stages[prevn].split)
+		exhaustive = bool(stage.dop or (n + 1 != len(self.stages)
+				and self.stages[n + 1].prune))
+		return (stage.name, stage.mode, stage.prune, stage.k,
+				stage.estimator, stage.objective == 'shortest',
+				stage.estimates, stage.split, splitprune,
+				self.stages[prevn].markorigin, exhaustive,
+				stage.beam_beta, stage.beam_delta, stage.maxitems,
+				stage.maxedges, stage.timelimit, stage.bucketwidth)
+
+	def fingerprint(self, stage):
+		"""Return the fingerprint of the grammar of a stage."""
+		if stage.name not in self.fingerprints:
+			self.fingerprints[stage.name] = stage.grammar.fingerprint()
+		return self.fingerprints[stage.name]
+
+	def addtocache(self, key, data):
+		"""Add serialized chart to cache; evict least recently used charts.
+
+		Charts are evicted while the cache exceeds its maximum size."""
+		self.cache[key] = data
+		self.cachebytes += len(data)
+		while self.cachebytes > self.cachesize:
+			_, data = self.cache.popitem(last=False)
+			self.cachebytes -= len(data)
+
+	def lazyderivations(self, stage):
+		"""Test whether disambiguation of stage extracts derivations itself.
+
+		I.e., derivations are enumerated lazily, or not at all."""
+		objective = stage.objective if stage.dop else 'mpd'
+		if objective in ('max-rule-product', 'max-recall'):
+			return True
+		return (objective in ('mpp', 'mpd') and stage.dop != 'ostag'
+				and self.verbosity < 3
+				and not any(a.prune == stage.name
+					and a.mode in ('dop-rerank', 'mc-rerank')
+					for a in self.stages))
+
 	def postprocess(self, treestr, sent, stage):
 		"""Take parse tree and apply postprocessing."""
 		parsetree = ParentedTree(treestr)
@@ -580,6 +697,9 @@ class Parser(object):
 		if not newtrees:
 			return
 		prm = self.prm
+		self.cache.clear()
+		self.cachebytes = 0
+		self.fingerprints.clear()
 		newtrees = [a.copy(True) for a in newtrees]  # will modify in-place
 		for tree, sent in zip(newtrees, newsents):
 			treebanktransforms.transform(tree, sent, prm.transformations)
@@ -696,11 +816,14 @@ class Parser(object):
 
 
 def readgrammars(resultdir, stages, postagging=None,
-		transformations=None, top='ROOT', cache=False):
+		transformations=None, top='ROOT', cache=False, numproc=1):
 	"""Read the grammars from a previous experiment.
 
 	Expects a directory ``resultdir`` which contains the relevant grammars and
-	the parameter file ``params.prm``, as produced by ``runexp``."""
+	the parameter file ``params.prm``, as produced by ``runexp``. Grammar files
+	may be compressed with gzip, lz4, zstd, or uncompressed.
+
+	:param numproc: number of processes to parse large rule files with."""
 	if os.path.exists('%s/mapping.json.gz' % resultdir):
 		mappings = json.load(openread('%s/mapping.json.gz' % resultdir))
 		for stage, mapping in zip(stages, mappings):
@@ -719,8 +842,8 @@ def readgrammars(resultdir, stages, postagging=None,
 		backtransform = outside = None
 		prevn = 0
 		if stage.mode != 'mc-rerank':
-			rules = '%s/%s.rules.gz' % (resultdir, stage.name)
-			lexicon = '%s/%s.lex.gz' % (resultdir, stage.name)
+			rules = findfile('%s/%s.rules' % (resultdir, stage.name))
+			lexicon = findfile('%s/%s.lex' % (resultdir, stage.name))
 			probsfile = '%s/%s.probs.npz' % (resultdir, stage.name)
 			if not os.path.exists(probsfile):
 				probsfile = None
@@ -729,10 +852,12 @@ def readgrammars(resultdir, stages, postagging=None,
 						resultdir, stage.name)).read().splitlines()
 			if cache and os.path.exists('%s/%s.g' % (resultdir, stage.name)):
 				gram = Grammar.frombinfile('%s/%s.g' % (resultdir, stage.name),
-						rules, lexicon, backtransform=backtransform)
+						rules, lexicon, backtransform=backtransform,
+						precision=stage.precision)
 			else:
 				gram = Grammar(rules, lexicon, start=top, altweights=probsfile,
-						backtransform=backtransform)
+						backtransform=backtransform, precision=stage.precision,
+						numproc=numproc)
 				if cache:
 					gram.tobinfile('%s/%s.g' % (resultdir, stage.name))
 		if n and stage.prune:
@@ -741,8 +866,6 @@ def readgrammars(resultdir, stages, postagging=None,
 			gram = pickle.loads(gzip.open('%s/%s.train.pickle.gz' % (
 					resultdir, stage.name), 'rb').read())
 		elif stage.dop:
-			if stage.estimates is not None:
-				raise ValueError('not supported')
 			if stage.dop in ('doubledop', 'dop1'):
 				# recoverfragments() relies on this mapping to identify
 				# binarization nodes. treeparsing() relies on this as well.
@@ -767,13 +890,6 @@ def readgrammars(resultdir, stages, postagging=None,
 					if stage.mode == 'dop-rerank':
 						gram.getrulemapping(stages[prevn].grammar,
 								re.compile(r'@[-0-9]+\b'))
-				if stage.objective == 'sl-dop':  # needed for treeparsing()
-					_ = gram.getmapping(
-							None, striplabelre=re.compile(r'@[-0-9]+\b'),
-							debug=False)
-					# only need rulemapping for dop reduction,
-					# defaults to 1-1 mapping otherwise.
-					gram.getrulemapping(gram, re.compile(r'@[-0-9]+\b'))
 		else:  # not stage.dop
 			if n and stage.prune:
 				_ = gram.getmapping(stages[prevn].grammar,
@@ -782,21 +898,39 @@ def readgrammars(resultdir, stages, postagging=None,
 					splitprune=not stage.split and stages[prevn].split,
 					markorigin=stages[prevn].markorigin,
 					mapping=stage.mapping, debug=False)
-			if stage.estimates in ('SX', 'SXlrgaps'):
-				if stage.estimates == 'SX' and gram.maxfanout != 1:
-					raise ValueError('SX estimate requires PCFG.')
-				if stage.mode != 'plcfrs':
-					raise ValueError('estimates require parser w/agenda.')
+		labelmap = None
+		if stage.estimates in ('SX', 'SXlrgaps'):
+			estgram = gram
+			if stage.dop:
+				if not (n and stage.prune) or stages[prevn].dop:
+					raise ValueError('estimates for DOP stage require '
+							'pruning with non-DOP stage.')
+				estgram = stages[prevn].grammar
+				labelmap = estimates.projectlabels(gram, estgram)
+			if stage.estimates == 'SX' and estgram.maxfanout != 1:
+				raise ValueError('SX estimate requires PCFG.')
+			if stage.mode != 'plcfrs':
+				raise ValueError('estimates require parser w/agenda.')
+			filename = '%s/%s.outside.npy' % (resultdir, stage.name)
+			if not os.path.exists(filename):  # older format
 				outside = np.load('%s/%s.outside.npz' % (
 						resultdir, stage.name))['outside']
-				logging.info('loaded %s estimates', stage.estimates)
-			elif stage.estimates:
-				raise ValueError('unrecognized value; specify SX or SXlrgaps.')
+				if stage.estimates == 'SXlrgaps':
+					outside = estimates.SXlrgapsEstimates(
+							estgram, outside.shape[1] - 1, outside=outside)
+			elif stage.estimates == 'SXlrgaps':
+				outside = estimates.SXlrgapsEstimates.fromfile(
+						filename, estgram)
+			else:
+				outside = np.load(filename, mmap_mode='r')
+			logging.info('loaded %s estimates', stage.estimates)
+		elif stage.estimates:
+			raise ValueError('unrecognized value; specify SX or SXlrgaps.')
 
 		if stage.mode != 'mc-rerank':
 			_sumsto1, msg = gram.testgrammar()
 		logging.info('%s: %s', stage.name, msg)
-		stage.update(grammar=gram, outside=outside)
+		stage.update(grammar=gram, outside=outside, estimatelabels=labelmap)
 	if postagging and postagging.method == 'unknownword':
 		postagging.unknownwordfun = UNKNOWNWORDFUNC[postagging.model]
 		postagging.lexicon = {w for w in stages[0].grammar.getwords()
@@ -886,8 +1020,9 @@ def readparam(filename):
 					and stage.objective == 'mpp')
 		if stage.dop:
 			assert stage.estimator in ('rfe', 'ewe', 'bon')
-			assert stage.objective in ('mpp', 'mpd', 'mcp', 'shortest',
-					'sl-dop', 'sl-dop-simple')
+			assert stage.objective in ('mpp', 'mpp-sample', 'mpd', 'mcp',
+					'max-rule-product', 'max-recall', 'shortest', 'sl-dop',
+					'sl-dop-simple')
 	assert params['binarization'].method in (
 			None, 'default', 'optimal', 'optimalhead')
 	postagging = params['postagging']
@@ -912,6 +1047,22 @@ def readparam(filename):
 	return DictObj(params)
 
 
+def loadchart(filename, grammar, fingerprint=None):
+	"""Load a chart stored with ``Chart.tobytes()``.
+
+	:param grammar: the grammar with which the chart was produced."""
+	with open(filename, 'rb') as inp:
+		return chartfrombytes(inp.read(), grammar, fingerprint)
+
+
+def chartfrombytes(data, grammar, fingerprint=None):
+	"""Load a chart serialized with ``Chart.tobytes()``, of any type."""
+	name = data[:data.index(b'\n')].decode('ascii')
+	if name not in CHARTTYPES:
+		raise ValueError('unknown chart type: %r' % name)
+	return CHARTTYPES[name].frombytes(data, grammar, fingerprint)
+
+
 def readinputbitparstyle(infile):
 	"""Yields lists of tokens, where '\\n\\n' identifies a sentence break.
 
@@ -928,11 +1079,19 @@ def readinputbitparstyle(infile):
 
 
 def initworker(parser, printprob, usetags, numparses,
-		fmt, morphology):
+		fmt, morphology, savecharts=None, fromcharts=None):
 	"""Load parser for a worker process."""
 	PARAMS.update(parser=parser, printprob=printprob,
 			usetags=usetags, numparses=numparses, fmt=fmt,
-			morphology=morphology)
+			morphology=morphology, savecharts=savecharts,
+			fromcharts=fromcharts, fingerprints={})
+
+
+def grammarfingerprint(grammar):
+	"""Return the fingerprint of a grammar, memoized in a worker."""
+	if id(grammar) not in PARAMS.fingerprints:
+		PARAMS.fingerprints[id(grammar)] = grammar.fingerprint()
+	return PARAMS.fingerprints[id(grammar)]
 
 
 @workerfunc
@@ -953,7 +1112,28 @@ def worker(args):
 	if PARAMS.usetags:
 		sent, tags = zip(*(a.rsplit('/', 1) for a in sent))
 	msg = 'parsing %s: %s' % (key, ' '.join(sent))
-	result = list(PARAMS.parser.parse(sent, tags=tags))[-1]
+	charts = {} if PARAMS.savecharts else None
+	fromchart = result = None
+	if PARAMS.fromcharts:
+		stage = PARAMS.parser.stages[-1]
+		filename = os.path.join(PARAMS.fromcharts, '%s.chart' % key)
+		try:
+			fromchart = loadchart(filename, stage.grammar,
+					grammarfingerprint(stage.grammar))
+		except FileNotFoundError:
+			msg += '\nchart not found: %s' % filename
+			parsetree, prob, noparse = PARAMS.parser.noparse(
+					stage, sent, tags, None, len(PARAMS.parser.stages) - 1)
+			result = DictObj(name=stage.name, parsetree=parsetree,
+					prob=prob, parsetrees=[], noparse=noparse)
+	if result is None:
+		result = list(PARAMS.parser.parse(sent, tags=tags,
+				fromchart=fromchart, keepcharts=charts))[-1]
+	if charts and charts.get(result.name) is not None:
+		chart = charts[result.name]
+		with open(os.path.join(
+				PARAMS.savecharts, '%s.chart' % key), 'wb') as out:
+			out.write(chart.tobytes(grammarfingerprint(chart.grammar)))
 	output = ''
 	if result.noparse:
 		msg += '\nNo parse for "%s"' % ' '.join(sent)
@@ -985,8 +1165,14 @@ def worker(args):
 
 
 def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
-		numproc, fmt, morphology, sentid):
-	"""Parse sentences from file and write results to file, log to stdout."""
+		numproc, fmt, morphology, sentid, savecharts=None, fromcharts=None):
+	"""Parse sentences from file and write results to file, log to stdout.
+
+	:param savecharts: optionally, a directory in which the chart of the last
+		stage is stored for each sentence.
+	:param fromcharts: optionally, a directory with charts stored with
+		``savecharts``; instead of parsing, only disambiguation and
+		postprocessing of the last stage are performed."""
 	times = []
 	unparsed = 0
 	if not oneline:
@@ -995,14 +1181,17 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
 		infile = (line.split('|', 1) for line in infile if line.strip())
 	else:
 		infile = enumerate((line for line in infile if line.strip()), 1)
+	if savecharts and not os.path.exists(savecharts):
+		os.mkdir(savecharts)
 	if numproc == 1:
-		initworker(parser, printprob, usetags, numparses, fmt, morphology)
+		initworker(parser, printprob, usetags, numparses, fmt, morphology,
+				savecharts, fromcharts)
 		mymap, myworker = map, worker
 	else:
 		pool = multiprocessing.Pool(
 				processes=numproc, initializer=initworker,
 				initargs=(parser, printprob, usetags, numparses, fmt,
-					morphology))
+					morphology, savecharts, fromcharts))
 		mymap, myworker = pool.map, mpworker
 	for output, noparse, sec, msg in mymap(myworker, infile):
 		if output:
@@ -1023,7 +1212,8 @@ def doparsing(parser, infile, out, printprob, oneline, usetags, numparses,
 def main():
 	"""Handle command line arguments."""
 	flags = 'help prob tags sentid simple'.split()
-	options = flags + 'obj= bt= numproc= fmt= verbosity='.split()
+	options = flags + ('obj= bt= numproc= fmt= verbosity= '
+			'savecharts= fromcharts=').split()
 	try:
 		opts, args = gnu_getopt(sys.argv[2:], 'hb:s:m:x', options)
 	except GetoptError as err:
@@ -1053,7 +1243,8 @@ def main():
 		backtransform = None
 		if opts.get('--bt'):
 			backtransform = openread(opts.get('--bt')).read().splitlines()
-		gram = Grammar(rules, lexicon, start=top, backtransform=backtransform)
+		gram = Grammar(rules, lexicon, start=top, backtransform=backtransform,
+				numproc=int(opts.get('--numproc', 1)) or None)
 		mode = 'pcfg' if gram.maxfanout == 1 else 'plcfrs'
 		stages = []
 		stage = DEFAULTSTAGE.copy()
@@ -1085,7 +1276,8 @@ def main():
 		params = readparam(os.path.join(directory, 'params.prm'))
 		params.update(resultdir=directory)
 		readgrammars(directory, params.stages, params.postagging,
-				params.transformations, top=getattr(params, 'top', top))
+				params.transformations, top=getattr(params, 'top', top),
+				numproc=int(opts.get('--numproc', 1)) or None)
 		params.update(verbosity=int(opts.get('--verbosity', params.verbosity)))
 		parser = Parser(params)
 		morph = params.morphology
@@ -1095,8 +1287,9 @@ def main():
 				else sys.stdout.fileno(), 'w', encoding='utf8') as out:
 			doparsing(parser, infile, out, prob, oneline, tags, numparses,
 					int(opts.get('--numproc', 1)),
-					opts.get('--fmt', 'discbracket'), morph, sentid)
+					opts.get('--fmt', 'discbracket'), morph, sentid,
+					opts.get('--savecharts'), opts.get('--fromcharts'))
 
 
-__all__ = ['DictObj', 'Parser', 'doparsing', 'initworker', 'probstr',
-		'readgrammars', 'readinputbitparstyle', 'readparam']
+__all__ = ['DictObj', 'Parser', 'doparsing', 'initworker', 'loadchart',
+		'probstr', 'readgrammars', 'readinputbitparstyle', 'readparam']
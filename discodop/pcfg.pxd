@@ -1,5 +1,6 @@
 cimport cython
 from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from libc.string cimport memcpy
 from libcpp.vector cimport vector
 from libcpp.utility cimport pair
 from cpython.dict cimport PyDict_Contains, PyDict_GetItem
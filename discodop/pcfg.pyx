@@ -39,6 +39,14 @@ cdef class CFGChart(Chart):
 		"""Return probability of subtree headed by item."""
 		raise NotImplementedError
 
+	cdef bytes _itemstobytes(self):
+		return (<char *>&self.items[0])[
+				:self.items.size() * sizeof(uint64_t)]
+
+	cdef _itemsfrombytes(self, bytes data):
+		self.items.resize(len(data) // sizeof(uint64_t))
+		memcpy(&self.items[0], <char *>data, len(data))
+
 
 @cython.final
 cdef class DenseCFGChart(CFGChart):
@@ -324,6 +332,12 @@ cdef class SparseCFGChart(CFGChart):
 		return self.itemindex[cellstruct(
 				edge.pos.mid, item.st.end) + edge.rule.rhs2]
 
+	cdef _itemsfrombytes(self, bytes data):
+		cdef ItemNo n
+		CFGChart._itemsfrombytes(self, data)
+		for n in range(self.items.size()):
+			self.itemindex[self.items[n]] = n
+
 	cdef Label _label(self, uint64_t item):
 		cdef CFGItem itemx
 		itemx.dt = item
@@ -6,7 +6,8 @@ from libcpp.utility cimport pair
 from cpython.set cimport PySet_Contains
 from .containers cimport (Chart, Grammar, Prob, Label, ItemNo,
 		ProbRule, LexicalRule, SmallChartItem, FatChartItem, Edge,
-		Whitelist, Agenda, SmallChartItemBtreeMap, FatChartItemBtreeMap,
+		Whitelist, Agenda, BucketAgenda, SmallChartItemBtreeMap,
+		FatChartItemBtreeMap, sparse_hash_map,
 		BITSIZE, CFGtoSmallChartItem, CFGtoFatChartItem, cellidx)
 from .bit cimport (nextset, nextunset, bitcount, bitlength,
 	testbit, anextset, anextunset, abitcount, abitlength, setunion)
@@ -18,6 +19,14 @@ cdef extern from "macros.h":
 	void SETBIT(uint64_t a[], int b)
 	uint64_t TESTBIT(uint64_t a[], int b)
 
+cdef extern from "_containers.h":
+	# unsigned __int128, only available if SLOTS == 2; opaque because Cython
+	# has no 128-bit integer type, its operations are implemented in C++.
+	ctypedef struct uint128_t:
+		pass
+	uint128_t touint128(const uint64_t *vec)
+	bint concatbits[T](ProbRule *rule, T lvec, T rvec)
+
 ctypedef fused LCFRSChart_fused:
 	SmallLCFRSChart
 	FatLCFRSChart
@@ -26,7 +35,21 @@ ctypedef fused LCFRSItem_fused:
 	SmallChartItem
 	FatChartItem
 
+ctypedef Agenda[ItemNo, pair[Prob, Prob]] LCFRSAgenda
+ctypedef BucketAgenda[ItemNo, pair[Prob, Prob]] LCFRSBucketAgenda
+
+ctypedef fused LCFRSAgenda_fused:
+	LCFRSAgenda
+	LCFRSBucketAgenda
+
 cdef class LCFRSChart(Chart):
+	# (label, leftmost/rightmost position) -> items popped from agenda
+	cdef sparse_hash_map[uint64_t, vector[ItemNo]] byleft
+	cdef sparse_hash_map[uint64_t, vector[ItemNo]] byright
+	cdef void indexitem(self, ItemNo itemidx, Label label, int left,
+			int right)
+	cdef void siblings(self, vector[ItemNo]& result, Label label,
+			int start, int end, bint rightmost)
 	cdef void addlexedge(self, ItemNo itemidx, short wordidx)
 	cdef void updateprob(self, ItemNo itemidx, Prob prob)
 	cdef void addprob(self, ItemNo itemidx, Prob prob)
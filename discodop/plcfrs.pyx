@@ -6,8 +6,10 @@ import re
 import logging
 import numpy as np
 from math import exp, log as pylog
+from time import perf_counter
+from .estimates import SXlrgapsEstimates
 cimport cython
-from cython.operator cimport preincrement, dereference
+from cython.operator cimport dereference
 from libc.math cimport HUGE_VAL as INFINITY
 include "constants.pxi"
 
@@ -16,6 +18,16 @@ cdef SmallChartItem NONE = SmallChartItem(0, 0)
 cdef FatChartItem FATNONE = FatChartItem(0)
 cdef FatChartItem FATCOMPONENT = FatChartItem(0)
 
+cdef inline uint64_t poskey(Label label, int pos):
+	"""Key for the sibling index of a chart: a label and a position."""
+	return (<uint64_t>label << 16) | pos
+
+
+cdef inline Label estlabel(const Label *labelmap, Label label):
+	"""The label of an item in the outside estimates."""
+	return label if labelmap is NULL else labelmap[label]
+
+
 cdef class LCFRSChart(Chart):
 	"""A chart for LCFRS grammars. An item is a ChartItem object."""
 	def __init__(self, Grammar grammar, list sent,
@@ -45,6 +57,28 @@ cdef class LCFRSChart(Chart):
 	cdef Prob _subtreeprob(self, ItemNo itemidx):
 		return self.probs[itemidx]
 
+	cdef void indexitem(self, ItemNo itemidx, Label label, int left,
+			int right):
+		"""Make item available as sibling; left, right are its outer bits."""
+		self.byleft[poskey(label, left)].push_back(itemidx)
+		self.byright[poskey(label, right)].push_back(itemidx)
+
+	cdef void siblings(self, vector[ItemNo]& result, Label label,
+			int start, int end, bint rightmost):
+		"""Collect items with label and leftmost/rightmost position in range.
+
+		The leftmost (or rightmost) position should be in the half-open
+		interval ``start, end``."""
+		cdef sparse_hash_map[uint64_t, vector[ItemNo]] *index = (
+				&self.byright if rightmost else &self.byleft)
+		cdef int pos
+		cdef ItemNo sibidx
+		for pos in range(max(start, 0), end):
+			it = index.find(poskey(label, pos))
+			if it != index.end():
+				for sibidx in dereference(it).second:
+					result.push_back(sibidx)
+
 	cdef Prob subtreeprob(self, ItemNo itemidx):
 		return self.probs[itemidx]
 
@@ -171,6 +205,17 @@ cdef class SmallLCFRSChart(LCFRSChart):
 		assert 0 <= start < end <= self.lensent
 		return cellidx(start, end, self.lensent, 1)
 
+	cdef bytes _itemstobytes(self):
+		return (<char *>&self.items[0])[
+				:self.items.size() * sizeof(SmallChartItem)]
+
+	cdef _itemsfrombytes(self, bytes data):
+		cdef ItemNo n
+		self.items.resize(len(data) // sizeof(SmallChartItem))
+		memcpy(&self.items[0], <char *>data, len(data))
+		for n in range(self.items.size()):
+			self.itemindex[self.items[n]] = n
+
 
 @cython.final
 cdef class FatLCFRSChart(LCFRSChart):
@@ -303,12 +348,24 @@ cdef class FatLCFRSChart(LCFRSChart):
 		assert 0 <= start < end <= self.lensent
 		return cellidx(start, end, self.lensent, 1)
 
+	cdef bytes _itemstobytes(self):
+		return (<char *>&self.items[0])[
+				:self.items.size() * sizeof(FatChartItem)]
+
+	cdef _itemsfrombytes(self, bytes data):
+		cdef ItemNo n
+		self.items.resize(len(data) // sizeof(FatChartItem))
+		memcpy(&self.items[0], <char *>data, len(data))
+		for n in range(self.items.size()):
+			self.itemindex[self.items[n]] = n
+
 
 def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
 		start=None, Whitelist whitelist=None, bint splitprune=False,
 		bint markorigin=False, estimates=None,
 		Prob beam_beta=0.0, int beam_delta=50, itemsestimate=None,
-		postagging=None):
+		postagging=None, size_t maxitems=0, size_t maxedges=0,
+		double timelimit=0.0, double bucketwidth=0.0):
 	"""Parse sentence and produce a chart.
 
 	:param sent: A sequence of tokens that will be parsed.
@@ -331,50 +388,96 @@ def parse(sent, Grammar grammar, tags=None, bint exhaustive=True,
 		map to the discontinuous node NP_2
 	:param estimates: use context-summary estimates (heuristics, figures of
 		merit) to order agenda. should be a tuple with the kind of
-		estimates ('SX' or 'SXlrgaps'), and the estimates themselves in a
-		4-dimensional numpy matrix. If estimates are not consistent, it is
+		estimates ('SX' or 'SXlrgaps'), and the estimates themselves; a
+		4-dimensional numpy matrix, or for 'SXlrgaps', optionally an
+		``SXlrgapsEstimates`` object. If estimates are not consistent, it is
 		no longer guaranteed that the optimal parse will be found.
-		experimental.
+		experimental. An optional third element is an array mapping the
+		labels of ``grammar`` to those of the estimates; cf.
+		``estimates.projectlabels()``.
 	:param beam_beta: keep track of the best score in each cell and only allow
 		items which are within a multiple of ``beam_beta`` of the best score.
 		Should be a negative log probability. Pass ``0.0`` to disable.
 	:param beam_delta: the maximum span length to which beam search is applied.
 	:param itemsestimate: the number of chart items to pre-allocate.
+	:param maxitems, maxedges, timelimit: budget for parsing; stop after
+		popping ``maxitems`` items from the agenda, adding ``maxedges`` edges,
+		or after ``timelimit`` seconds of wall-clock time. When the budget is
+		exhausted, the chart built so far is returned with
+		``chart.incomplete`` set; it may not contain a complete derivation.
+		Pass ``0`` to disable.
+	:param bucketwidth: if nonzero, use a bucketed priority queue for the
+		agenda, with buckets for priorities in intervals of this width
+		(a negative log probability); otherwise, use a binary heap. Both
+		produce the same results.
 	"""
+	cdef LCFRSAgenda agenda
+	cdef LCFRSBucketAgenda bucketagenda
+	if estimates is not None and estimates[0] == 'SXlrgaps':
+		outside = estimates[1]
+		if not isinstance(outside, SXlrgapsEstimates):
+			outside = SXlrgapsEstimates(grammar, outside.shape[1] - 1,
+					outside=outside)
+		outside = outside.getslice(len(sent))
+		estimates = None if outside is None else (
+				('SXlrgaps', outside) + tuple(estimates[2:]))
+	if bucketwidth:
+		bucketagenda.setwidth(bucketwidth)
 	if <unsigned>len(sent) < sizeof(COMPONENT.vec) * 8:
 		chart = SmallLCFRSChart(grammar, list(sent), start,
 			itemsestimate=itemsestimate)
-		return parse_main[SmallLCFRSChart, SmallChartItem](
+		if bucketwidth:
+			return parse_main[SmallLCFRSChart, SmallChartItem,
+					LCFRSBucketAgenda](
+					<SmallLCFRSChart>chart,
+					<SmallChartItem>(<SmallLCFRSChart>chart)._root(),
+					bucketagenda, sent, grammar, tags, exhaustive, whitelist,
+					splitprune, markorigin, estimates, beam_beta, beam_delta,
+					postagging, maxitems, maxedges, timelimit)
+		return parse_main[SmallLCFRSChart, SmallChartItem, LCFRSAgenda](
 				<SmallLCFRSChart>chart,
 				<SmallChartItem>(<SmallLCFRSChart>chart)._root(),
-				sent, grammar, tags, exhaustive, whitelist,
+				agenda, sent, grammar, tags, exhaustive, whitelist,
 				splitprune, markorigin, estimates, beam_beta, beam_delta,
-				postagging)
+				postagging, maxitems, maxedges, timelimit)
 	chart = FatLCFRSChart(grammar, list(sent), start,
 			itemsestimate=itemsestimate)
-	return parse_main[FatLCFRSChart, FatChartItem](
+	if bucketwidth:
+		return parse_main[FatLCFRSChart, FatChartItem, LCFRSBucketAgenda](
+				<FatLCFRSChart>chart,
+				<FatChartItem>(<FatLCFRSChart>chart)._root(),
+				bucketagenda, sent, grammar, tags, exhaustive, whitelist,
+				splitprune, markorigin, estimates, beam_beta, beam_delta,
+				postagging, maxitems, maxedges, timelimit)
+	return parse_main[FatLCFRSChart, FatChartItem, LCFRSAgenda](
 			<FatLCFRSChart>chart, <FatChartItem>(<FatLCFRSChart>chart)._root(),
-			sent, grammar, tags, exhaustive, whitelist,
+			agenda, sent, grammar, tags, exhaustive, whitelist,
 			splitprune, markorigin, estimates, beam_beta, beam_delta,
-			postagging)
+			postagging, maxitems, maxedges, timelimit)
 
 
-cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
-		Grammar grammar, tags, bint exhaustive, Whitelist whitelist,
+cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal,
+		LCFRSAgenda_fused& agenda,  # prioritized items to explore
+		sent, Grammar grammar, tags, bint exhaustive, Whitelist whitelist,
 		bint splitprune, bint markorigin, estimates,
-		Prob beam_beta, int beam_delta, postagging):
+		Prob beam_beta, int beam_delta, postagging,
+		size_t maxitems, size_t maxedges, double timelimit):
 	cdef:
-		Agenda[ItemNo, pair[Prob, Prob]] agenda  # prioritized items to explore
 		pair[ItemNo, pair[Prob, Prob]] entry
 		vector[ItemNo] sibvec
 		ProbRule *rule
-		LCFRSItem_fused item, sib, newitem, tmpitem
-		double [:, :, :, :] outside = None  # outside estimates, if provided
+		LCFRSItem_fused item, sib, newitem
+		const double [:, :, :, :] outside = None  # outside estimates
+		const Label [:] labelmap = None  # labels of outside estimates
+		const Label *estlabels = NULL
 		Prob siblingprob, score, prob, newprob
 		short lensent = len(sent), estimatetype = 0
 		int length = 1, left = 0, right = 0, gaps = 0
+		int leftmost, rightmost, end, comp
 		ItemNo itemidx, sibidx
 		size_t blocked = 0, maxA = 0, n
+		size_t popped = 0, numedges = 0
+		double deadline = perf_counter() + timelimit
 		bint usemask = grammar.mask.size() != 0
 	# avoid generating code for spurious fused type combinations
 	if ((LCFRSItem_fused is SmallChartItem
@@ -383,18 +486,20 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 			and LCFRSChart_fused is SmallLCFRSChart)):
 		return
 	if estimates is not None:
-		estimatetypestr, outside = estimates
+		estimatetypestr, outside = estimates[:2]
 		estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+		if len(estimates) == 3:
+			labelmap = estimates[2]
+			estlabels = &labelmap[0]
 	if LCFRSItem_fused is SmallChartItem:
 		newitem = SmallChartItem(0, 0)
-		tmpitem = SmallChartItem(0, 0)
 	elif LCFRSItem_fused is FatChartItem:
 		newitem = FatChartItem(0)
-		tmpitem = FatChartItem(0)
 	agenda.reserve(1024)
 
 	# assign POS tags
-	covered, msg = populatepos[LCFRSChart_fused, LCFRSItem_fused](
+	covered, msg = populatepos[
+			LCFRSAgenda_fused, LCFRSChart_fused, LCFRSItem_fused](
 			grammar, agenda, chart, newitem,
 			sent, tags, whitelist, estimates, postagging)
 	if not covered:
@@ -402,10 +507,27 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 	assert not agenda.empty()
 
 	while not agenda.empty():  # main parsing loop
+		if ((maxitems and popped >= maxitems)
+				or (maxedges and numedges >= maxedges)
+				# only check the clock every 1024 items
+				or (timelimit and popped & 1023 == 0
+					and perf_counter() > deadline)):
+			chart.incomplete = True
+			break
 		entry = agenda.pop()
+		popped += 1
 		itemidx = entry.first
 		prob = entry.second.second
 		item = chart.items[itemidx]
+		if LCFRSItem_fused is SmallChartItem:
+			leftmost = nextset(item.vec, 0)
+			rightmost = bitlength(item.vec) - 1
+		elif LCFRSItem_fused is FatChartItem:
+			leftmost = anextset(item.vec, 0, SLOTS)
+			rightmost = abitlength(item.vec, SLOTS) - 1
+		# only items that have been popped can be siblings.
+		if chart.probs[itemidx] == INFINITY:
+			chart.indexitem(itemidx, item.label, leftmost, rightmost)
 		# store viterbi probability; cannot do this when this item is added to
 		# the agenda because that would give rise to duplicate edges.
 		chart.updateprob(itemidx, prob)
@@ -438,12 +560,13 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 					continue
 				score = newprob = prob + rule.prob
 				if estimatetype == SX:
-					score += outside[rule.lhs, left, right, 0]
+					score += outside[estlabel(estlabels, rule.lhs),
+							left, right, 0]
 					if score > MAX_LOGPROB:
 						continue
 				elif estimatetype == SXlrgaps:
-					score += outside[
-							rule.lhs, length, left + right, gaps]
+					score += outside[estlabel(estlabels, rule.lhs),
+							length, left + right, 0]
 					if score > MAX_LOGPROB:
 						continue
 				else:
@@ -451,11 +574,13 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 					# have a strictly lower score than items with length n + 1.
 					score += length * MAX_LOGPROB
 				newitem.label = rule.lhs
-				if process_edge[LCFRSItem_fused, LCFRSChart_fused](
+				if process_edge[LCFRSItem_fused, LCFRSAgenda_fused,
+						LCFRSChart_fused](
 						newitem, newprob, score, rule, itemidx, item,
 						agenda, chart, estimatetype, whitelist,
 						splitprune and grammar.fanout[rule.lhs] != 1,
 						markorigin, 0.0):
+					numedges += 1
 					if LCFRSItem_fused is SmallChartItem:
 						newitem.vec = item.vec
 					elif LCFRSItem_fused is FatChartItem:
@@ -472,18 +597,26 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 				# 	continue
 				elif usemask and TESTBIT(&(grammar.mask[0]), rule.no):
 					continue
-				tmpitem.label = rule.rhs1
-				itemidxit = chart.itemindex.lower_bound(tmpitem)
+				# the first component of the right item follows component
+				# ``comp`` of the left sibling; if that is the last component
+				# of the sibling, the sibling ends before the right item.
 				sibvec.clear()
-				while (itemidxit != chart.itemindex.end()
-						and dereference(itemidxit).first.label == rule.rhs1):
-					sib = dereference(itemidxit).first
-					sibidx = dereference(itemidxit).second
-					sibvec.push_back(sibidx)
-					preincrement(itemidxit)
+				comp = nextset(rule.args, 0) - 1
+				if comp == -1:
+					# the yield starts with the right item, as in
+					# ``NP => DT NN 1,01``; consider all siblings.
+					chart.siblings(sibvec, rule.rhs1, 0, lensent, False)
+				elif comp + 1 == bitlength(rule.lengths) - bitcount(rule.args):
+					if testbit(rule.lengths, comp):  # a gap
+						chart.siblings(sibvec, rule.rhs1,
+								0, leftmost - 1, True)
+					else:
+						chart.siblings(sibvec, rule.rhs1,
+								leftmost - 1, leftmost, True)
+				else:
+					chart.siblings(sibvec, rule.rhs1, 0, leftmost, False)
 				for sibidx in sibvec:
 					sib = chart.items[sibidx]
-					preincrement(itemidxit)
 					if concat[LCFRSItem_fused](rule, &sib, &item):
 						newitem.label = rule.lhs
 						combine_item[LCFRSItem_fused](&newitem, &sib, &item)
@@ -502,7 +635,8 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 								left = anextset(newitem.vec, 0, SLOTS)
 						if estimatetype == SX:
 							right = lensent - length - left
-							score += outside[rule.lhs, left, right, 0]
+							score += outside[estlabel(estlabels, rule.lhs),
+									left, right, 0]
 							if score > MAX_LOGPROB:
 								continue
 						elif estimatetype == SXlrgaps:
@@ -512,19 +646,20 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 								gaps = abitlength(newitem.vec, SLOTS
 										) - length - left
 							right = lensent - length - left - gaps
-							score += outside[
-									rule.lhs, length, left + right, gaps]
+							score += outside[estlabel(estlabels, rule.lhs),
+									length, left + right, 0]
 							if score > MAX_LOGPROB:
 								continue
 						else:
 							score += length * MAX_LOGPROB
-						if process_edge[LCFRSItem_fused, LCFRSChart_fused](
+						if process_edge[LCFRSItem_fused, LCFRSAgenda_fused,
+								LCFRSChart_fused](
 								newitem, newprob, score, rule, sibidx, sib,
 								agenda, chart, estimatetype, whitelist,
 								splitprune and grammar.fanout[rule.lhs] != 1,
 								markorigin,
 								beam_beta if length <= beam_delta else 0.0):
-							pass
+							numedges += 1
 						else:
 							blocked += 1
 			# binary production, item from agenda is on the left
@@ -536,15 +671,21 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 				# 	continue
 				elif usemask and TESTBIT(&(grammar.mask[0]), rule.no):
 					continue
-				tmpitem.label = rule.rhs2
-				itemidxit = chart.itemindex.lower_bound(tmpitem)
+				# the right sibling starts directly after, or after a gap
+				# following, component ``comp`` of the item.
 				sibvec.clear()
-				while (itemidxit != chart.itemindex.end()
-						and dereference(itemidxit).first.label == rule.rhs2):
-					sib = dereference(itemidxit).first
-					sibidx = dereference(itemidxit).second
-					sibvec.push_back(sibidx)
-					preincrement(itemidxit)
+				comp = nextset(rule.args, 0) - 1
+				if comp == -1:  # the yield starts with the right sibling
+					chart.siblings(sibvec, rule.rhs2, 0, lensent, False)
+				else:
+					end = componentend[LCFRSItem_fused](&item, comp)
+					if end == -1:
+						continue
+					elif testbit(rule.lengths, comp):  # a gap
+						chart.siblings(sibvec, rule.rhs2,
+								end + 1, lensent, False)
+					else:
+						chart.siblings(sibvec, rule.rhs2, end, end + 1, False)
 				for sibidx in sibvec:
 					sib = chart.items[sibidx]
 					if concat[LCFRSItem_fused](rule, &item, &sib):
@@ -565,7 +706,8 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 								left = anextset(newitem.vec, 0, SLOTS)
 						if estimatetype == SX:
 							right = lensent - length - left
-							score += outside[rule.lhs, left, right, 0]
+							score += outside[estlabel(estlabels, rule.lhs),
+									left, right, 0]
 							if score > MAX_LOGPROB:
 								continue
 						elif estimatetype == SXlrgaps:
@@ -575,34 +717,69 @@ cdef parse_main(LCFRSChart_fused chart, LCFRSItem_fused goal, sent,
 								gaps = abitlength(newitem.vec, SLOTS
 										) - length - left
 							right = lensent - length - left - gaps
-							score += outside[rule.lhs, length,
-									left + right, gaps]
+							score += outside[estlabel(estlabels, rule.lhs),
+									length, left + right, 0]
 							if score > MAX_LOGPROB:
 								continue
 						else:
 							score += length * MAX_LOGPROB
-						if process_edge[LCFRSItem_fused, LCFRSChart_fused](
+						if process_edge[LCFRSItem_fused, LCFRSAgenda_fused,
+								LCFRSChart_fused](
 								newitem, newprob, score, rule, itemidx, item,
 								agenda, chart, estimatetype, whitelist,
 								splitprune and grammar.fanout[rule.lhs] != 1,
 								markorigin,
 								beam_beta if length <= beam_delta else 0.0):
-							pass
+							numedges += 1
 						else:
 							blocked += 1
 		if agenda.size() > maxA:
 			maxA = agenda.size()
 	msg = ('%s, blocked %d, agenda max %d, now %d' % (
 			chart.stats(), blocked, maxA, agenda.size()))
+	if chart.incomplete:
+		finalizegoal[LCFRSChart_fused, LCFRSItem_fused](chart, goal)
+		msg += ', budget exhausted after %d items' % popped
 	if not chart:
 		return chart, 'no parse; ' + msg
 	return chart, msg
 
 
+cdef void finalizegoal(LCFRSChart_fused chart, LCFRSItem_fused goal):
+	"""Set probability of goal item in an interrupted chart.
+
+	The goal item may have been derived without having been popped from the
+	agenda; its best edge then determines its probability."""
+	cdef ItemNo itemidx, leftidx, rightidx
+	cdef Edge edge
+	cdef Prob prob
+	# avoid generating code for spurious fused type combinations
+	if ((LCFRSItem_fused is SmallChartItem
+			and LCFRSChart_fused is FatLCFRSChart)
+			or (LCFRSItem_fused is FatChartItem
+			and LCFRSChart_fused is SmallLCFRSChart)):
+		return
+	it = chart.itemindex.find(goal)
+	if it == chart.itemindex.end():
+		return
+	itemidx = dereference(it).second
+	if chart.probs[itemidx] != INFINITY:
+		return
+	for edge in chart.parseforest[itemidx]:
+		if edge.rule is NULL:
+			continue
+		leftidx = chart._left(itemidx, edge)
+		prob = edge.rule.prob + chart.probs[leftidx]
+		if edge.rule.rhs2:
+			rightidx = chart._right(itemidx, edge)
+			prob += chart.probs[rightidx]
+		chart.updateprob(itemidx, prob)
+
+
 cdef inline bint process_edge(LCFRSItem_fused newitem,
 		Prob prob, Prob score, ProbRule *rule,
 		ItemNo leftitemidx, LCFRSItem_fused& left,
-		Agenda[ItemNo, pair[Prob, Prob]]& agenda, LCFRSChart_fused chart,
+		LCFRSAgenda_fused& agenda, LCFRSChart_fused chart,
 		int estimatetype, Whitelist whitelist, bint splitprune,
 		bint markorigin, Prob beam):
 	"""Decide what to do with a newly derived edge.
@@ -672,7 +849,7 @@ cdef inline bint process_edge(LCFRSItem_fused newitem,
 
 
 cdef populatepos(Grammar grammar,
-		Agenda[ItemNo, pair[Prob, Prob]]& agenda, LCFRSChart_fused chart,
+		LCFRSAgenda_fused& agenda, LCFRSChart_fused chart,
 		LCFRSItem_fused item, sent, tags, Whitelist whitelist, estimates,
 		postagging):
 	"""Apply all possible lexical and unary rules on each lexical span.
@@ -682,7 +859,9 @@ cdef populatepos(Grammar grammar,
 	cdef:
 		LexicalRule lexrule
 		LCFRSItem_fused newitem
-		double [:, :, :, :] outside = None  # outside estimates, if provided
+		const double [:, :, :, :] outside = None  # outside estimates
+		const Label [:] labelmap = None  # labels of outside estimates
+		const Label *estlabels = NULL
 		Prob score
 		short wordidx, lensent = len(sent), estimatetype = 0
 		int length = 1, left = 0, right = 0, gaps = 0
@@ -690,8 +869,11 @@ cdef populatepos(Grammar grammar,
 		bint recognized
 		Prob openclassfactor = 0.001
 	if estimates is not None:
-		estimatetypestr, outside = estimates
+		estimatetypestr, outside = estimates[:2]
 		estimatetype = {'SX': SX, 'SXlrgaps': SXlrgaps}[estimatetypestr]
+		if len(estimates) == 3:
+			labelmap = estimates[2]
+			estlabels = &labelmap[0]
 	# newitem will be recycled until it is added to the chart
 	if LCFRSItem_fused is SmallChartItem:
 		newitem = SmallChartItem(0, 0)
@@ -731,12 +913,13 @@ cdef populatepos(Grammar grammar,
 				if not tag or tagre.match(grammar.tolabel[lexrule.lhs]):
 					score = lexrule.prob
 					if estimatetype == SX:
-						score += outside[lexrule.lhs, left, right, 0]
+						score += outside[estlabel(estlabels, lexrule.lhs),
+								left, right, 0]
 						if score > MAX_LOGPROB:
 							continue
 					elif estimatetype == SXlrgaps:
-						score += outside[
-								lexrule.lhs, length, left + right, gaps]
+						score += outside[estlabel(estlabels, lexrule.lhs),
+								length, left + right, 0]
 						if score > MAX_LOGPROB:
 							continue
 					# NB: do NOT add length of span to score, so that the
@@ -748,7 +931,8 @@ cdef populatepos(Grammar grammar,
 					elif LCFRSItem_fused is FatChartItem:
 						memset(<void *>newitem.vec, 0, SLOTS * sizeof(uint64_t))
 						SETBIT(newitem.vec, wordidx)
-					if process_lexedge[LCFRSItem_fused, LCFRSChart_fused](
+					if process_lexedge[LCFRSItem_fused, LCFRSAgenda_fused,
+							LCFRSChart_fused](
 							newitem, lexrule.prob + reserveprob,
 							score + reserveprob, wordidx, agenda, chart,
 							whitelist):
@@ -776,7 +960,8 @@ cdef populatepos(Grammar grammar,
 						SETBIT(newitem.vec, wordidx)
 					score = lexrule.prob - pylog(openclassfactor)
 					# process_lexedge checks that tag is not already in agenda
-					if process_lexedge[LCFRSItem_fused, LCFRSChart_fused](
+					if process_lexedge[LCFRSItem_fused, LCFRSAgenda_fused,
+							LCFRSChart_fused](
 							newitem, lexrule.prob - pylog(openclassfactor),
 							score, wordidx, agenda, chart, whitelist):
 						if LCFRSItem_fused is SmallChartItem:
@@ -791,11 +976,13 @@ cdef populatepos(Grammar grammar,
 				if tagre.match(grammar.tolabel[lhs]) is not None:
 					score = 0.0
 					if estimatetype == SX:
-						score += outside[lhs, left, right, 0]
+						score += outside[estlabel(estlabels, lhs),
+								left, right, 0]
 						if score > MAX_LOGPROB:
 							continue
 					elif estimatetype == SXlrgaps:
-						score += outside[lhs, length, left + right, gaps]
+						score += outside[estlabel(estlabels, lhs),
+								length, left + right, 0]
 						if score > MAX_LOGPROB:
 							continue
 					newitem.label = lhs
@@ -807,7 +994,8 @@ cdef populatepos(Grammar grammar,
 								SLOTS * sizeof(uint64_t))
 						SETBIT(newitem.vec, wordidx)
 					# prevent pruning of provided tags in whitelist
-					if process_lexedge[LCFRSItem_fused, LCFRSChart_fused](
+					if process_lexedge[LCFRSItem_fused, LCFRSAgenda_fused,
+							LCFRSChart_fused](
 							newitem, 0.0, score, wordidx, agenda, chart, None):
 						if LCFRSItem_fused is SmallChartItem:
 							newitem = SmallChartItem(0, 0)
@@ -829,7 +1017,7 @@ cdef populatepos(Grammar grammar,
 
 cdef inline int process_lexedge(LCFRSItem_fused newitem,
 		Prob prob, Prob score, short wordidx,
-		Agenda[ItemNo, pair[Prob, Prob]]& agenda, LCFRSChart_fused chart,
+		LCFRSAgenda_fused& agenda, LCFRSChart_fused chart,
 		Whitelist whitelist) except -1:
 	"""Decide whether to accept a lexical edge ``(POS, word)``.
 
@@ -948,6 +1136,27 @@ cdef inline void combine_item(LCFRSItem_fused *newitem,
 		setunion(newitem[0].vec, left[0].vec, right[0].vec, SLOTS)
 
 
+cdef inline int componentend(LCFRSItem_fused *item, int comp):
+	"""Return the position after component ``comp`` of an item.
+
+	:returns: the index of the first unset bit after the given (0-based)
+		component, or -1 if the item has fewer components."""
+	cdef int pos
+	if LCFRSItem_fused is SmallChartItem:
+		pos = nextset(item[0].vec, 0)
+		while comp > 0 and pos != -1:
+			pos = nextset(item[0].vec, nextunset(item[0].vec, pos))
+			comp -= 1
+		return -1 if pos == -1 else nextunset(item[0].vec, pos)
+	elif LCFRSItem_fused is FatChartItem:
+		pos = anextset(item[0].vec, 0, SLOTS)
+		while comp > 0 and pos != -1:
+			pos = anextset(item[0].vec,
+					anextunset(item[0].vec, pos, SLOTS), SLOTS)
+			comp -= 1
+		return -1 if pos == -1 else anextunset(item[0].vec, pos, SLOTS)
+
+
 cdef inline bint concat(ProbRule *rule,
 		LCFRSItem_fused *left, LCFRSItem_fused *right):
 	"""Test whether two bitvectors combine according to a given rule.
@@ -972,43 +1181,17 @@ cdef inline bint concat(ProbRule *rule,
 	NB: note reversal due to the way binary numbers are represented
 	the least significant bit (rightmost) corresponds to the lowest
 	index in the sentence / constituent (leftmost)."""
-	cdef uint64_t lvec, rvec, mask
 	cdef uint64_t *alvec
 	cdef uint64_t *arvec
 	cdef int lpos, rpos, n
 	if LCFRSItem_fused is SmallChartItem:
-		lvec = left[0].vec
-		rvec = right[0].vec
-		if lvec & rvec:
-			return False
-		mask = rvec if testbit(rule.args, 0) else lvec
-		for n in range(bitlength(rule.lengths)):
-			if testbit(rule.args, n):  # component from right vector
-				if rvec & mask == 0:
-					return False  # check for expected component
-				rvec |= rvec - 1  # trailing 0 bits => 1 bits
-				mask = rvec & (~rvec - 1)  # mask of 1 bits up to first 0 bit
-			else:  # component from left vector
-				if lvec & mask == 0:
-					return False  # check for expected component
-				lvec |= lvec - 1  # trailing 0 bits => 1 bits
-				mask = lvec & (~lvec - 1)  # mask of 1 bits up to first 0 bit
-			# zero out component
-			lvec &= ~mask
-			rvec &= ~mask
-			if testbit(rule.lengths, n):  # a gap
-				# check that there is a gap in both vectors
-				if (lvec ^ rvec) & (mask + 1):
-					return False
-				# increase mask to cover gap
-				# get minimum of trailing zero bits of lvec & rvec
-				mask = (~lvec & (lvec - 1)) & (~rvec & (rvec - 1))
-			mask += 1  # e.g., 00111 => 01000
-		# success if we've reached the end of both left and right vector
-		return lvec == rvec == 0
+		return concatbits[uint64_t](rule, left[0].vec, right[0].vec)
 	elif LCFRSItem_fused is FatChartItem:
 		alvec = left[0].vec
 		arvec = right[0].vec
+		if SLOTS == 2:  # fits in a single 128-bit integer
+			return concatbits[uint128_t](rule,
+					touint128(alvec), touint128(arvec))
 		for n in range(SLOTS):
 			if alvec[n] & arvec[n]:
 				return False
@@ -1086,10 +1269,48 @@ def test():
 	assert testsent('Darueber muss nachgedacht werden werden werden', grammar)
 	print('ungrammatical sentence (\'no parse\' expected):')
 	assert not testsent('muss Darueber nachgedacht werden', grammar)
+	# a yield function starting with the right child, cf. demos.bitext()
+	grammar1 = Grammar([
+		((('S', 'NP_2', 'SEP'), ((0, 1, 0), )), 1),
+		((('NP_2', 'DT', 'NN_2'), ((1, ), (0, 1))), 1),
+		((('NN_2', 'NN', 'NN'), ((0, ), (1, ))), 1),
+		((('DT', 'Epsilon'), ('la', )), 1),
+		((('NN', 'Epsilon'), ('pizza', )), 1),
+		((('SEP', 'Epsilon'), ('|', )), 1)], start='S')
+	assert testsent('pizza | la pizza', grammar1)
+	assert not testsent('pizza | pizza la', grammar1)
 	assert testsent('Darueber muss nachgedacht ' + ' '.join(32 * ['werden']),
 			grammar)
 	assert testsent('Darueber muss nachgedacht ' + ' '.join(64 * ['werden']),
 			grammar)
+	print('budget exhausted (incomplete chart expected):')
+	sent = 'Darueber muss nachgedacht werden werden werden'.split()
+	chart, msg = parse(sent, grammar, maxitems=3)
+	print(msg)
+	assert chart.incomplete and not chart
+	chart, msg = parse(sent, grammar)
+	assert not chart.incomplete and chart
+	print('bucket agenda (same chart expected):')
+	chart1, msg1 = parse(sent, grammar, bucketwidth=1.0)
+	print(msg1)
+	assert msg1 == msg
+	assert str(chart1) == str(chart)
+
+
+def bench(lengths=(30, 40, 50, 60)):
+	"""Time exhaustive parsing with a highly ambiguous grammar."""
+	grammar = Grammar([
+		((('S', 'S', 'S'), ((0, 1), )), 0.4),
+		((('S', 'D_2', 'S'), ((0, 1, 0), )), 0.1),
+		((('D_2', 'A', 'A'), ((0, ), (1, ))), 1),
+		((('S', 'A'), ((0, ), )), 0.5),
+		((('A', 'Epsilon'), ('a', )), 1)], start='S')
+	for length in lengths:
+		sent = length * ['a']
+		begin = perf_counter()
+		chart, msg = parse(sent, grammar, exhaustive=True)
+		print('%d words, %.2fs: %s' % (length, perf_counter() - begin, msg))
+		assert chart
 
 
 __all__ = ['LCFRSChart', 'SmallLCFRSChart', 'FatLCFRSChart', 'parse']
@@ -21,7 +21,7 @@ from . import eval as evalmod
 from . import (__version__, treebank, treebanktransforms, treetransforms,
 		grammar, lexicon, parser, estimates)
 from .treetransforms import binarizetree
-from .util import workerfunc
+from .util import workerfunc, openread
 from .containers import Grammar
 
 INTERNALPARAMS = None
@@ -175,7 +175,7 @@ def startexp(
 
 	if rerun:
 		parser.readgrammars(resultdir, prm.stages, prm.postagging,
-				prm.transformations, top)
+				prm.transformations, top, numproc=prm.numproc)
 		if prm.predictfunctions:
 			import joblib
 			funcclassifier = joblib.load('%s/funcclassifier.pickle' % resultdir)
@@ -373,20 +373,21 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 				out.write(pickle.dumps(gram, protocol=-1))
 		elif stage.dop:
 			rules = lex = None
-			if stage.dop in ('doubledop', 'dop1'):
-				if stage.dop == 'doubledop':
-					(xgrammar, backtransform,
-							altweights, fragments) = grammar.doubledop(
-							traintrees, sents,
-							numproc=numproc, maxdepth=stage.maxdepth,
-							maxfrontier=stage.maxfrontier,
-							extrarules=extrarules)
-				elif stage.dop == 'dop1':
-					(xgrammar, backtransform,
-							altweights, fragments) = grammar.dop1(
-							traintrees, sents, maxdepth=stage.maxdepth,
-							maxfrontier=stage.maxfrontier,
-							extrarules=extrarules)
+			if stage.dop == 'dop1':
+				# write grammar files without keeping all fragments in memory
+				numrules = grammar.streamdop1(traintrees, sents,
+						'%s/%s' % (resultdir, stage.name),
+						maxdepth=stage.maxdepth, maxfrontier=stage.maxfrontier,
+						extrarules=extrarules, tmpdir=resultdir)
+				backtransform = openread('%s/%s.backtransform.gz' % (
+						resultdir, stage.name)).read().splitlines()
+			elif stage.dop == 'doubledop':
+				(xgrammar, backtransform,
+						altweights, fragments) = grammar.doubledop(
+						traintrees, sents,
+						numproc=numproc, maxdepth=stage.maxdepth,
+						maxfrontier=stage.maxfrontier,
+						extrarules=extrarules)
 				# dump fragments
 				with codecs.getwriter('utf8')(gzip.open(
 						'%s/%s.fragments.gz' % (resultdir, stage.name), 'wb',
@@ -396,7 +397,7 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 			elif stage.dop == 'reduction':
 				xgrammar, altweights = grammar.dopreduction(
 						traintrees, sents, packedgraph=stage.packedgraph,
-						extrarules=extrarules)
+						extrarules=extrarules, numproc=numproc)
 			elif stage.dop == 'ostag':
 				rules, lex, inittrees, auxtrees = grammar.doubleostagfromtsg(
 						traintrees, sents, numproc=numproc,
@@ -414,23 +415,26 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 			else:
 				raise ValueError('unrecognized DOP model: %r' % stage.dop)
 			nodes = sum(len(list(a.subtrees())) for a in traintrees)
-			msg = grammar.grammarinfo(xgrammar)
-			if rules is None:
-				rules, lex = grammar.writegrammar(xgrammar)
 			rulesfile = '%s/%s.rules.gz' % (resultdir, stage.name)
 			lexiconfile = '%s/%s.lex.gz' % (resultdir, stage.name)
-			with codecs.getwriter('utf8')(gzip.open(rulesfile, 'wb',
-					compresslevel=1)) as out:
-				out.write(rules)
-			with codecs.getwriter('utf8')(gzip.open(lexiconfile, 'wb',
-					compresslevel=1)) as out:
-				out.write(lex)
-			# write prob models
-			np.savez_compressed('%s/%s.probs.npz' % (resultdir, stage.name),
-					**altweights)
+			if stage.dop == 'dop1':  # files have already been written
+				msg = 'clauses: %d' % numrules
+			else:
+				msg = grammar.grammarinfo(xgrammar)
+				if rules is None:
+					rules, lex = grammar.writegrammar(xgrammar)
+				with codecs.getwriter('utf8')(gzip.open(rulesfile, 'wb',
+						compresslevel=1)) as out:
+					out.write(rules)
+				with codecs.getwriter('utf8')(gzip.open(lexiconfile, 'wb',
+						compresslevel=1)) as out:
+					out.write(lex)
+				# write prob models
+				np.savez_compressed('%s/%s.probs.npz' % (
+						resultdir, stage.name), **altweights)
 			gram = Grammar(rulesfile, lexiconfile, start=top,
 					altweights='%s/%s.probs.npz' % (resultdir, stage.name),
-					backtransform=backtransform)
+					backtransform=backtransform, precision=stage.precision)
 			logging.info('DOP model based on %d sentences, %d nodes, '
 				'%d nonterminals', len(traintrees), nodes, gram.nonterminals)
 			logging.info(msg)
@@ -441,10 +445,11 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 				# backtransform keys are line numbers to rules file;
 				# to see them together do:
 				# $ paste <(zcat dop.rules.gz) <(zcat dop.backtransform.gz)
-				with codecs.getwriter('utf8')(gzip.open(
-						'%s/%s.backtransform.gz' % (resultdir, stage.name),
-						'wb', compresslevel=1)) as out:
-					out.writelines('%s\n' % a for a in backtransform)
+				if stage.dop == 'doubledop':
+					with codecs.getwriter('utf8')(gzip.open(
+							'%s/%s.backtransform.gz' % (resultdir, stage.name),
+							'wb', compresslevel=1)) as out:
+						out.writelines('%s\n' % a for a in backtransform)
 				# recoverfragments() relies on this mapping to identify
 				# binarization nodes. treeparsing() relies on this as well.
 				msg = gram.getmapping(
@@ -473,14 +478,9 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 						gram.getrulemapping(stages[prevn].grammar,
 								re.compile(r'@[-0-9]+\b'))
 					logging.info(msg)
-				if stage.objective == 'sl-dop':  # needed for treeparsing()
-					_ = gram.getmapping(
-							None, striplabelre=re.compile(r'@[-0-9]+\b'))
-					gram.getrulemapping(gram, re.compile(r'@[-0-9]+\b')
-							)
 		else:  # not stage.dop
 			xgrammar = grammar.treebankgrammar(traintrees, sents,
-					extrarules=extrarules)
+					extrarules=extrarules, numproc=numproc)
 			logging.info('induced %s based on %d sentences',
 				('PCFG' if tbfanout == 1 or stage.split else 'PLCFRS'),
 				len(traintrees))
@@ -498,7 +498,8 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 			with codecs.getwriter('utf8')(gzip.open(lexiconfile, 'wb',
 					compresslevel=1)) as out:
 				out.write(lex)
-			gram = Grammar(rulesfile, lexiconfile, start=top)
+			gram = Grammar(rulesfile, lexiconfile, start=top,
+					precision=stage.precision)
 			logging.info(gram.testgrammar()[1])
 			if n and stage.prune:
 				msg = gram.getmapping(stages[prevn].grammar,
@@ -513,9 +514,17 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 				resultdir, stage.name,
 				',backtransform' if stage.dop in ('doubledop', 'dop1') else '')
 
-		outside = None
+		outside = labelmap = None
 		if stage.estimates in ('SX', 'SXlrgaps'):
-			if stage.estimates == 'SX' and tbfanout != 1 and not stage.split:
+			estgram = gram
+			if stage.dop:
+				# compute estimates for the labels of the coarse stage.
+				if not (n and stage.prune) or stages[prevn].dop:
+					raise ValueError('estimates for DOP stage require '
+							'pruning with non-DOP stage.')
+				estgram = stages[prevn].grammar
+				labelmap = estimates.projectlabels(gram, estgram)
+			if stage.estimates == 'SX' and estgram.maxfanout != 1:
 				raise ValueError('SX estimate requires PCFG.')
 			elif stage.mode != 'plcfrs':
 				raise ValueError('estimates require parser w/agenda.')
@@ -523,19 +532,23 @@ def getgrammars(trees, sents, stages, testmaxwords, resultdir,
 			logging.info('computing %s estimates', stage.estimates)
 			if stage.estimates == 'SX':
 				outside = estimates.getpcfgestimates(
-						gram, testmaxwords, trees[0].label)
+						estgram, testmaxwords, trees[0].label)
+				np.save('%s/%s.outside.npy' % (resultdir, stage.name), outside)
+				logging.info('estimates done. cpu time elapsed: %gs',
+						process_time() - begin)
+				logging.info('saved %s estimates', stage.estimates)
 			elif stage.estimates == 'SXlrgaps':
-				outside = estimates.getestimates(
-						gram, testmaxwords, trees[0].label)
-			logging.info('estimates done. cpu time elapsed: %gs',
-					process_time() - begin)
-			np.savez_compressed('%s/%s.outside.npz' % (
-					resultdir, stage.name), outside=outside)
-			logging.info('saved %s estimates', stage.estimates)
+				# slices are computed when sentences of each length are parsed;
+				# the file is created here, before any worker processes start.
+				filename = '%s/%s.outside.npy' % (resultdir, stage.name)
+				if os.path.exists(filename):
+					os.remove(filename)
+				outside = estimates.SXlrgapsEstimates(
+						estgram, testmaxwords, filename)
 		elif stage.estimates:
 			raise ValueError('unrecognized value; specify SX or SXlrgaps.')
 
-		stage.update(grammar=gram, outside=outside)
+		stage.update(grammar=gram, outside=outside, estimatelabels=labelmap)
 
 	if any(stage.mapping is not None for stage in stages):
 		with codecs.getwriter('utf8')(gzip.open('%s/mapping.json.gz' % (
@@ -0,0 +1,327 @@
+"""Tune coarse-to-fine pruning parameters on a development set.
+
+Parses a development set with a number of settings for the stage parameters
+that can be changed without re-training (``k``, ``beam_beta``,
+``beam_delta``), and reports the speed/accuracy trade-off of each."""
+import io
+import os
+import sys
+import logging
+from math import ceil, log
+from pprint import pformat
+from itertools import product, groupby
+from operator import itemgetter
+from getopt import gnu_getopt, GetoptError
+from . import eval as evalmod
+from .parser import Parser, DictObj, readparam, readgrammars
+from .treebank import READERS
+
+SHORTUSAGE = '''\
+Usage: discodop tune <grammar/> <devset> <output.prm> [options]'''
+
+# values to try for each parameter; k is only tuned for pruned stages,
+# the beam for PLCFRS stages.
+DEFAULTGRID = dict(
+		k=(10, 50, 100, 500),
+		kposterior=(1e-3, 1e-4, 1e-5, 1e-6),
+		beam_beta=(1.0, 1e-4, 1e-6),
+		beam_delta=(20, 40))
+
+
+def stagegrid(stages, grid=None):
+	"""Return a list of ``(stage, param, values)`` tuples to search over.
+
+	:param grid: optionally, a dictionary with stage names as keys and
+		dictionaries of parameters and values to try as values; stages not in
+		the dictionary get default values based on their mode.
+
+	>>> stages = [DictObj(name='pcfg', mode='pcfg', prune=False, k=50),
+	...		DictObj(name='plcfrs', mode='plcfrs', prune='pcfg', k=1e-5)]
+	>>> for name, param, values in stagegrid(stages):
+	...		print(name, param, values)
+	pcfg beam_beta (1.0, 0.0001, 1e-06)
+	plcfrs k (0.001, 0.0001, 1e-05, 1e-06)
+	plcfrs beam_beta (1.0, 0.0001, 1e-06)
+	plcfrs beam_delta (20, 40)"""
+	result = []
+	for stage in stages:
+		if grid is not None and stage.name in grid:
+			for param, values in sorted(grid[stage.name].items()):
+				if param not in ('k', 'beam_beta', 'beam_delta'):
+					raise ValueError('parameter %r can not be tuned.' % param)
+				result.append((stage.name, param, tuple(values)))
+			continue
+		if stage.prune and stage.mode in ('pcfg', 'plcfrs'):
+			result.append((stage.name, 'k', DEFAULTGRID[
+					'kposterior' if 0 < stage.k < 1 else 'k']))
+		if stage.mode in ('pcfg', 'plcfrs'):
+			result.append((stage.name, 'beam_beta', DEFAULTGRID['beam_beta']))
+		if stage.mode == 'plcfrs':
+			result.append((stage.name, 'beam_delta',
+					DEFAULTGRID['beam_delta']))
+	return result
+
+
+def settings(grid):
+	"""Enumerate all combinations of parameter values in a grid.
+
+	:returns: a list of tuples of ``(stage, param, value)`` triples.
+
+	>>> grid = [('a', 'k', (1, 2)), ('b', 'beam_beta', (1.0, 0.5))]
+	>>> for setting in settings(grid):
+	...		print(setting)
+	(('a', 'k', 1), ('b', 'beam_beta', 1.0))
+	(('a', 'k', 1), ('b', 'beam_beta', 0.5))
+	(('a', 'k', 2), ('b', 'beam_beta', 1.0))
+	(('a', 'k', 2), ('b', 'beam_beta', 0.5))"""
+	result = []
+	seen = set()
+	for values in product(*[values for _, _, values in grid]):
+		# the beam width is irrelevant when the beam is disabled
+		nobeam = {name for (name, param, _), value in zip(grid, values)
+				if param == 'beam_beta' and value == 1.0}
+		setting = tuple((name, param, value) for (name, param, _), value
+				in zip(grid, values)
+				if not (param == 'beam_delta' and name in nobeam))
+		if setting not in seen:
+			seen.add(setting)
+			result.append(setting)
+	return result
+
+
+def applysetting(stages, setting):
+	"""Update stage parameters in-place with the given setting."""
+	bystage = {stage.name: stage for stage in stages}
+	for name, param, value in setting:
+		bystage[name].update({param: value})
+
+
+def evaluate(parser, testset, evalparam, setting):
+	"""Parse test set with given setting and collect speed and accuracy.
+
+	:param testset: a list of tuples ``(sentid, tagged_sent, tree, sent)``,
+		where ``tagged_sent`` are the tokens (and optionally tags) given to the
+		parser, and ``tree`` and ``sent`` are the gold standard.
+	:returns: a DictObj with the setting, average time and number of chart
+		items per sentence, the F1 score, and the number of parse failures."""
+	applysetting(parser.stages, setting)
+	evaluator = evalmod.Evaluator(evalparam)
+	elapsedtime = numitems = noparse = 0
+	for sentid, tagged_sent, goldtree, goldsent in testset:
+		sent = [w for w, _ in tagged_sent]
+		tags = [t for _, t in tagged_sent]
+		results = list(parser.parse(sent,
+				tags=None if None in tags else tags))
+		elapsedtime += sum(result.elapsedtime for result in results)
+		numitems += sum(result.numitems for result in results)
+		noparse += results[-1].noparse
+		evaluator.add(sentid, goldtree.copy(True), goldsent,
+				results[-1].parsetree.copy(True), sent)
+	try:
+		f1 = 100 * float(evalmod.f_measure(
+				evaluator.acc.goldb, evaluator.acc.candb))
+	except ZeroDivisionError:
+		f1 = 0.0
+	return DictObj(setting=setting, time=elapsedtime / len(testset),
+			numitems=numitems / len(testset), f1=f1, noparse=noparse,
+			numsents=len(testset))
+
+
+def gridsearch(parser, testset, evalparam, candidates):
+	"""Evaluate each setting on the full test set."""
+	results = []
+	for setting in candidates:
+		results.append(evaluate(parser, testset, evalparam, setting))
+		logging.info('%s', resultstr(results[-1]))
+	return results
+
+
+def successivehalving(parser, testset, evalparam, candidates, budget=None,
+		eta=2):
+	"""Evaluate settings on increasingly larger subsets of the test set.
+
+	In each round, only the best ``1 / eta`` of the settings are kept, while
+	the number of sentences is multiplied by ``eta``. Settings are ranked by
+	whether they meet the time budget, and then by F1 score. The last round
+	uses the full test set.
+
+	:returns: the results of the last round."""
+	numrounds = max(0, ceil(log(len(candidates), eta) - 1e-9))
+	numsents = max(1, len(testset) // eta ** numrounds)
+	while True:
+		numsents = min(numsents, len(testset))
+		results = gridsearch(parser, testset[:numsents], evalparam,
+				candidates)
+		if numsents == len(testset):
+			return results
+		results.sort(key=lambda a: rankkey(a, budget))
+		candidates = [a.setting for a in
+				results[:max(1, len(results) // eta)]]
+		numsents *= eta
+
+
+def tunestages(parser, testset, evalparam, grid, search='halving',
+		budget=None):
+	"""Tune the parameters of one stage at a time, from first to last.
+
+	For each stage, the combinations of its own parameter values are
+	evaluated, with the stages tuned before it fixed at their selected
+	setting, and later stages as given in the parameter file. This avoids
+	searching the cross-product of the values for all stages.
+
+	:param grid: a list of ``(stage, param, values)`` tuples, as returned by
+		``stagegrid()``.
+	:param search: ``'grid'`` or ``'halving'``; cf. ``gridsearch()`` and
+		``successivehalving()``.
+	:returns: the results for the last tuned stage; their settings include
+		the selected values for the stages before it."""
+	best = ()
+	results = None
+	for name, group in groupby(grid, key=itemgetter(0)):
+		candidates = [best + setting for setting in settings(list(group))]
+		logging.info('stage %s: %d settings, %d sentences',
+				name, len(candidates), len(testset))
+		if search == 'grid':
+			results = gridsearch(parser, testset, evalparam, candidates)
+		else:
+			results = successivehalving(parser, testset, evalparam,
+					candidates, budget)
+		best = selectsetting(paretofrontier(results), budget).setting
+	if results is None:  # nothing to tune
+		results = gridsearch(parser, testset, evalparam, [()])
+	return results
+
+
+def rankkey(result, budget=None):
+	"""Sort key: settings meeting the budget first, then by F1, then time."""
+	return (budget is not None and result.time > budget,
+			-result.f1, result.time)
+
+
+def paretofrontier(results):
+	"""Return results not dominated in both time and F1 by another result.
+
+	>>> results = [DictObj(time=t, f1=f) for t, f in
+	...		((0.1, 70.0), (0.2, 75.0), (0.3, 74.0), (0.4, 80.0))]
+	>>> [(a.time, a.f1) for a in paretofrontier(results)]
+	[(0.1, 70.0), (0.2, 75.0), (0.4, 80.0)]"""
+	frontier = []
+	for result in sorted(results, key=lambda a: (a.time, -a.f1)):
+		if not frontier or result.f1 > frontier[-1].f1:
+			frontier.append(result)
+	return frontier
+
+
+def selectsetting(frontier, budget=None):
+	"""Pick the most accurate setting within the time budget per sentence.
+
+	When no setting meets the budget, the fastest setting is returned."""
+	if budget is None:
+		return frontier[-1]
+	feasible = [a for a in frontier if a.time <= budget]
+	return feasible[-1] if feasible else frontier[0]
+
+
+def resultstr(result):
+	"""Render a single result as a line of text."""
+	return '%8.4f %10.1f %6.2f %4d  %s' % (
+			result.time, result.numitems, result.f1, result.noparse,
+			' '.join('%s.%s=%g' % a for a in result.setting))
+
+
+def writeparam(paramfile, outfile, setting):
+	"""Write a copy of a parameter file with the given stage parameters."""
+	with io.open(paramfile, encoding='utf8') as inp:
+		params = eval('dict(%s)' % inp.read())  # pylint: disable=eval-used
+	for stage in params['stages']:
+		for name, param, value in setting:
+			if stage.get('name', 'stage1') == name:
+				stage[param] = value
+	with io.open(outfile, 'w', encoding='utf8') as out:
+		for key, value in params.items():
+			out.write('%s=%s,\n' % (key, pformat(value)))
+
+
+def readdevset(prm, filename, fmt=None, encoding='utf8', numsents=None,
+		maxwords=None):
+	"""Read development set in the same way as ``runexp`` reads a test set.
+
+	:returns: a list of tuples as expected by ``evaluate()``."""
+	corpus = READERS[fmt or prm.corpusfmt](
+			filename, encoding=encoding,
+			headrules=prm.binarization.headrules,
+			removeempty=prm.removeempty, morphology=prm.morphology,
+			functions=prm.functions, ensureroot=prm.ensureroot)
+	usetags = not (prm.postagging and prm.postagging.method == 'unknownword')
+	result = []
+	for n, item in corpus.itertrees(0, numsents):
+		if maxwords is None or len(item.sent) <= maxwords:
+			tagged = [(word, tag if usetags else None) for word, (_, tag)
+					in zip(item.sent, sorted(item.tree.pos()))]
+			result.append((n, tagged, item.tree, item.sent))
+	if not result:
+		raise ValueError('development set (selection) should be non-empty.')
+	return result
+
+
+def main():
+	"""Command line interface for tuning parameters."""
+	options = ('help', 'fmt=', 'encoding=', 'numsents=', 'maxwords=',
+			'budget=', 'search=', 'grid=', 'evalparam=')
+	try:
+		opts, args = gnu_getopt(sys.argv[2:], 'h', options)
+	except GetoptError as err:
+		print('error:', err, file=sys.stderr)
+		print(SHORTUSAGE)
+		sys.exit(2)
+	opts = dict(opts)
+	if len(args) != 3:
+		print('error: incorrect number of arguments', file=sys.stderr)
+		print(SHORTUSAGE)
+		sys.exit(2)
+	directory, devfile, outfile = args
+	if not os.path.isdir(directory):
+		raise ValueError('expected directory produced by "discodop runexp"')
+	search = opts.get('--search', 'halving')
+	if search not in ('grid', 'halving'):
+		raise ValueError('unrecognized search method: %r' % search)
+	budget = float(opts['--budget']) if '--budget' in opts else None
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	paramfile = os.path.join(directory, 'params.prm')
+	prm = readparam(paramfile)
+	prm.update(resultdir=directory, verbosity=0)
+	readgrammars(directory, prm.stages, prm.postagging, prm.transformations,
+			top=getattr(prm, 'top', 'ROOT'))
+	parser = Parser(prm)
+	maxwords = (int(opts['--maxwords']) if '--maxwords' in opts
+			else prm.testcorpus.maxwords)
+	testset = readdevset(prm, devfile, opts.get('--fmt'),
+			opts.get('--encoding', 'utf8'),
+			int(opts['--numsents']) if '--numsents' in opts else None,
+			maxwords)
+	if '--evalparam' in opts:
+		evalparam = evalmod.readparam(opts['--evalparam'])
+	else:
+		evalparam = evalmod.readparam(prm.evalparam
+				if prm.evalparam and os.path.exists(prm.evalparam) else None)
+	evalparam['DEBUG'] = -1
+	# the F1 score should cover all sentences that are parsed
+	evalparam['CUTOFF_LEN'] = maxwords
+	grid = None
+	if '--grid' in opts:
+		with io.open(opts['--grid'], encoding='utf8') as inp:
+			grid = eval('dict(%s)' % inp.read())  # pylint: disable=eval-used
+	results = tunestages(parser, testset, evalparam,
+			stagegrid(prm.stages, grid), search, budget)
+	frontier = paretofrontier(results)
+	print('time/sent      items     F1 fail  setting')
+	for result in frontier:
+		print(resultstr(result))
+	best = selectsetting(frontier, budget)
+	writeparam(paramfile, outfile, best.setting)
+	print('wrote parameters to %s:\n%s' % (outfile, resultstr(best)))
+
+
+__all__ = ['stagegrid', 'settings', 'applysetting', 'evaluate', 'gridsearch',
+		'successivehalving', 'tunestages', 'rankkey', 'paretofrontier',
+		'selectsetting', 'resultstr', 'writeparam', 'readdevset', 'main']
@@ -4,6 +4,8 @@ import re
 import sys
 import gzip
 import codecs
+import pickle
+import tempfile
 import traceback
 import subprocess
 from contextlib import contextmanager
@@ -111,6 +113,17 @@ def readbytes(filename):
 		return inp.read()
 
 
+def findfile(filename):
+	"""Return filename, possibly with a compression extension, that exists.
+
+	Tries ``filename`` itself, followed by ``.zst``, ``.lz4``, and ``.gz``
+	extensions; if none exists, return ``filename + '.gz'``."""
+	for ext in ('', '.zst', '.lz4'):
+		if os.path.exists(filename + ext):
+			return filename + ext
+	return filename + '.gz'
+
+
 def slice_bounds(seq, slice_obj, allow_step=False):
 	"""Calculate the effective (start, stop) bounds of a slice.
 
@@ -393,6 +406,75 @@ def merge(*iterables, key=None):
 		yield from iterable
 
 
+def externalsort(items, key=None, chunksize=100000, tmpdir=None,
+		maxfiles=64):
+	"""Generator that sorts an iterable using temporary files.
+
+	>>> list(externalsort([3, 1, 0, 2, 1], chunksize=2))
+	[0, 1, 1, 2, 3]
+
+	Chunks of ``chunksize`` items are sorted in memory and pickled to
+	temporary files in ``tmpdir``; the chunks are merged lazily. Memory usage
+	is therefore proportional to ``chunksize`` rather than the number of
+	items. The sort is stable.
+
+	:param maxfiles: when this number of sorted runs of the same size has been
+		written, they are merged into a single run; this bounds the number of
+		files that are open at the same time."""
+	files = []  # tuples (level, file); a run of level n merges maxfiles ** n
+	chunk = []
+	try:
+		for item in items:
+			chunk.append(item)
+			if len(chunk) >= chunksize:
+				chunk.sort(key=key)
+				files.append((0, _writechunk(chunk, tmpdir)))
+				chunk = []
+				_mergeruns(files, key, maxfiles, tmpdir)
+		chunk.sort(key=key)
+		if not files:
+			yield from chunk
+			return
+		files.append((0, _writechunk(chunk, tmpdir)))
+		del chunk
+		yield from merge(*[_readchunk(a) for _, a in files], key=key)
+	finally:
+		for _, a in files:
+			a.close()
+
+
+def _mergeruns(files, key, maxfiles, tmpdir):
+	"""Merge the last ``maxfiles`` runs into one while they have equal level.
+
+	Since only adjacent runs are merged, the merged sort remains stable."""
+	while len(files) >= maxfiles and all(level == files[-1][0]
+			for level, _ in files[-maxfiles:]):
+		runs = [a for _, a in files[-maxfiles:]]
+		merged = _writechunk(merge(*[_readchunk(a) for a in runs], key=key),
+				tmpdir)
+		for a in runs:
+			a.close()
+		files[-maxfiles:] = [(files[-1][0] + 1, merged)]
+
+
+def _writechunk(chunk, tmpdir):
+	"""Pickle an iterable of items to an anonymous temporary file."""
+	tmp = tempfile.TemporaryFile(dir=tmpdir)
+	for item in chunk:
+		pickle.dump(item, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+	tmp.seek(0)
+	return tmp
+
+
+def _readchunk(tmp):
+	"""Yield the items of a temporary file written by ``_writechunk()``."""
+	while True:
+		try:
+			yield pickle.load(tmp)
+		except EOFError:
+			return
+
+
 FRENCHCONTRACTIONS = 'aujourd|jusqu|lorsqu|presqu|puisqu|qu|quelqu|quoiqu'
 # List of contractions adapted from Robert MacIntyre's tokenizer.
 CONTRACTIONS = [
@@ -483,5 +565,6 @@ ANSICOLOR = {
 }
 
 __all__ = ['which', 'workerfunc', 'genericdecompressor', 'genericcompressor',
-		'openread', 'readbytes', 'slice_bounds', 'merge', 'tokenize', 'run',
+		'openread', 'readbytes', 'findfile', 'slice_bounds', 'merge',
+		'externalsort', 'tokenize', 'run',
 		'OrderedSet', 'PyAgenda', 'ANSICOLOR']
@@ -234,8 +234,8 @@ description = u'Disco-DOP Documentation'
 authors = [u'Andreas van Cranenburgh']
 man_pages = [('discodop', 'discodop', description, authors, 1)] + [
 		('cli/' + sub, 'discodop-' + sub, description, authors, 1)
-		for sub in ('eval fragments gen grammar parser runexp '
-			'treedraw treesearch treetransforms').split()]
+		for sub in ('estimates eval fragments gen grammar parser runexp '
+			'treedraw treesearch treetransforms tune').split()]
 
 # If true, show URL addresses after external links.
 man_show_urls = True
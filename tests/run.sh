@@ -10,7 +10,7 @@ do
 		echo "Nonzero exit code in $a:"
 		exit $?
 	fi
-	line=`! grep -v 'pcfg \|post \|cov 100\.0.*ex 100\.0' $a/output.log | grep 'ex \|Error'`
+	line=`! grep -v 'pcfg[a-z]* \|post \|cov 100\.0.*ex 100\.0' $a/output.log | grep 'ex \|Error'`
 	if [ $? -ne 0 ]; then
 		cat $a/output.log
 		echo "Failure in $a:"
@@ -215,6 +215,23 @@ class Test_grammar(object):
 				'(S|<VP>_2 (VP_3 (VP|<NP>_3 {0} (VP|<ADV>_2 {2} (VP|<VVPP> '
 				'{3})))) (S|<VAFIN> {1}))')
 
+	def test_shardedextraction(self):
+		from discodop.grammar import treebankgrammar, dopreduction
+		from discodop.treebank import NegraCorpusReader
+		from discodop.treetransforms import addfanoutmarkers
+		corpus = NegraCorpusReader('alpinosample.export', punct='move')
+		sents = list(corpus.sents().values())
+		trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+				for a in list(corpus.trees().values())]
+		assert (treebankgrammar(trees, sents, numproc=2)
+				== treebankgrammar(trees, sents))
+		rules1, altweights1 = dopreduction(trees, sents, numproc=2)
+		rules2, altweights2 = dopreduction(trees, sents)
+		assert rules1 == rules2
+		assert altweights1.keys() == altweights2.keys()
+		assert all((altweights1[a] == altweights2[a]).all()
+				for a in altweights1)
+
 
 class TestHeap(TestCase):
 	testN = 100
@@ -402,6 +419,9 @@ def test_fragments():
 			list(fragments.values()), params['trees1'], params['trees1'])
 	assert len(fragments) == 25
 	assert sum(counts) == 100
+	indexed = extractfragments(params['trees1'], 0, 0, params['vocab'],
+			disc=True, approx=False, minshared=1)
+	assert set(indexed) == set(fragments)
 
 
 def test_allfragments():
@@ -817,6 +837,239 @@ def test_runexp():
 	cli.runexp(['sample.prm'])
 
 
+def test_writedopgrammar(tmp_path):
+	import gzip
+	import numpy as np
+	from discodop.grammar import dopgrammar, writegrammar, writedopgrammar
+	trees = [Tree('(S (NP 0) (VP (V 1) (NP 2)))'),
+			Tree('(S (NP 0) (VP 1))')]
+	bytree = [
+			{'(S (NP 0=) (VP 1= 2=))': [0], '(S (NP 0=Mary) (VP 1= 2=))': [0],
+			'(VP (V 0=) (NP 1=))': [0], '(VP (V 0=sees) (NP 1=John))': [0],
+			'(NP 0=Mary)': [0], '(V 0=sees)': [0], '(NP 0=John)': [0]},
+			{'(S (NP 0=) (VP 1=))': [1], '(S (NP 0=John) (VP 1=walks))': [1],
+			'(NP 0=John)': [1], '(VP 0=walks)': [1]}]
+	fragments = {}
+	for frags in bytree:
+		for frag, indices in frags.items():
+			fragments.setdefault(frag, []).extend(indices)
+	fragments = {frag: fragments[frag] for frag in sorted(fragments)}
+	xgrammar, backtransform, altweights, fragments = dopgrammar(
+			trees, fragments)
+	rules, lexicon = writegrammar(xgrammar)
+	prefix = str(tmp_path / 'dop1')
+	assert writedopgrammar(trees, bytree, prefix, chunksize=3) == len(
+			xgrammar)
+	for ext, expected in (
+			('rules', rules), ('lex', lexicon),
+			('backtransform', ''.join('%s\n' % a for a in backtransform)),
+			('fragments', ''.join('%s\t%d\n' % (a, len(b))
+				for a, b in fragments))):
+		with gzip.open('%s.%s.gz' % (prefix, ext), 'rt') as inp:
+			assert inp.read() == expected
+	probs = np.load(prefix + '.probs.npz')
+	for name, weights in altweights.items():
+		assert (probs[name] == weights).all()
+
+
+def test_writedopgrammarids(tmp_path):
+	# binarization nodes of the S fragments are shared; only their IDs may
+	# differ from those of dopgrammar().
+	import gzip
+	from discodop.grammar import dopgrammar, writegrammar, writedopgrammar
+	trees = [Tree('(S (A 0) (B 1) (C 2) (D 3) (E 4))'),
+			Tree('(S (A 0) (B 1) (C 2) (D 3) (F 4))')]
+	bytree = [{'(S (A 0=) (B 1=) (C 2=) (D 3=) (%s 4=))' % label: [n],
+			'(S (A 0=a) (B 1=) (C 2=) (D 3=) (%s 4=))' % label: [n],
+			'(A 0=a)': [n]} for n, label in enumerate('EF')]
+	fragments = {}
+	for frags in bytree:
+		for frag, indices in frags.items():
+			fragments.setdefault(frag, []).extend(indices)
+	fragments = {frag: fragments[frag] for frag in sorted(fragments)}
+	xgrammar, _, _, _ = dopgrammar(trees, fragments)
+	rules, _ = writegrammar(xgrammar)
+	prefix = str(tmp_path / 'dop1')
+	assert writedopgrammar(trees, bytree, prefix, chunksize=2) == len(
+			xgrammar)
+	with gzip.open(prefix + '.rules.gz', 'rt') as inp:
+		result = inp.read()
+	for a in (rules, result):
+		assert len(set(re.findall(r'}<[0-9]+>', a))) == 8
+	assert (sorted(re.sub(r'}<[0-9]+>', '}<>', result).splitlines())
+			== sorted(re.sub(r'}<[0-9]+>', '}<>', rules).splitlines()))
+
+
+def test_externalsort():
+	from random import randint
+	from discodop.util import externalsort
+	items = [(randint(0, 9), n) for n in range(500)]
+	for chunksize, maxfiles in ((1, 2), (3, 4), (7, 64)):
+		assert list(externalsort(items, key=itemgetter(0),
+				chunksize=chunksize, maxfiles=maxfiles)) == sorted(
+				items, key=itemgetter(0))
+
+
+def test_paralleldopgrammar():
+	from discodop.grammar import dopgrammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+
+	def fragment(node, sent, depth):
+		if isinstance(node[0], int):
+			return '(%s %d=%s)' % (node.label, node[0], sent[node[0]])
+		elif depth == 0:
+			return '(%s %s)' % (node.label, ' '.join(
+					'%d=' % n for n in sorted(node.leaves())))
+		return '(%s %s)' % (node.label, ' '.join(
+				fragment(child, sent, depth - 1) for child in node))
+
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	fragments = {}
+	for n, (tree, sent) in enumerate(zip(trees, sents)):
+		for node in tree.subtrees():
+			for depth in (1, 3, 99):
+				fragments.setdefault(fragment(node, sent, depth), []).append(n)
+	grammar1, backtransform1, _, _ = dopgrammar(trees, fragments, numproc=2)
+	grammar2, backtransform2, _, _ = dopgrammar(trees, fragments)
+	assert grammar1 == grammar2
+	assert backtransform1 == backtransform2
+
+
+def test_compactgrammar(tmp_path):
+	import gzip
+	import numpy as np
+	from discodop.grammar import dopgrammar, writegrammar, compactgrammar
+	trees = [Tree('(ROOT (S (NP 0) (VP (V 1) (NP 2))))'),
+			Tree('(ROOT (S (NP 0) (VP 1)))'), Tree('(ROOT (S (NP 0) (VP 1)))')]
+	fragments = {
+			'(ROOT (S 0= 1= 2=))': [0], '(ROOT (S 0= 1=))': [1, 2],
+			'(S (NP 0=) (VP 1= 2=))': [0], '(S (NP 0=Mary) (VP 1= 2=))': [0],
+			'(VP (V 0=sees) (NP 1=John))': [0], '(S (NP 0=) (VP 1=))': [1, 2],
+			'(NP 0=Mary)': [0], '(NP 0=John)': [0, 1, 2],
+			'(VP 0=walks)': [1, 2]}
+	xgrammar, backtransform, altweights, fragments = dopgrammar(
+			trees, fragments)
+	rules, lexicon = writegrammar(xgrammar)
+	prefix, newprefix = str(tmp_path / 'dop'), str(tmp_path / 'new')
+	for ext, data in (('rules', rules), ('lex', lexicon),
+			('backtransform', ''.join('%s\n' % a for a in backtransform)),
+			('fragments', ''.join('%s\t%d\n' % (a, len(b))
+				for a, b in fragments))):
+		with gzip.open('%s.%s.gz' % (prefix, ext), 'wt') as out:
+			out.write(data)
+	np.savez_compressed(prefix + '.probs.npz', **altweights)
+
+	def read(prefix, ext):
+		with gzip.open('%s.%s.gz' % (prefix, ext), 'rt') as inp:
+			return inp.read().splitlines()
+
+	assert compactgrammar(prefix, newprefix) == (len(xgrammar), len(xgrammar))
+	for ext in ('rules', 'lex', 'backtransform', 'fragments'):
+		assert read(prefix, ext) == read(newprefix, ext)
+	before, after = compactgrammar(prefix, newprefix, minfragfreq=2)
+	assert after < before
+	# the fragments with 'sees' are pruned, and with them V@sees
+	assert all(int(a.rsplit('\t', 1)[1]) >= 2 for a in read(newprefix,
+			'fragments'))
+	assert not any('sees' in a for a in read(newprefix, 'rules')
+			+ read(newprefix, 'lex'))
+	assert len(read(newprefix, 'backtransform')) == sum(
+			1 for a in read(newprefix, 'rules') if '}<' not in a.split()[0])
+	rulemap = [int(a) for a in read(newprefix, 'rulemap')]
+	assert len(rulemap) == after
+	probs = np.load(newprefix + '.probs.npz')
+	assert (probs['bon'] == altweights['bon'][rulemap]).all()
+	lhs = [a.split('\t')[0] for a in read(newprefix, 'rules')] + [
+			b.split(' ')[0] for a in read(newprefix, 'lex')
+			for b in a.split('\t')[1:]]
+	for label in set(lhs):
+		assert abs(sum(w for a, w in zip(lhs, probs['ewe'])
+				if a == label) - 1) < 1e-9
+
+
+def test_parallelrules(tmp_path, monkeypatch):
+	from discodop import containers
+	from discodop.containers import Grammar
+	from discodop.util import findfile
+	from discodop.grammar import doubledop, writegrammar
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	corpus = NegraCorpusReader('alpinosample.export', punct='move')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in corpus.trees().values()]
+	xgrammar, backtransform, _, _ = doubledop(trees, sents, numproc=1)
+	rules, lexicon = writegrammar(xgrammar)
+	prefix = str(tmp_path / 'dop')
+	for ext, data in (('rules', rules), ('lex', lexicon)):
+		with open('%s.%s' % (prefix, ext), 'w', encoding='utf8') as out:
+			out.write(data)
+	assert findfile(prefix + '.rules') == prefix + '.rules'
+	assert findfile(prefix + '.probs') == prefix + '.probs.gz'
+	seq = Grammar(findfile(prefix + '.rules'), findfile(prefix + '.lex'),
+			start=trees[0].label, backtransform=backtransform)
+	monkeypatch.setattr(containers, 'PARALLELPARSESIZE', 0)
+	par = Grammar(findfile(prefix + '.rules'), findfile(prefix + '.lex'),
+			start=trees[0].label, backtransform=backtransform, numproc=3)
+	assert par.getlabels() == seq.getlabels()
+	assert str(par) == str(seq)
+	assert par.backtransform == seq.backtransform
+
+
+def test_quantizedweights():
+	import numpy as np
+	from discodop.grammar import QuantizedWeights, quantizationreport
+	weights = np.array([1, 0.9, 0.5, 1e-5, 1e-200, 0])
+	with np.errstate(divide='ignore'):
+		neglogprobs = -np.log(weights)
+	for precision in ('float32', 'uint16'):
+		quantized = QuantizedWeights(weights, precision)
+		assert len(quantized) == len(weights)
+		assert quantized.nbytes < weights.nbytes
+		approx = quantized.neglogprobs()
+		assert approx[-1] == np.inf and np.asarray(quantized)[-1] == 0
+		assert np.allclose(approx[:-1], neglogprobs[:-1], atol=1e-2)
+	quantized = QuantizedWeights(weights, 'uint16')
+	assert (np.abs(quantized.neglogprobs()[:-1] - neglogprobs[:-1]).max()
+			<= quantized.scale / 2 + 1e-9)
+	report = quantizationreport({'ewe': weights}).splitlines()
+	assert [line.split('\t')[:3] for line in report[1:]] == [
+			['ewe', 'float64', '48'], ['ewe', 'float32', '24'],
+			['ewe', 'uint16', '12']]
+
+
+def test_quantizedgrammar(tmp_path):
+	import numpy as np
+	from discodop.containers import Grammar
+	from discodop.grammar import QuantizedWeights
+	rules = [((('S', 'NP', 'VP'), ((0, 1), )), 1),
+			((('VP', 'V', 'NP'), ((0, 1), )), 1),
+			((('NP', 'Epsilon'), ('Mary', )), 3),
+			((('NP', 'Epsilon'), ('John', )), 4),
+			((('NP', 'Epsilon'), ('Bob', )), 7),
+			((('V', 'Epsilon'), ('sees', )), 2),
+			((('V', 'Epsilon'), ('loves', )), 5)]
+	exact = Grammar(rules, start='S')
+	words = exact.getwords()
+	lexprobs = [a for word in words for a in exact.getlexprobs(word)]
+	# phrasal rules have probability 1
+	expected = QuantizedWeights(np.exp(-np.array(
+			exact.numrules * [0.0] + lexprobs)), 'uint16').neglogprobs()[
+			exact.numrules:]
+	assert not np.allclose(lexprobs, expected, rtol=0, atol=1e-12)
+	filename = str(tmp_path / 'grammar.bin')
+	exact.tobinfile(filename)
+	for grammar in (Grammar(rules, start='S', precision='uint16'),
+			Grammar.frombinfile(filename, None, None, precision='uint16')):
+		assert np.allclose(
+				[a for word in words for a in grammar.getlexprobs(word)],
+				expected, rtol=0, atol=1e-12)
+
+
 def test_serialization(tmp_path):
 	# assumes current working directory is project root
 	tb = readtreebanks('alpinosample.export', fmt='export')
@@ -879,6 +1132,47 @@ def test_serialization(tmp_path):
 	assert trees.__getstate__() == trees1.__getstate__()
 
 
+def test_chartserialization():
+	from discodop.containers import Grammar
+	from discodop.grammar import dopreduction
+	from discodop.treebank import NegraCorpusReader
+	from discodop.treetransforms import addfanoutmarkers
+	from discodop.disambiguation import marginalize, REMOVEIDS
+	from discodop.parser import CHARTTYPES
+	from discodop import plcfrs, pcfg
+	corpus = NegraCorpusReader('alpinosample.export')
+	sents = list(corpus.sents().values())
+	trees = [addfanoutmarkers(binarize(a.copy(True), horzmarkov=1))
+			for a in list(corpus.trees().values())[:2]]
+	grammar = Grammar(dopreduction(trees, sents[:2])[0],
+			start=trees[0].label)
+	grammar.getmapping(None, striplabelre=REMOVEIDS)
+	chart, _ = plcfrs.parse(sents[0], grammar, exhaustive=True)
+	assert chart
+	data = chart.tobytes()
+	chart1 = CHARTTYPES[type(chart).__name__].frombytes(data, grammar)
+	assert str(chart1) == str(chart)
+	assert chart1.tobytes() == data
+	assert marginalize('mpp', chart1, k=50)[0] == marginalize(
+			'mpp', chart, k=50)[0]
+
+	grammar = Grammar(
+			[((('S', 'A', 'B'), ((0, 1), )), 1.0),
+			((('A', 'Epsilon'), ('a', )), 1.0),
+			((('B', 'Epsilon'), ('b', )), 1.0)],
+			start='S')
+	chart, _ = pcfg.parse(['a', 'b'], grammar)
+	assert chart
+	chart1 = type(chart).frombytes(chart.tobytes(), grammar)
+	assert str(chart1) == str(chart)
+	try:
+		plcfrs.SmallLCFRSChart.frombytes(chart.tobytes(), grammar)
+	except ValueError:
+		pass
+	else:
+		raise AssertionError('expected ValueError for wrong chart type')
+
+
 def test_issue51():
 	from discodop.containers import Grammar
 	from discodop.plcfrs import parse
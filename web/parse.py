@@ -37,6 +37,7 @@ LOG = APP.logger
 
 LIMIT = 40  # maximum sentence length
 CACHE = SimpleCache()
+CHARTCACHESIZE = 256 * 1024 * 1024  # bytes of charts to cache per grammar
 PARSERS = {}
 SHOWFUNC = True  # show function tags in results
 SHOWMORPH = True  # show morphological features in results
@@ -239,7 +240,7 @@ def loadparsers():
 			params.resultdir = directory
 			readgrammars(directory, params.stages, params.postagging,
 					params.transformations, top=getattr(params, 'top', 'ROOT'))
-			PARSERS[lang] = Parser(params)
+			PARSERS[lang] = Parser(params, cachesize=CHARTCACHESIZE)
 			LOG.info('Grammar for %s loaded.', lang)
 	if not PARSERS:
 		raise ValueError('no grammars found!')